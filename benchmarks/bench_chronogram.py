@@ -0,0 +1,141 @@
+"""Benchmarks for the chronogram pipeline, run against an offline OpenTree stand-in.
+
+Measures wall time, peak traced memory and OpenTree API call counts for
+node_ages, map_conflict_ages, combine_ages_from_sources, write_fastdate_prior
+and write_fastdate_tree on synthetic chronograms of several sizes.
+
+Example
+-------
+python benchmarks/bench_chronogram.py --scales 100 1000 10000 --trees 10 --json bench.json
+python benchmarks/bench_chronogram.py --record-dir recorded/   # also replays recorded responses
+"""
+#!/usr/bin/env python3
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import tracemalloc
+
+import dendropy
+
+from chronosynth import chronogram
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from offline_ot import OfflineOpenTree, offline
+
+
+def reset_caches(scratch):
+    """
+    Empties chronogram's in-memory SOURCE_CACHE and the source map store in scratch,
+    so a measured run starts cold rather than timing a cache hit.
+    """
+    chronogram.SOURCE_CACHE.evict()
+    for cache in chronogram._source_map_caches.values():
+        cache.close()
+    chronogram._source_map_caches.clear()
+    for name in os.listdir(scratch):
+        if name.startswith('source_maps.db'):
+            os.remove(os.path.join(scratch, name))
+
+
+def measure(offline_ot, scratch, func, *args, **kwargs):
+    """
+    Runs func twice from cold caches, once for wall time and API call counts,
+    and once under tracemalloc for peak memory.
+    Returns (result, {'seconds':, 'peak_mb':, 'calls':})
+    """
+    reset_caches(scratch)
+    before = offline_ot.call_counts.copy()
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    seconds = time.perf_counter() - start
+    calls = dict(offline_ot.call_counts - before)
+    reset_caches(scratch)
+    tracemalloc.start()
+    func(*args, **kwargs)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, {'seconds': seconds, 'peak_mb': peak / 1e6, 'calls': calls}
+
+
+def bench_scale(offline_ot, source_ids, subtree_node, workers, scratch):
+    """Benchmarks each pipeline stage on the given sources. Returns {stage: measurement}"""
+    chronogram.config.set('paths', 'cache_file_dir', scratch)
+    ret = {}
+    _, ret['node_ages'] = measure(offline_ot, scratch, chronogram.node_ages, source_ids[0])
+    _, ret['map_conflict_ages'] = measure(offline_ot, scratch, chronogram.map_conflict_ages, source_ids[0], fresh=True)
+    dates, ret['combine_ages_from_sources'] = measure(offline_ot, scratch, chronogram.combine_ages_from_sources,
+                                                       source_ids, fresh=True, workers=workers)
+    if subtree_node is not None:
+        newick = offline_ot.synth_subtree(node_id=subtree_node, label_format='id').response_dict['newick']
+        subtree = dendropy.Tree.get_from_string(newick, schema='newick')
+        _, ret['write_fastdate_prior'] = measure(offline_ot, scratch, chronogram.write_fastdate_prior, subtree, dates,
+                                                 outputfile=os.path.join(scratch, 'node_prior.txt'))
+        subtree_path = os.path.join(scratch, 'unresolved.tre')
+        subtree.write(path=subtree_path, schema='newick')
+        _, ret['write_fastdate_tree'] = measure(offline_ot, scratch, chronogram.write_fastdate_tree, subtree_path,
+                                                outputfile=os.path.join(scratch, 'fastdate_input.tre'))
+    return ret
+
+
+def run(scales, n_trees, workers=1, record_dir=None, seed=1):
+    """Returns a list of result rows, one per scale and stage"""
+    rows = []
+    scratch = tempfile.mkdtemp(prefix='chronosynth_bench')
+    try:
+        for n_tips in scales:
+            offline_ot = OfflineOpenTree()
+            source_ids = []
+            for i in range(n_trees):
+                # Ids differ between scales, so no scale is served another's cached trees
+                source_ids += offline_ot.add_synthetic_study('ot_bench{}_{}'.format(n_tips, i), n_tips, seed=seed + i)
+            subtree_node = next(iter(offline_ot.subtrees))
+            with offline(chronogram, offline_ot):
+                stages = bench_scale(offline_ot, source_ids, subtree_node, workers, scratch)
+            for stage, measured in stages.items():
+                rows.append(dict(measured, scale='{} tips x {} trees'.format(n_tips, n_trees), stage=stage))
+        if record_dir:
+            offline_ot = OfflineOpenTree(record_dir=record_dir)
+            with offline(chronogram, offline_ot):
+                source_ids = sorted(chronogram.find_trees())
+                source_ids = [source_id for source_id in source_ids
+                              if offline_ot.get_study(source_id.split('@')[0]).response_dict is not None]
+                if source_ids:
+                    stages = bench_scale(offline_ot, source_ids, None, workers, scratch)
+                    for stage, measured in stages.items():
+                        rows.append(dict(measured, scale='recorded x {} trees'.format(len(source_ids)), stage=stage))
+    finally:
+        shutil.rmtree(scratch)
+    return rows
+
+
+def main(arg_list):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument("--scales", nargs='+', type=int, default=[100, 1000, 10000],
+                        help='Number of tips in each synthetic chronogram.')
+    parser.add_argument("--trees", type=int, default=10,
+                        help='Number of chronograms combined at each scale.')
+    parser.add_argument("--workers", type=int, default=1,
+                        help='Workers passed to combine_ages_from_sources.')
+    parser.add_argument("--record-dir", default=None,
+                        help='Directory of responses saved with offline_ot.record_responses to replay.')
+    parser.add_argument("--json", default=None,
+                        help='Write results as JSON to this file.')
+    args = parser.parse_args(arg_list)
+    rows = run(args.scales, args.trees, workers=args.workers, record_dir=args.record_dir)
+    sys.stdout.write("{:<28} {:<28} {:>10} {:>10}  {}\n".format('scale', 'stage', 'seconds', 'peak MB', 'API calls'))
+    for row in rows:
+        calls = ', '.join('{}={}'.format(method, count) for method, count in sorted(row['calls'].items()))
+        sys.stdout.write("{:<28} {:<28} {:>10.3f} {:>10.1f}  {}\n".format(row['scale'], row['stage'],
+                                                                          row['seconds'], row['peak_mb'], calls))
+    if args.json:
+        with open(args.json, 'w') as out:
+            json.dump(rows, out, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
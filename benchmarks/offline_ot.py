@@ -0,0 +1,248 @@
+"""Offline stand-in for the OpenTree API, used by the benchmarks.
+
+Replays recorded responses from a directory, and can generate synthetic
+chronograms of any size, with matching conflict data and synth subtrees.
+"""
+#!/usr/bin/env python3
+import os
+import json
+import random
+import collections
+import contextlib
+
+
+class OfflineResponse(object):
+    """Quacks like opentree's WebServiceCallRecord for the attributes chronogram uses"""
+    def __init__(self, response_dict, status_code=200):
+        self.response_dict = response_dict
+        self.status_code = status_code
+
+    def __bool__(self):
+        return self.status_code == 200
+
+
+def _response_path(record_dir, method, key=None):
+    if key is None:
+        return os.path.join(record_dir, method + '.json')
+    return os.path.join(record_dir, method, key.replace('/', '_') + '.json')
+
+
+class OfflineOpenTree(object):
+    """
+    Drop-in for the opentree OT object with the calls chronogram makes:
+    find_trees, get_study, conflict_info, about, synth_subtree, synth_node_info and taxon_info.
+
+    Responses come from, in order, synthetic studies added with add_synthetic_study,
+    and JSON files in record_dir written by record_responses.
+    Missing responses get a 404 with a None response_dict.
+    call_counts counts calls by method name.
+    """
+    _api_endpoint = 'offline'
+
+    def __init__(self, record_dir=None, synth_id='opentree_offline', phylesystem_sha='0' * 40):
+        self.record_dir = record_dir
+        self.synth_id = synth_id
+        self.phylesystem_sha = phylesystem_sha
+        self.studies = {}
+        self.conflicts = {}
+        self.subtrees = {}
+        self.call_counts = collections.Counter()
+
+    def _replay(self, method, key=None):
+        if self.record_dir is None:
+            return OfflineResponse(None, 404)
+        path = _response_path(self.record_dir, method, key)
+        if not os.path.exists(path):
+            return OfflineResponse(None, 404)
+        with open(path) as response_file:
+            return OfflineResponse(json.load(response_file))
+
+    def find_trees(self, value, search_property, exact=False, verbose=False):
+        self.call_counts['find_trees'] += 1
+        resp = self._replay('find_trees', '{}={}'.format(search_property, value))
+        if resp.response_dict is None:
+            resp = OfflineResponse({'matched_studies': []})
+        if self.studies and search_property == 'ot:branchLengthMode' and value == 'ot:time':
+            matched = [{'ot:studyId': study_id,
+                        'matched_trees': [{'ot:treeId': tree_id} for tree_id in _tree_ids(nexson)]}
+                       for study_id, nexson in self.studies.items()]
+            resp = OfflineResponse({'matched_studies': resp.response_dict['matched_studies'] + matched})
+        return resp
+
+    def get_study(self, study_id):
+        self.call_counts['get_study'] += 1
+        if study_id in self.studies:
+            return OfflineResponse({'data': self.studies[study_id], 'sha': self.phylesystem_sha})
+        return self._replay('get_study', study_id)
+
+    def conflict_info(self, study_id, tree_id, compare_to='synth'):
+        self.call_counts['conflict_info'] += 1
+        source_id = '{}@{}'.format(study_id, tree_id)
+        if source_id in self.conflicts:
+            return OfflineResponse(self.conflicts[source_id])
+        return self._replay('conflict_info', source_id)
+
+    def about(self):
+        self.call_counts['about'] += 1
+        resp = self._replay('about')
+        if resp.response_dict is not None:
+            return resp.response_dict
+        return {'taxonomy_about': {}, 'synth_tree_about': {'synth_id': self.synth_id}}
+
+    def synth_subtree(self, node_id=None, ott_id=None, tree_format="newick", label_format="name_and_id",
+                      height_limit=None):
+        self.call_counts['synth_subtree'] += 1
+        if node_id in self.subtrees:
+            return OfflineResponse({'newick': self.subtrees[node_id]})
+        return self._replay('synth_subtree', node_id)
+
+    def synth_node_info(self, node_ids=None, node_id=None, ott_id=None, include_lineage=False):
+        self.call_counts['synth_node_info'] += 1
+        if isinstance(node_ids, str):
+            node_ids = [node_ids]
+        return self._replay('synth_node_info', ','.join(node_ids or [node_id]))
+
+    def taxon_info(self, ott_id=None, source_id=None, include_lineage=False,
+                   include_children=False, include_terminal_descendants=False):
+        self.call_counts['taxon_info'] += 1
+        return self._replay('taxon_info', str(ott_id))
+
+    def add_synthetic_study(self, study_id, n_tips, n_trees=1, seed=None, time_unit='Myr'):
+        """
+        Adds a study of random ultrametric chronograms with n_tips tips each,
+        conflict data mapping every internal node to a synth node, and for each tree
+        a synth subtree (newick labelled with ids) rooted at the tree's root.
+        Returns the source ids of the new trees.
+        """
+        rng = random.Random(seed)
+        study = {'nexml': {'otusById': {}, 'treesById': {}}}
+        source_ids = []
+        for t in range(n_trees):
+            tree_id = 'tree{}'.format(t + 1)
+            otus_id = 'otus{}'.format(t + 1)
+            tree_obj, otus, conflict, newick, root_witness = synthetic_chronogram(n_tips, rng, time_unit)
+            study['nexml']['otusById'][otus_id] = {'otuById': otus}
+            study['nexml']['treesById']['trees{}'.format(t + 1)] = {'@otus': otus_id, 'treeById': {tree_id: tree_obj}}
+            source_id = '{}@{}'.format(study_id, tree_id)
+            self.conflicts[source_id] = conflict
+            self.subtrees[root_witness] = newick
+            source_ids.append(source_id)
+        self.studies[study_id] = study
+        return source_ids
+
+
+def _tree_ids(nexson):
+    for tree_set in nexson['nexml']['treesById'].values():
+        for tree_id in tree_set['treeById']:
+            yield tree_id
+
+
+def synthetic_chronogram(n_tips, rng, time_unit='Myr'):
+    """
+    Random ultrametric tree built by merging random pairs of lineages at increasing heights.
+    Tips are ott ids 1..n_tips, and each internal node is witnessed by the synth node
+    mrcaott{first}ott{last} of its clade.
+    Returns (NexSON tree object, otuById dict, conflict response, synth subtree newick, root witness)
+    """
+    heights = [0.0] * n_tips
+    children = [[] for _ in range(n_tips)]
+    clades = [(i + 1, i + 1) for i in range(n_tips)]
+    active = list(range(n_tips))
+    height = 0.0
+    while len(active) > 1:
+        height += rng.expovariate(len(active))
+        a, b = rng.sample(range(len(active)), 2)
+        left, right = active[a], active[b]
+        new = len(heights)
+        heights.append(height)
+        children.append([left, right])
+        clades.append((clades[left][0], clades[right][1]))
+        for i in sorted((a, b), reverse=True):
+            active.pop(i)
+        active.append(new)
+    root = active[0]
+    node_id = lambda i: 'node{}'.format(i + 1)
+    witness = lambda i: 'mrcaott{}ott{}'.format(*clades[i]) if children[i] else 'ott{}'.format(clades[i][0])
+    nodes = {}
+    edges = {}
+    otus = {}
+    conflict = {}
+    for i in range(len(heights)):
+        nodes[node_id(i)] = {}
+        if not children[i]:
+            otu_id = 'otu{}'.format(i + 1)
+            otus[otu_id] = {'^ot:originalLabel': 'taxon {}'.format(i + 1), '^ot:ottId': i + 1}
+            nodes[node_id(i)]['@otu'] = otu_id
+        else:
+            edges[node_id(i)] = {'edge{}'.format(child + 1): {'@source': node_id(i),
+                                                              '@target': node_id(child),
+                                                              '@length': heights[i] - heights[child]}
+                                 for child in children[i]}
+            if i != root:
+                conflict[node_id(i)] = {'status': 'supported_by', 'witness': witness(i)}
+    nodes[node_id(root)]['@root'] = True
+    tree_obj = {'@xsi:type': 'nex:FloatTree',
+                '^ot:rootNodeId': node_id(root),
+                '^ot:specifiedRoot': node_id(root),
+                '^ot:branchLengthMode': 'ot:time',
+                '^ot:branchLengthTimeUnit': time_unit,
+                'nodeById': nodes,
+                'edgeBySourceId': edges}
+    return tree_obj, otus, conflict, _newick(root, children, witness), witness(root)
+
+
+def _newick(root, children, label):
+    parts = []
+    to_proc = [root]
+    while to_proc:
+        item = to_proc.pop()
+        if isinstance(item, str):
+            parts.append(item)
+        elif children[item]:
+            parts.append('(')
+            to_proc.append(')' + label(item))
+            for j, child in enumerate(reversed(children[item])):
+                if j:
+                    to_proc.append(',')
+                to_proc.append(child)
+        else:
+            parts.append(label(item))
+    return ''.join(parts) + ';'
+
+
+def record_responses(ot, record_dir, source_ids=(), subtree_nodes=(), search_values=(('ot:branchLengthMode', 'ot:time'),)):
+    """
+    Saves live responses from an opentree OT object to record_dir, for replay by OfflineOpenTree.
+    """
+    def save(method, key, response_dict):
+        path = _response_path(record_dir, method, key)
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as response_file:
+            json.dump(response_dict, response_file)
+    save('about', None, ot.about())
+    for search_property, value in search_values:
+        save('find_trees', '{}={}'.format(search_property, value),
+             ot.find_trees(search_property=search_property, value=value).response_dict)
+    for study_id in sorted(set(source_id.split('@')[0] for source_id in source_ids)):
+        save('get_study', study_id, ot.get_study(study_id).response_dict)
+    for source_id in source_ids:
+        study_id, tree_id = source_id.split('@')
+        save('conflict_info', source_id, ot.conflict_info(study_id=study_id, tree_id=tree_id).response_dict)
+    for node_id in subtree_nodes:
+        save('synth_subtree', node_id, ot.synth_subtree(node_id=node_id, label_format='id').response_dict)
+
+
+@contextlib.contextmanager
+def offline(chronogram, offline_ot):
+    """
+    Points chronogram at an OfflineOpenTree, instrumented as the real OT is, with get_phylesystem_sha answering
+    offline_ot.phylesystem_sha instead of running git ls-remote, and restores both on exit.
+    """
+    saved = chronogram.OT, chronogram.get_phylesystem_sha
+    chronogram.OT = chronogram.instrument.InstrumentedOT(offline_ot)
+    chronogram.get_phylesystem_sha = lambda repo_url=None, repo_dir=None: offline_ot.phylesystem_sha
+    try:
+        yield offline_ot
+    finally:
+        chronogram.OT, chronogram.get_phylesystem_sha = saved
@@ -0,0 +1,145 @@
+"""Streaming summary of node ages across replicate chronograms"""
+#!/usr/bin/env python3
+import random
+
+import numpy as np
+import dendropy
+
+from chronosynth.arraytree import ArrayTree, TreeBatch, batch_ages, clade_hashes, suppress_unifurcations
+
+
+class ReplicateAgeSummary(object):
+    """
+    Running per-node age statistics over replicate chronograms that are resolutions of one reference tree,
+    e.g. fastdate runs on randomly resolved copies of a synth subtree.
+
+    Replicates are added one at a time, and only running counts, means and sums of squares
+    (Welford's method) are kept per reference node, so memory scales with one tree whatever the
+    number of replicates. Only if quantiles are asked for are the ages themselves kept.
+    Reference nodes are found in each replicate by the set of tips below them (see arraytree.clade_hashes),
+    so replicates don't need to keep internal node labels.
+    """
+    def __init__(self, reference, quantiles=None, seed=0):
+        """
+        reference: the unresolved tree, as a path to a newick file, dendropy tree or ArrayTree,
+                   with nodes labelled by synth node id
+        quantiles: optional list of quantiles to report, e.g. [0.025, 0.5, 0.975]
+        seed: seed for the random tip hashes
+        """
+        if isinstance(reference, str):
+            reference = dendropy.Tree.get_from_path(reference, schema="newick")
+        if not isinstance(reference, ArrayTree):
+            reference = ArrayTree.from_dendropy(reference)
+        self.reference = suppress_unifurcations(reference)
+        rng = random.Random(seed)
+        internal = self.reference.is_internal()
+        self.tip_hash = {self.reference.labels[i]: rng.getrandbits(64) for i in np.flatnonzero(~internal)}
+        self.keys = clade_hashes(self.reference, self.tip_hash)
+        self.quantiles = list(quantiles) if quantiles else []
+        self.n_replicates = 0
+        self.n = np.zeros(len(self.reference), dtype=np.int64)
+        self.mean = np.zeros(len(self.reference), dtype=np.float64)
+        self.m2 = np.zeros(len(self.reference), dtype=np.float64)
+        self.values = [[] for _ in range(len(self.reference))] if self.quantiles else None
+
+    def add(self, replicate):
+        """
+        Adds the node ages of one replicate chronogram
+        replicate: path to a newick file, dendropy tree or ArrayTree
+        """
+        if isinstance(replicate, str):
+            replicate = dendropy.Tree.get_from_path(replicate, schema="newick")
+        if not isinstance(replicate, ArrayTree):
+            replicate = ArrayTree.from_dendropy(replicate)
+        ages = batch_ages(TreeBatch([replicate]))
+        hashes = clade_hashes(replicate, self.tip_hash)
+        order = np.argsort(hashes)
+        pos = np.searchsorted(hashes[order], self.keys)
+        pos[pos == len(order)] = 0
+        found = np.flatnonzero(hashes[order][pos] == self.keys)
+        x = ages[order][pos[found]]
+        self.n[found] += 1
+        delta = x - self.mean[found]
+        self.mean[found] += delta / self.n[found]
+        self.m2[found] += delta * (x - self.mean[found])
+        if self.values is not None:
+            for i, age in zip(found.tolist(), x.tolist()):
+                self.values[i].append(age)
+        self.n_replicates += 1
+
+    def node_stats(self, i):
+        """{'n':, 'mean':, 'variance':, and 'quantiles': {q: age} if asked for} for reference node i"""
+        n = int(self.n[i])
+        stats = {'n': n,
+                 'mean': float(self.mean[i]) if n else None,
+                 'variance': float(self.m2[i] / (n - 1)) if n > 1 else None}
+        if self.quantiles:
+            stats['quantiles'] = dict(zip(self.quantiles, np.quantile(self.values[i], self.quantiles).tolist())) if n else {}
+        return stats
+
+    def summary(self):
+        """{synth node label: node_stats} over the labelled internal nodes of the reference"""
+        internal = self.reference.is_internal()
+        return {self.reference.labels[i]: self.node_stats(i)
+                for i in np.flatnonzero(internal) if self.reference.labels[i]}
+
+    def summary_tree(self):
+        """
+        The reference tree with edge lengths from mean node ages. Tips have age 0,
+        and nodes not found in any replicate take the age of their oldest child.
+        """
+        ref = self.reference
+        age = np.where(self.n > 0, self.mean, 0.0)
+        for i in reversed(range(1, len(ref))):
+            parent = ref.parent[i]
+            if self.n[parent] == 0:
+                age[parent] = max(age[parent], age[i])
+        edge_length = np.full(len(ref), np.nan)
+        edge_length[1:] = np.maximum(age[ref.parent[1:]] - age[1:], 0.0)
+        return ArrayTree(ref.labels, ref.parent, edge_length, dict(ref.annotations))
+
+    def write(self, outputfile):
+        """
+        Writes the summary tree as newick, with the statistics of each internal node
+        in a comment, e.g. [&age_mean=10.2,age_variance=0.3,age_q0.5=10.1,n=10]
+        """
+        internal = self.reference.is_internal()
+        comments = [None] * len(self.reference)
+        for i in np.flatnonzero(internal):
+            stats = self.node_stats(i)
+            if not stats['n']:
+                continue
+            parts = ['age_mean={}'.format(stats['mean'])]
+            if stats['variance'] is not None:
+                parts.append('age_variance={}'.format(stats['variance']))
+            for q, value in stats.get('quantiles', {}).items():
+                parts.append('age_q{}={}'.format(q, value))
+            parts.append('n={}'.format(stats['n']))
+            comments[i] = '&' + ','.join(parts)
+        with open(outputfile, 'w') as out:
+            out.write(self.summary_tree().to_newick(comments=comments))
+            out.write('\n')
+        return outputfile
+
+
+def summarize_replicates(reference, replicates, outputfile=None, quantiles=None):
+    """
+    Summarizes node ages over replicate chronograms, reading them one at a time.
+
+    Inputs
+    ------
+    reference: the unresolved tree the replicates were resolved from
+    replicates: iterable of paths to newick files, dendropy trees or ArrayTrees
+    outputfile: if given, the summary tree is written there (see ReplicateAgeSummary.write)
+    quantiles: optional list of quantiles to report
+
+    Returns
+    -------
+    the ReplicateAgeSummary
+    """
+    summary = ReplicateAgeSummary(reference, quantiles=quantiles)
+    for replicate in replicates:
+        summary.add(replicate)
+    if outputfile is not None:
+        summary.write(outputfile)
+    return summary
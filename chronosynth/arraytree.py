@@ -0,0 +1,464 @@
+"""Array backed trees and vectorized node age calculations"""
+#!/usr/bin/env python3
+import numpy as np
+from dendropy.dataio import nexusprocessing
+
+
+_NON_ANNOTATIONS = frozenset(["^ot:inGroupClade", "^ot:rootNodeId", "^ot:specifiedRoot"])
+
+
+class ArrayTree(object):
+    """
+    Compact tree stored as arrays, with nodes in preorder (every parent before its children,
+    siblings in child order).
+
+    labels: list of node labels
+    parent: int array of parent indices, -1 for the root
+    edge_length: float array of subtending edge lengths, nan where missing
+    annotations: dict of tree level annotations, e.g. branchLengthMode
+    """
+    __slots__ = ('labels', 'parent', 'edge_length', 'annotations')
+
+    def __init__(self, labels, parent, edge_length, annotations=None):
+        self.labels = list(labels)
+        self.parent = np.asarray(parent, dtype=np.int64)
+        self.edge_length = np.asarray(edge_length, dtype=np.float64)
+        self.annotations = annotations if annotations is not None else {}
+        assert len(self.labels) == len(self.parent) == len(self.edge_length)
+        assert len(self.parent) == 0 or (self.parent[0] == -1 and (self.parent[1:] < np.arange(1, len(self.parent))).all()), \
+            "nodes must be in preorder"
+
+    def __len__(self):
+        return len(self.parent)
+
+    @classmethod
+    def from_dendropy(cls, tree):
+        """Builds an ArrayTree from a dendropy tree. Leaves without a label take their taxon label."""
+        index = {}
+        labels = []
+        parent = []
+        edge_length = []
+        for i, node in enumerate(tree.preorder_node_iter()):
+            index[node] = i
+            if node.label is None and node.taxon is not None and node.is_leaf():
+                labels.append(node.taxon.label)
+            else:
+                labels.append(node.label)
+            parent.append(index[node.parent_node] if node.parent_node is not None else -1)
+            edge_length.append(node.edge.length if node.edge.length is not None else np.nan)
+        annotations = {annotation.name: annotation.value for annotation in tree.annotations}
+        return cls(labels, parent, edge_length, annotations)
+
+    @classmethod
+    def from_nexson(cls, nexson, tree_id):
+        """
+        Builds an ArrayTree straight from the NexSON dict of a study,
+        reading only the edges, edge lengths, node ids and '^ot:' tree annotations.
+        Node labels are the NexSON node ids, as in opentree's DendropyConvert.tree_from_nexson.
+        """
+        tree_obj = None
+        for tree_set in nexson['nexml'].get('treesById', {}).values():
+            tree_obj = tree_set.get('treeById', {}).get(tree_id)
+            if tree_obj:
+                break
+        if tree_obj is None:
+            raise KeyError('Tree with id "{}" not found in NexSON'.format(tree_id))
+        annotations = {key[4:]: value for key, value in tree_obj.items()
+                       if key.startswith('^ot:') and key not in _NON_ANNOTATIONS}
+        edges_by_src = tree_obj['edgeBySourceId']
+        labels = []
+        parent = []
+        edge_length = []
+        to_proc = [(tree_obj['^ot:rootNodeId'], -1, None)]
+        while to_proc:
+            node_id, parent_index, length = to_proc.pop()
+            index = len(labels)
+            labels.append(node_id)
+            parent.append(parent_index)
+            edge_length.append(float(length) if length is not None else np.nan)
+            edges = list(edges_by_src.get(node_id, {}).values())
+            for e_dict in reversed(edges):
+                to_proc.append((e_dict['@target'], index, e_dict.get('@length')))
+        return cls(labels, parent, edge_length, annotations)
+
+    def is_internal(self):
+        """Boolean array, True for nodes with children"""
+        internal = np.zeros(len(self), dtype=bool)
+        internal[self.parent[1:]] = True
+        return internal
+
+    def children(self):
+        """List of child index lists, in child order"""
+        kids = [[] for _ in range(len(self))]
+        for i, parent in enumerate(self.parent.tolist()[1:], 1):
+            kids[parent].append(i)
+        return kids
+
+    def to_newick(self, comments=None):
+        """
+        Newick string, with labels escaped and edge lengths formatted as dendropy writes them.
+        comments: optional list with a string or None per node, written in square brackets after the node
+        """
+        kids = self.children()
+        lengths = self.edge_length.tolist()
+        parts = []
+        to_proc = [0] if len(self) else []
+        while to_proc:
+            item = to_proc.pop()
+            if isinstance(item, str):
+                parts.append(item)
+                continue
+            if kids[item]:
+                parts.append('(')
+                to_proc.append(')' + self._node_tag(item, lengths[item], comments))
+                for j, child in enumerate(reversed(kids[item])):
+                    if j:
+                        to_proc.append(',')
+                    to_proc.append(child)
+            else:
+                parts.append(self._node_tag(item, lengths[item], comments))
+        return ''.join(parts) + ';'
+
+    def _node_tag(self, i, length, comments=None):
+        tag = ''
+        if self.labels[i]:
+            tag = nexusprocessing.escape_nexus_token(str(self.labels[i]),
+                                                     preserve_spaces=False,
+                                                     quote_underscores=True,
+                                                     protect_regex=r'''[()[\]{},;:'"\0\t\n]''')
+        if length == length:
+            tag += ':{}'.format(length)
+        if comments is not None and comments[i]:
+            tag += '[{}]'.format(comments[i])
+        return tag
+
+
+def _from_lists(root, kids, labels, lengths, annotations):
+    """ArrayTree from child lists, relabelled in preorder from root"""
+    new_labels = []
+    parent = []
+    edge_length = []
+    to_proc = [(root, -1)]
+    while to_proc:
+        node, parent_index = to_proc.pop()
+        index = len(new_labels)
+        new_labels.append(labels[node])
+        parent.append(parent_index)
+        edge_length.append(np.nan if lengths[node] is None else lengths[node])
+        for child in reversed(kids[node]):
+            to_proc.append((child, index))
+    return ArrayTree(new_labels, parent, edge_length, dict(annotations))
+
+
+def _postorder(root, kids):
+    order = []
+    to_proc = [(root, False)]
+    while to_proc:
+        node, expanded = to_proc.pop()
+        if expanded or not kids[node]:
+            order.append(node)
+        else:
+            to_proc.append((node, True))
+            for child in reversed(kids[node]):
+                to_proc.append((child, False))
+    return order
+
+
+def _suppress_unifurcations(root, kids, par, lengths):
+    """Removes nodes with one child from child lists, as dendropy's suppress_unifurcations. Returns the new root"""
+    for node in _postorder(root, kids):
+        if len(kids[node]) != 1:
+            continue
+        child = kids[node][0]
+        if lengths[node] is not None:
+            lengths[child] = lengths[node] if lengths[child] is None else lengths[child] + lengths[node]
+        if node == root:
+            root = child
+        else:
+            siblings = kids[par[node]]
+            siblings[siblings.index(node)] = child
+        par[child] = par[node]
+        kids[node] = []
+    return root
+
+
+def _to_lists(tree):
+    lengths = [None if length != length else length for length in tree.edge_length.tolist()]
+    return tree.children(), tree.parent.tolist(), list(tree.labels), lengths
+
+
+def suppress_unifurcations(tree):
+    """Copy of an ArrayTree without nodes of outdegree one, as dendropy's suppress_unifurcations"""
+    kids, par, labels, lengths = _to_lists(tree)
+    root = _suppress_unifurcations(0, kids, par, lengths)
+    return _from_lists(root, kids, labels, lengths, tree.annotations)
+
+
+def clade_hashes(tree, tip_hash):
+    """
+    Hash of the set of leaves below each node: the sum, wrapping at 2**64, of tip_hash[label] over its leaves.
+    With random 64 bit tip hashes, the same clade gets the same hash in any tree, however it is resolved.
+    Returns a uint64 array.
+    """
+    internal = tree.is_internal()
+    hashes = np.zeros(len(tree), dtype=np.uint64)
+    leaves = np.flatnonzero(~internal)
+    try:
+        hashes[leaves] = np.array([tip_hash[tree.labels[i]] for i in leaves], dtype=np.uint64)
+    except KeyError as err:
+        raise ValueError("Tip {} has no hash".format(err))
+    for level in reversed(_level_groups(_chain_rank(tree.parent))[1:]):
+        np.add.at(hashes, tree.parent[level], hashes[level])
+    return hashes
+
+
+def resolve_polytomies(tree, rng, br_len=None, polytomy_br=None):
+    """
+    A randomly resolved copy of an ArrayTree, with unifurcations suppressed.
+    Polytomies are broken by sequential addition, as in dendropy's Tree.resolve_polytomies
+    with an rng, making the same rng calls, so a given seed gives the same tree as dendropy.
+    New nodes get edge length 0, and unifurcations are suppressed as in dendropy's
+    suppress_unifurcations, adding their edge length to their child's.
+
+    Inputs
+    ------
+    tree: ArrayTree
+    rng: random.Random, or anything with sample and choice
+    br_len: if given, the length of non root edges with no length
+    polytomy_br: if given, the length of non root edges with length 0, including the new ones
+    """
+    kids, par, labels, lengths = _to_lists(tree)
+    root = 0
+    for node in [node for node in _postorder(root, kids) if len(kids[node]) > 2]:
+        to_attach = rng.sample(kids[node], len(kids[node]) - 2)
+        detached = set(to_attach)
+        kids[node] = [child for child in kids[node] if child not in detached]
+        attachment_points = list(kids[node])
+        attachment_points.append(node)
+        while to_attach:
+            next_child = to_attach.pop()
+            next_sib = rng.choice(attachment_points)
+            new = len(kids)
+            labels.append(None)
+            lengths.append(0.0)
+            if next_sib == node:
+                kids.append(kids[node])
+                for child in kids[new]:
+                    par[child] = new
+                kids[node] = [new, next_child]
+                par.append(node)
+                par[next_child] = node
+            else:
+                p = par[next_sib]
+                kids[p].remove(next_sib)
+                kids[p].append(new)
+                kids.append([next_sib, next_child])
+                par.append(p)
+                par[next_sib] = new
+                par[next_child] = new
+            attachment_points.append(new)
+            attachment_points.append(next_child)
+    root = _suppress_unifurcations(root, kids, par, lengths)
+    if br_len is not None or polytomy_br is not None:
+        for node in _postorder(root, kids):
+            if node == root:
+                continue
+            if br_len is not None and lengths[node] is None:
+                lengths[node] = br_len
+            if polytomy_br is not None and lengths[node] == 0:
+                lengths[node] = polytomy_br
+    return _from_lists(root, kids, labels, lengths, tree.annotations)
+
+
+class TreeBatch(object):
+    """
+    Several ArrayTrees concatenated into one set of arrays, so that
+    calculations run over all of their nodes at once.
+    """
+    def __init__(self, trees):
+        self.trees = list(trees)
+        sizes = np.array([len(tree) for tree in self.trees], dtype=np.int64)
+        self.offsets = np.concatenate([[0], np.cumsum(sizes)])
+        n_nodes = int(self.offsets[-1])
+        self.tree_index = np.repeat(np.arange(len(self.trees)), sizes)
+        if self.trees:
+            self.parent = np.concatenate([np.where(tree.parent >= 0, tree.parent + offset, -1)
+                                          for tree, offset in zip(self.trees, self.offsets)])
+            # Missing edge lengths count as 0, as in dendropy
+            self.edge_length = np.nan_to_num(np.concatenate([tree.edge_length for tree in self.trees]))
+        else:
+            self.parent = np.zeros(0, dtype=np.int64)
+            self.edge_length = np.zeros(0, dtype=np.float64)
+        has_parent = self.parent >= 0
+        children = np.arange(n_nodes)[has_parent]
+        self.internal = np.zeros(n_nodes, dtype=bool)
+        self.internal[self.parent[has_parent]] = True
+        # Children follow their parent in preorder, so the first child has the lowest index
+        first_child = np.full(n_nodes, n_nodes, dtype=np.int64)
+        np.minimum.at(first_child, self.parent[has_parent], children)
+        self.first_child = np.where(self.internal, first_child, -1)
+
+    def __len__(self):
+        return len(self.parent)
+
+
+def _chain_rank(pointer):
+    """
+    Number of steps from each node to the end of its pointer chain (where pointer is -1),
+    by pointer jumping: log2(longest chain) vectorized passes.
+    """
+    rank = (pointer >= 0).astype(np.int64)
+    pointer = pointer.copy()
+    while True:
+        active = pointer >= 0
+        if not active.any():
+            return rank
+        targets = pointer[active]
+        new_rank = rank.copy()
+        new_rank[active] += rank[targets]
+        new_pointer = pointer.copy()
+        new_pointer[active] = pointer[targets]
+        rank, pointer = new_rank, new_pointer
+
+
+def _level_groups(rank):
+    """Node indices grouped by rank, lowest rank first"""
+    order = np.argsort(rank, kind='stable')
+    bounds = np.searchsorted(rank[order], np.arange(rank.max() + 2 if len(rank) else 1))
+    return [order[bounds[level]:bounds[level + 1]] for level in range(len(bounds) - 1)]
+
+
+def root_depths(batch):
+    """Sum of edge lengths from the root of its tree to each node of a TreeBatch"""
+    depth = np.zeros(len(batch), dtype=np.float64)
+    for level in _level_groups(_chain_rank(batch.parent))[1:]:
+        depth[level] = depth[batch.parent[level]] + batch.edge_length[level]
+    return depth
+
+
+def batch_ages(batch):
+    """
+    Node ages for all nodes of a TreeBatch.
+    As in dendropy's calc_node_ages, tips have age 0 and each internal node
+    takes its age from its first child: age(child) + length(child).
+    Ages are accumulated one level of first children at a time, so the
+    additions happen in the same order as in dendropy and give identical floats.
+    """
+    age = np.zeros(len(batch), dtype=np.float64)
+    for level in _level_groups(_chain_rank(batch.first_child))[1:]:
+        child = batch.first_child[level]
+        age[level] = age[child] + batch.edge_length[child]
+    return age
+
+
+def ultrametricity_deviation(batch, age=None):
+    """
+    Largest difference, per tree, between a node's age and age(child) + length(child)
+    over all of its children. 0 for a perfectly ultrametric tree.
+    """
+    if age is None:
+        age = batch_ages(batch)
+    deviation = np.zeros(len(batch.trees), dtype=np.float64)
+    has_parent = batch.parent >= 0
+    parent = batch.parent[has_parent]
+    diff = np.abs(age[parent] - (age[has_parent] + batch.edge_length[has_parent]))
+    np.maximum.at(deviation, batch.tree_index[has_parent], diff)
+    return deviation
+
+
+def batch_node_ages(trees, ultrametricity_precision=0.01):
+    """
+    Ages of the internal nodes of many ArrayTrees at once.
+
+    Inputs
+    ------
+    trees: list of ArrayTree
+    ultrametricity_precision: trees whose ultrametricity deviation is above it get None.
+                              None, False or a negative value skips the check.
+
+    Returns
+    -------
+    A list, with for each tree either None or {node_label: node_age} over internal nodes in preorder,
+    matching the 'ages' of chronogram.node_ages
+    """
+    batch = TreeBatch(trees)
+    age = batch_ages(batch)
+    check = not (ultrametricity_precision is None
+                 or ultrametricity_precision is False
+                 or ultrametricity_precision < 0)
+    if check:
+        deviation = ultrametricity_deviation(batch, age)
+    ret = []
+    for i, tree in enumerate(batch.trees):
+        if check and deviation[i] > ultrametricity_precision:
+            ret.append(None)
+            continue
+        start = batch.offsets[i]
+        tree_age = age[start:batch.offsets[i + 1]]
+        ages = {}
+        for j in np.flatnonzero(batch.internal[start:batch.offsets[i + 1]]):
+            label = tree.labels[j]
+            assert label not in ages
+            ages[label] = float(tree_age[j])
+        ret.append(ages)
+    return ret
+
+
+def bladj_ages(parent, calibration, root_age=None):
+    """
+    BLADJ-style node ages for a whole tree, from ages fixed at some nodes.
+
+    Tips have age 0. A calibration is kept if it is older than every kept age below it,
+    otherwise it is dropped, as BLADJ does. Each undated node then takes its age
+    by splitting the gap between its parent's age and the oldest fixed age below it
+    evenly over the longest chain of undated nodes down to a fixed node.
+    Runs one vectorized pass per tree level, upwards then downwards.
+
+    Inputs
+    ------
+    parent: int array of parent indices in preorder, -1 for the root
+    calibration: float array of calibrated ages, nan for undated nodes
+    root_age: age of the root. Defaults to its calibration if it has one,
+              otherwise 1.25 times the oldest fixed age below it.
+
+    Returns
+    -------
+    (age, fixed): float array of node ages, and boolean array of the nodes with a fixed age:
+                  tips, kept calibrations and a given root_age
+    """
+    parent = np.asarray(parent, dtype=np.int64)
+    calibration = np.asarray(calibration, dtype=np.float64)
+    n_nodes = len(parent)
+    has_parent = parent >= 0
+    internal = np.zeros(n_nodes, dtype=bool)
+    internal[parent[has_parent]] = True
+    # Oldest fixed age below each node, and the longest chain of edges down to a fixed node
+    below = np.zeros(n_nodes, dtype=np.float64)
+    steps = np.zeros(n_nodes, dtype=np.int64)
+    fixed = ~internal
+    age = np.where(fixed, 0.0, np.nan)
+    levels = _level_groups(_chain_rank(parent))
+    for level in reversed(levels):
+        level_internal = level[internal[level]]
+        keep = calibration[level_internal] > below[level_internal]
+        fixed[level_internal[keep]] = True
+        age[level_internal[keep]] = calibration[level_internal[keep]]
+        level = level[has_parent[level]]
+        np.maximum.at(below, parent[level], np.where(fixed[level], age[level], below[level]))
+        np.maximum.at(steps, parent[level], np.where(fixed[level], 1, steps[level] + 1))
+    if n_nodes == 0:
+        return age, fixed
+    if root_age is not None:
+        if root_age <= below[0]:
+            raise ValueError("Root age {} is not older than the ages below it ({})".format(root_age, below[0]))
+        age[0] = root_age
+        fixed[0] = True
+    elif not fixed[0]:
+        if below[0] <= 0:
+            raise ValueError("No calibrations to date the tree from")
+        age[0] = below[0] * 1.25
+    for level in levels[1:]:
+        undated = level[~fixed[level]]
+        parent_age = age[parent[undated]]
+        age[undated] = parent_age - (parent_age - below[undated]) / (steps[undated] + 1)
+    return age, fixed
@@ -8,19 +8,37 @@ import subprocess
 import re
 import random
 import configparser
-import statistics
+import tempfile
+import collections
 import logging
+import concurrent.futures
+import mmap
+import hashlib
+import urllib.request
+import glob
+import time
+import threading
 
 from sh import git
 import dendropy
+import numpy as np
 
 import opentree
 from opentree import OT
 
-import peyotl
 from peyotl.phylesystem.git_actions import PhylesystemGitAction
 
 import chronosynth
+from chronosynth.node_store import NodeAgeStore, SourceMapCache, write_node_age_store, summarize_node_ages
+from chronosynth.node_store import NodeAgeTable, NodeAgeTableBuilder, write_node_age_table, ChronogramCatalog
+from chronosynth.arraytree import ArrayTree, batch_node_ages, resolve_polytomies, bladj_ages
+from chronosynth import instrument
+from chronosynth import transport
+from chronosynth.age_summary import summarize_replicates
+from chronosynth import synth_index
+from chronosynth.synth_index import SynthTreeIndex
+from chronosynth.conflict import SynthConflict
+from chronosynth.source_cache import SourceCache
 
 config = configparser.ConfigParser()
 config.read(chronosynth.configfile)
@@ -32,32 +50,58 @@ log.debug("logging set to debug")
 
 DC = opentree.object_conversion.DendropyConvert()
 
+# Pooled, gzip compressed HTTP with retries, and if http_cache is set, a size bounded on-disk cache
+# of responses revalidated with ETag / If-Modified-Since, see transport.Transport
+HTTP = transport.Transport(cache_path=config.get('paths', 'http_cache', fallback=None) or None,
+                           pool_size=int(config.get('params', 'http_pool_size', fallback='10')),
+                           retries=int(config.get('params', 'http_retries', fallback='3')),
+                           backoff=float(config.get('params', 'http_backoff', fallback='0.5')),
+                           cache_max_bytes=int(float(config.get('params', 'http_cache_max_mb', fallback='512')) * 1e6))
+
+# Trees, ages and conflict maps of recently used sources, shared by as_dendropy, node_ages,
+# conflict_info and so map_conflict_ages and map_conflict_nodes, see source_cache.SourceCache
+SOURCE_CACHE = SourceCache(max_sources=int(config.get('params', 'source_cache_size', fallback='256')))
+
+
+def _open_tree(ot):
+    """Sends ot's API calls through HTTP, and times and counts them, see instrument.InstrumentedOT"""
+    transport.install(ot.ws, HTTP)
+    return instrument.InstrumentedOT(ot)
+
+
+OT = _open_tree(OT)
+
 
 def set_dev():
     """Set endpoint to dev"""
     global OT
-    OT = opentree.ot_object.OpenTree(api_endpoint='dev')
+    OT = _open_tree(opentree.ot_object.OpenTree(api_endpoint='dev'))
 
 
 def set_prod():
     """Set endpoint to production"""
     global OT
-    OT = opentree.ot_object.OpenTree()
+    OT = _open_tree(opentree.ot_object.OpenTree())
 
 def print_endpoint():
     """Print endpoint"""
     print(OT._api_endpoint)
     log.debug("api_endpoint is %s", format(OT._api_endpoint))
 
-def find_trees(search_property="ot:branchLengthMode", value="ot:time"):
+def find_trees(search_property="ot:branchLengthMode", value="ot:time", repo_dir=None):
     """
     Get study and tree ids for all chronograms (trees with branch lengths proportional
     to time) in Phylesystem, i.e., where 'ot:branchLengthMode' == 'ot:time'
+    repo_dir: a local clone of phylesystem. If given, trees are looked up in the local catalog
+              (see chronogram_catalog) rather than with the search API.
 
     Returns
     -------
     A list of Phylesystem chronogram's source ids: study_id@treeid.
     """
+    if repo_dir:
+        with chronogram_catalog(repo_dir) as catalog:
+            return catalog.find(search_property, value)
     output = OT.find_trees(search_property=search_property, value=value)
     chronograms = set()
     for study in output.response_dict["matched_studies"]:
@@ -67,29 +111,272 @@ def find_trees(search_property="ot:branchLengthMode", value="ot:time"):
             chronograms.add('{}@{}'.format(study_id, tree_id))
     return list(chronograms)
 
-def as_dendropy(source_id):
+def study_filepath(repo_dir, study_id):
+    """
+    Path to a study's NexSON file in a local clone of phylesystem,
+    following the phylesystem layout, e.g. study/ot_00/ot_1000/ot_1000.json
+    """
+    prefix, num = study_id.split('_', 1)
+    frag = num[-2:].zfill(2)
+    return os.path.join(repo_dir, 'study', '{}_{}'.format(prefix, frag), study_id, study_id + '.json')
+
+
+def study_commit_shas(repo_dir, study_ids):
+    """
+    Last commit that touched each study in a local clone of phylesystem,
+    found with a single walk of the git log.
+    Returns {study_id: sha}, leaving out studies not in the repo.
+    """
+    paths = {os.path.relpath(study_filepath(repo_dir, study_id), repo_dir): study_id for study_id in study_ids}
+    if not paths:
+        return {}
+    pathspec = list(paths) if len(paths) <= 100 else ['study']
+    process = subprocess.Popen(["git", "-C", repo_dir, "log", "--format=commit %H", "--name-only", "--"] + pathspec,
+                               stdout=subprocess.PIPE)
+    shas = {}
+    sha = None
+    for line in process.stdout:
+        line = line.decode('utf-8').strip()
+        if line.startswith('commit '):
+            sha = line[7:]
+        elif line in paths and paths[line] not in shas:
+            shas[paths[line]] = sha
+            if len(shas) == len(paths):
+                break
+    process.kill()
+    process.wait()
+    return shas
+
+
+_local_study_shas = {}
+
+def local_study_shas(repo_dir, study_ids):
+    """
+    study_commit_shas, remembered for each HEAD commit of the clone, so the history of a study
+    is only walked again once the clone has moved on. Studies are looked up in one batch.
+    Returns {study_id: sha}, leaving out studies not in the repo.
+    """
+    head = read_head_sha(repo_dir)
+    cached_head, shas = _local_study_shas.get(os.path.abspath(repo_dir), (None, {}))
+    if cached_head != head:
+        shas = {}
+    missing = set(study_ids) - set(shas)
+    if missing:
+        found = study_commit_shas(repo_dir, missing)
+        shas.update({study_id: found.get(study_id) for study_id in missing})
+        _local_study_shas[os.path.abspath(repo_dir)] = (head, shas)
+    return {study_id: shas[study_id] for study_id in study_ids if shas[study_id] is not None}
+
+
+def study_version(study_id, repo_dir=None):
+    """
+    Phylesystem commit of a study, used to tell whether cached results for it are current.
+    Returns (study_sha, study_nexson). With repo_dir the sha is read from the local git log
+    (see local_study_shas) and study_nexson is None. Otherwise the study is downloaded, and both are returned.
+    """
+    if repo_dir:
+        return local_study_shas(repo_dir, [study_id]).get(study_id), None
+    study = OT.get_study(study_id)
+    _remember_study_sha(study_id, study.response_dict.get('sha'))
+    return study.response_dict.get('sha'), study.response_dict['data']
+
+
+_api_study_shas = {}
+
+def _remember_study_sha(study_id, study_sha):
+    if study_sha:
+        _api_study_shas[(OT._api_endpoint, study_id)] = (time.monotonic(), study_sha)
+
+
+def known_study_sha(study_id, repo_dir=None, ttl=None):
+    """
+    Commit of a study, found without downloading it. With repo_dir it is read from the local git log
+    (see local_study_shas). Otherwise it is the commit the study was last downloaded at from the API,
+    reused for ttl seconds, or None.
+    ttl: defaults to study_sha_ttl in config params, or 300. 0 never reuses one.
+    """
+    if repo_dir:
+        return local_study_shas(repo_dir, [study_id]).get(study_id)
+    if ttl is None:
+        ttl = float(config.get('params', 'study_sha_ttl', fallback='300'))
+    cached = _api_study_shas.get((OT._api_endpoint, study_id))
+    if cached and time.monotonic() - cached[0] < ttl:
+        return cached[1]
+    return None
+
+
+def get_study_nexson(study_id, repo_dir=None):
+    """
+    Get the NexSON of a study.
+    repo_dir: a local clone of phylesystem. Defaults to None, and uses the API.
+    """
+    if repo_dir:
+        study_path = study_filepath(repo_dir, study_id)
+        if not os.path.exists(study_path):
+            raise ValueError("Study {} not found in local phylesystem at {}".format(study_id, repo_dir))
+        with open(study_path) as study_file:
+            return json.load(study_file)
+    study = OT.get_study(study_id)## Todo: catch failure of study GET
+    _remember_study_sha(study_id, study.response_dict.get('sha'))
+    return study.response_dict['data']
+
+
+def _catalog_study(study_path):
+    """
+    Catalog entries for the trees of one study file, see node_store.ChronogramCatalog.
+    Returns (study_id, [tree entries without study_sha])
+    """
+    with open(study_path) as study_file:
+        nexml = json.load(study_file)['nexml']
+    study_id = os.path.splitext(os.path.basename(study_path))[0]
+    # Search properties are the '^ot:' annotations, less the nested annotation records
+    study_properties = {key[1:]: value for key, value in nexml.items()
+                        if key.startswith('^ot:') and not isinstance(value, dict)}
+    trees = []
+    for tree_set in nexml.get('treesById', {}).values():
+        for tree_id, tree_obj in tree_set.get('treeById', {}).items():
+            properties = dict(study_properties)
+            properties.update({key[1:]: value for key, value in tree_obj.items()
+                               if key.startswith('^ot:') and not isinstance(value, dict)})
+            properties['ot:studyId'] = study_id
+            properties['ot:treeId'] = tree_id
+            edges_by_src = tree_obj.get('edgeBySourceId', {})
+            trees.append({'source_id': '{}@{}'.format(study_id, tree_id),
+                          'study_id': study_id,
+                          'tree_id': tree_id,
+                          'branch_length_mode': tree_obj.get('^ot:branchLengthMode'),
+                          'time_unit': tree_obj.get('^ot:branchLengthTimeUnit'),
+                          'tip_count': sum(1 for node_id in tree_obj.get('nodeById', {}) if node_id not in edges_by_src),
+                          'properties': properties})
+    return study_id, trees
+
+
+def chronogram_catalog(repo_dir, cache_file_path=None, workers=None, fresh=False):
+    """
+    Catalog of every tree in a local clone of phylesystem, to find trees by any search property
+    without the network (see node_store.ChronogramCatalog).
+    The first call scans all study files with a pool of worker processes. Later calls
+    only rescan the studies changed in git since the commit the catalog was built from.
+
+    Inputs
+    ------
+    repo_dir: local clone of phylesystem
+    cache_file_path: defaults to chronogram_catalog.db in the cache_file_dir set in config
+    workers: number of processes reading study files, defaults to the number of cpus
+    fresh: if True, rescans every study
+
+    Returns
+    -------
+    the open ChronogramCatalog
+    """
+    if cache_file_path is None:
+        cache_file_dir = config.get('paths', 'cache_file_dir', fallback='/tmp/')
+        cache_file_path = os.path.join(cache_file_dir, 'chronogram_catalog.db')
+    catalog = ChronogramCatalog(cache_file_path)
+    current_sha = get_phylesystem_sha(repo_dir=repo_dir)
+    cached_sha = None if fresh else catalog.metadata.get('phylesystem_sha')
+    if cached_sha == current_sha:
+        return catalog
+    # Without a usable cached commit, e.g. one git no longer has, every study is rescanned
+    study_ids = changed_study_ids(repo_dir, cached_sha) if cached_sha else None
+    if study_ids is not None:
+        study_paths = [study_filepath(repo_dir, study_id) for study_id in study_ids]
+        study_paths = [path for path in study_paths if os.path.exists(path)]
+    else:
+        study_paths = sorted(glob.glob(os.path.join(repo_dir, 'study', '*', '*', '*.json')))
+        study_ids = set(catalog.study_ids())
+        study_ids.update(os.path.splitext(os.path.basename(path))[0] for path in study_paths)
+    sys.stdout.write("Cataloguing trees in {} studies in {}\n".format(len(study_paths), repo_dir))
+    with instrument.stage('catalog'):
+        trees = []
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+            for study_id, study_trees in pool.map(_catalog_study, study_paths, chunksize=16):
+                trees.extend(study_trees)
+        shas = study_commit_shas(repo_dir, set(tree['study_id'] for tree in trees))
+        for tree in trees:
+            tree['study_sha'] = shas.get(tree['study_id'])
+        catalog.replace_studies(study_ids, trees)
+        catalog.set_metadata({'phylesystem_sha': current_sha})
+    return catalog
+
+
+_synth_abouts = {}
+
+def get_synth_tree_about(ttl=None):
+    """
+    synth_tree_about of OT.about() for the current endpoint, reused for ttl seconds.
+    ttl: defaults to synth_about_ttl in config params, or 300. 0 always asks the API.
+    """
+    if ttl is None:
+        ttl = float(config.get('params', 'synth_about_ttl', fallback='300'))
+    now = time.monotonic()
+    cached = _synth_abouts.get(OT._api_endpoint)
+    if cached and now - cached[0] < ttl:
+        return cached[1]
+    about = OT.about()['synth_tree_about']
+    _synth_abouts[OT._api_endpoint] = (now, about)
+    return about
+
+
+def synth_version():
+    """synth_id of the current synth tree"""
+    return get_synth_tree_about().get('synth_id')
+
+
+def _cached_source(source_id, study_sha, slot, compute):
+    """
+    Value of slot in the SOURCE_CACHE entry of source_id at study commit study_sha,
+    from compute() if it isn't cached yet. Nothing is cached when the commit isn't known.
+    """
+    if study_sha is None:
+        return compute()
+    value = SOURCE_CACHE.get(source_id, study_sha, slot, default=False)
+    if value is False:
+        value = SOURCE_CACHE.put(source_id, study_sha, slot, compute())
+    return value
+
+
+def as_dendropy(source_id, repo_dir=None, study_nexson=None, study_sha=None):
     """
     Get a dendropy object of a chronogram in Phylesystem.
 
     Example
     -------
     source_id = 'ot_1000@tree1'
+    repo_dir: a local clone of phylesystem. Defaults to None, and uses the API.
+    study_nexson: an already fetched study NexSON dict. Default None, fetches it.
+    study_sha: the commit of study_nexson. If neither is given, the commit is known_study_sha,
+               and the study is only fetched if it isn't cached at that commit.
+
+    The parsed tree is kept in SOURCE_CACHE under the study commit, and each call returns
+    a copy of it sharing its taxon namespace, so callers can modify it.
     """
     assert '@' in source_id
     study_id = source_id.split('@')[0]
     tree_id = source_id.split('@')[1]
-    study = OT.get_study(study_id)## Todo: catch failure of study GET
-    study_nexson = study.response_dict['data']
-    tree_obj = DC.tree_from_nexson(study_nexson, tree_id)
-    return tree_obj
+    if study_sha is None and study_nexson is None:
+        study_sha = known_study_sha(study_id, repo_dir=repo_dir)
+        if study_sha is None:
+            study_sha, study_nexson = study_version(study_id, repo_dir=repo_dir)
+
+    def parse():
+        nexson = study_nexson if study_nexson is not None else get_study_nexson(study_id, repo_dir=repo_dir)
+        return DC.tree_from_nexson(nexson, tree_id)
+    return _cached_source(source_id, study_sha, 'tree', parse).clone(depth=1)
 
-def node_ages(source_id, ultrametricity_precision=None):
+def node_ages(source_id, ultrametricity_precision=None, repo_dir=None, study_nexson=None, study_sha=None):
     """
-    Get node ages for a DendroPy tree object.
+    Get node ages for a chronogram.
+    Reads the tree straight from NexSON into arrays (see arraytree.ArrayTree),
+    without building a DendroPy tree, and gives the same ages as dendropy's internal_node_ages.
     Inputs
     ------
     source_id: in format study_id@tree_id
-    ultrametricity_precision: passed to dendropy
+    ultrametricity_precision: maximum deviation from ultrametricity, as in dendropy
+    repo_dir: a local clone of phylesystem. Defaults to None, and uses the API.
+    study_nexson: an already fetched study NexSON dict. Default None, fetches it.
+    study_sha: the commit of study_nexson. If neither is given, the commit is known_study_sha,
+               and the study is only fetched if its ages aren't cached at that commit.
 
     Returns
     -------
@@ -97,61 +384,68 @@ def node_ages(source_id, ultrametricity_precision=None):
     {'metadata': {'study_id': study_id, 'tree_id': tree_id, 'time_unit': time_unit},
     'ages': {node_label:node_age}
     }
-
+    Results are kept in SOURCE_CACHE under the study commit, per ultrametricity_precision.
     """
     if ultrametricity_precision is None:
         ultrametricity_precision = float(config.get('params', 'ultrametricity_precision',
                                                     fallback='0.01'))
+    if study_sha is None and study_nexson is None:
+        study_sha = known_study_sha(source_id.split('@')[0], repo_dir=repo_dir)
+        if study_sha is None:
+            with instrument.stage('fetch', source_id):
+                study_sha, study_nexson = study_version(source_id.split('@')[0], repo_dir=repo_dir)
+    return _cached_source(source_id, study_sha, ('ages', ultrametricity_precision),
+                          lambda: _node_ages(source_id, ultrametricity_precision, repo_dir, study_nexson))
+
 
+def _node_ages(source_id, ultrametricity_precision, repo_dir, study_nexson):
     study_id = source_id.split('@')[0]
     tree_id = source_id.split('@')[1]
-    dp_tree = as_dendropy(source_id)
-    assert dp_tree.annotations.get_value("branchLengthMode") == 'ot:time'
-    time_unit = dp_tree.annotations.get_value("branchLengthTimeUnit")
+    if study_nexson is None:
+        with instrument.stage('fetch', source_id):
+            study_nexson = get_study_nexson(study_id, repo_dir=repo_dir)
+    with instrument.stage('convert', source_id):
+        tree = ArrayTree.from_nexson(study_nexson, tree_id)
+    assert tree.annotations.get("branchLengthMode") == 'ot:time'
+    time_unit = tree.annotations.get("branchLengthTimeUnit")
     metadata = {'study_id': study_id, 'tree_id': tree_id, 'time_unit' :time_unit}
-    ages = {}
-    try:
-        dp_tree.internal_node_ages(ultrametricity_precision=ultrametricity_precision)
-        for node in dp_tree.internal_nodes():
-            assert node.label not in ages.keys()
-            ages[node.label] = node.age
-    except dendropy.utility.error.UltrametricityError as err:
+    with instrument.stage('ages', source_id):
+        ages = batch_node_ages([tree], ultrametricity_precision=ultrametricity_precision)[0]
+    if ages is None:
         sys.stderr.write("source {} does not meet ultrametricity_precision threshold of {}".format(source_id, ultrametricity_precision))
         return None
     ret = {'metadata':metadata, 'ages':ages}
     return ret
 
 
-def map_conflict_ages(source_id,
-                      ultrametricity_precision=None,
-#                      repo_dir=None, ##ToDo run locally....
-                      cache_file_path=None,
-                      fresh=False):
-    """
-    Takes a source id in format study_id@tree_id
+_source_map_caches = {}
 
-    returns a dictionary of:
-    {'metadata':{'study_id': study_id, 'tree_id': tree_id,
-                 'time_unit': time_unit, 'synth_version':version, sha},
-    'supported_nodes':{synth_node_id : {'age':age, 'node_label':node_label}}
+def source_map_cache(cache_file_path=None, table='source_maps'):
+    """
+    The consolidated cache of map_conflict_ages results (see node_store.SourceMapCache).
+    Entries are stored with the synth_id and study commit they were made from.
+    cache_file_path: Defaults to source_maps.db in the cache_file_dir set in config
+    table: 'source_maps' for conflict mapped ages, or 'source_ages' for node_ages output,
+           which only depends on the study commit and so survives synth releases.
+    Connections are opened once per process and path.
     """
     if cache_file_path is None:
         cache_file_dir = config.get('paths', 'cache_file_dir',
                                     fallback='/tmp/')
-        cache_file_path = cache_file_dir + '/{}.json'.format(source_id)
-    if os.path.exists(cache_file_path) and fresh == False:
-        sys.stdout.write("Loading" + cache_file_path + "\n")
-        ret = json.load(open(cache_file_path))
-        return ret
-    ages_data = node_ages(source_id, ultrametricity_precision=ultrametricity_precision)
-    if ages_data is None:
-        return None
+        cache_file_path = cache_file_dir + '/source_maps.db'
+    key = (os.path.abspath(cache_file_path), table, os.getpid())
+    if key not in _source_map_caches:
+        _source_map_caches[key] = SourceMapCache(cache_file_path, table=table)
+    return _source_map_caches[key]
+
+
+def _supported_nodes(source_id, ages_data, conf):
+    """
+    Pairs node ages with conflict statuses.
+    Returns {synth_node_id : {'age':age, 'node_label':node_label}},
+    or None if there is no conflict data for the tree.
+    """
     metadata = ages_data['metadata']
-    version = OT.about()
-    metadata['synth_tree_about'] = version['synth_tree_about']
-    output_conflict = OT.conflict_info(study_id=metadata['study_id'],
-                                       tree_id=metadata['tree_id'])
-    conf = output_conflict.response_dict
     if conf is None:
         url = "https://tree.opentreeoflife.org/curator/study/view/{}/?tab=home&tree={}".format(metadata['study_id'],
                                                                                                metadata['tree_id'])
@@ -172,17 +466,283 @@ def map_conflict_ages(source_id,
         witness = node_conf['witness']
         if status == 'supported_by':
             supported_nodes[witness] = {'age':age, 'node_label':node_label}
+    return supported_nodes
+
+
+def map_conflict_ages(source_id,
+                      ultrametricity_precision=None,
+                      repo_dir=None,
+                      cache_file_path=None,
+                      fresh=False):
+    """
+    Takes a source id in format study_id@tree_id
+    repo_dir: a local clone of phylesystem to read the study from. Defaults to None, and uses the API.
+    cache_file_path: the source map cache, defaults to source_maps.db in the cache_file_dir set in config
+    fresh: if False re-uses a cached result, as long as it was made from the current synth_id,
+           the same ultrametricity_precision and the current commit of the study. With a repo_dir the
+           study commit is read from the local git log. Without one, a result is current while phylesystem
+           (see get_phylesystem_sha) is at the commit the result was last checked at; once phylesystem has
+           moved on, the study is downloaded and its commit compared. Cached node ages are kept across
+           synth releases, and only the conflict mapping is redone. If True, the source is also dropped
+           from SOURCE_CACHE.
+
+    returns a dictionary of:
+    {'metadata':{'study_id': study_id, 'tree_id': tree_id,
+                 'time_unit': time_unit, 'synth_tree_about':version, 'study_sha': sha},
+    'supported_nodes':{synth_node_id : {'age':age, 'node_label':node_label}}
+    """
+    if ultrametricity_precision is None:
+        ultrametricity_precision = float(config.get('params', 'ultrametricity_precision',
+                                                    fallback='0.01'))
+    maps_cache = source_map_cache(cache_file_path)
+    ages_cache = source_map_cache(cache_file_path, table='source_ages')
+    synth_tree_about = get_synth_tree_about()
+    synth_id = synth_tree_about.get('synth_id')
+    study_id = source_id.split('@')[0]
+    study_sha = study_nexson = phylesystem_sha = None
+    if repo_dir:
+        study_sha, study_nexson = study_version(study_id, repo_dir=repo_dir)
+    else:
+        phylesystem_sha = get_phylesystem_sha() or None
+    ages_data = None
+    version = None
+    if fresh:
+        SOURCE_CACHE.evict(source_id)
+    else:
+        version = maps_cache.versions([source_id]).get(source_id)
+        if _cached_is_current(version, synth_id, ultrametricity_precision, study_sha, phylesystem_sha):
+            sys.stdout.write("Loading {} from {}\n".format(source_id, maps_cache.path))
+            return maps_cache.get(source_id)
+    if not repo_dir:
+        with instrument.stage('fetch', source_id):
+            study_sha, study_nexson = study_version(study_id)
+        if _cached_is_current(version, synth_id, ultrametricity_precision, study_sha):
+            maps_cache.confirm([source_id], phylesystem_sha)
+            sys.stdout.write("Loading {} from {}\n".format(source_id, maps_cache.path))
+            return maps_cache.get(source_id)
+    if fresh == False:
+        ages_data = ages_cache.get(source_id, study_sha=study_sha, precision=ultrametricity_precision)
+    if ages_data is None:
+        ages_data = node_ages(source_id,
+                              ultrametricity_precision=ultrametricity_precision,
+                              repo_dir=repo_dir,
+                              study_nexson=study_nexson,
+                              study_sha=study_sha)
+        if ages_data is None:
+            return None
+        ages_cache.put(source_id, ages_data, study_sha=study_sha, precision=ultrametricity_precision)
+    metadata = dict(ages_data['metadata'])
+    metadata['synth_tree_about'] = synth_tree_about
+    metadata['study_sha'] = study_sha
+    with instrument.stage('conflict', source_id):
+        conf = conflict_info(source_id, study_nexson=study_nexson, repo_dir=repo_dir, study_sha=study_sha)
+        supported_nodes = _supported_nodes(source_id, ages_data, conf)
+    if supported_nodes is None:
+        return None
     ret = {'metadata':metadata, 'supported_nodes':supported_nodes}
-    sf = json.dumps(ret, sort_keys=True, indent=2, separators=(',', ': '), ensure_ascii=True)
-    ofi = open(cache_file_path, 'w')
-    ofi.write(sf)
-    ofi.close()
+    maps_cache.put(source_id, ret, synth_id=synth_id, study_sha=study_sha, precision=ultrametricity_precision,
+                   phylesystem_sha=phylesystem_sha)
     return ret
 
 
-def map_conflict_nodes(source_id):
+def _cached_is_current(version, synth_id, precision, study_sha=None, phylesystem_sha=None):
+    """
+    Whether a cached mapping made from version, a SourceMapCache.versions tuple, is current:
+    made from synth_id and precision, and either from the study commit study_sha, or last checked
+    at the phylesystem commit phylesystem_sha. Versions that are None are unknown, and never match.
+    """
+    if version is None:
+        return False
+    cached_synth_id, cached_sha, cached_precision, cached_phylesystem_sha = version
+    if cached_synth_id is None or cached_synth_id != synth_id or cached_precision != precision:
+        return False
+    return ((study_sha is not None and cached_sha == study_sha) or
+            (phylesystem_sha is not None and cached_phylesystem_sha == phylesystem_sha))
+
+
+def _fetch_source(source_id, synth_id, repo_dir=None, study_sha=None, cached_version=None, precision=None,
+                  phylesystem_sha=None):
+    """
+    Network stage of the parallel pipeline.
+    Returns a dict with the study_sha, the study NexSON and the conflict statuses for a source,
+    and 'cached' True if the cached mapping, made from cached_version (see SourceMapCache.versions),
+    is current (see _cached_is_current), in which case no conflict is fetched.
+    With a local phylesystem the study_sha is passed in, and the study is left for the worker to read from disk.
+    Otherwise, unless the mapping was last checked at phylesystem_sha, the study is downloaded to compare
+    its commit, and 'confirmed' is True if the mapping is still current.
+    Conflict is computed here, in the main process, when a local synth tree is configured (see conflict_info),
+    so the tree is loaded once rather than in every worker.
+    """
+    if _cached_is_current(cached_version, synth_id, precision, study_sha, phylesystem_sha):
+        return {'study_sha': cached_version[1], 'study_nexson': None, 'conf': None, 'cached': True,
+                'confirmed': False}
+    study_id = source_id.split('@')[0]
+    study_nexson = None
+    if not repo_dir:
+        with instrument.stage('fetch', source_id):
+            study_sha, study_nexson = study_version(study_id)
+        if _cached_is_current(cached_version, synth_id, precision, study_sha):
+            return {'study_sha': study_sha, 'study_nexson': None, 'conf': None, 'cached': True, 'confirmed': True}
+    fetched = {'study_sha': study_sha, 'study_nexson': study_nexson, 'conf': None, 'cached': False,
+               'confirmed': False}
+    with instrument.stage('conflict', source_id):
+        fetched['conf'] = conflict_info(source_id, study_nexson=study_nexson, repo_dir=repo_dir, study_sha=study_sha)
+    return fetched
+
+
+def _map_fetched_source(source_id, study_nexson, conf, synth_tree_about, ultrametricity_precision,
+                        repo_dir=None, study_sha=None, ages_data=None):
+    """
+    CPU stage of the parallel pipeline, run in a worker process.
+    Node ages are only estimated if ages_data is not given.
+    Returns (ages_data, map_conflict_ages output)
+    """
+    if ages_data is None:
+        ages_data = node_ages(source_id,
+                              ultrametricity_precision=ultrametricity_precision,
+                              repo_dir=repo_dir,
+                              study_nexson=study_nexson,
+                              study_sha=study_sha)
+    if ages_data is None:
+        return None, None
+    metadata = dict(ages_data['metadata'])
+    metadata['synth_tree_about'] = synth_tree_about
+    metadata['study_sha'] = study_sha
+    supported_nodes = _supported_nodes(source_id, ages_data, conf)
+    if supported_nodes is None:
+        return ages_data, None
+    return ages_data, {'metadata':metadata, 'supported_nodes':supported_nodes}
+
+
+def _started_process_pool(workers):
+    """
+    A ProcessPoolExecutor with its workers already running. Forked workers copy the locks of the
+    forking process as they are, so they are started before any thread that takes them, e.g. in
+    SOURCE_CACHE or the HTTP cache, is running.
+    """
+    pool = concurrent.futures.ProcessPoolExecutor(max_workers=workers)
+    concurrent.futures.wait([pool.submit(os.getpid) for _ in range(workers)])
+    return pool
+
+
+def map_conflict_ages_parallel(source_ids,
+                               workers=None,
+                               ultrametricity_precision=None,
+                               repo_dir=None,
+                               fresh=False):
+    """
+    Runs map_conflict_ages over many sources at once.
+    Study and conflict downloads overlap in a thread pool, and the
+    tree conversion and age estimation run in a pool of worker processes.
+    As in map_conflict_ages, cached results are reused while the synth_id, the ultrametricity_precision
+    and the study commit they were made from are current.
+
+    Inputs
+    ------
+    source_ids: a list of source ids in format study_id@tree_id
+    workers: number of download threads and worker processes.
+             Defaults to 'workers' in config params.
+    ultrametricity_precision: a float passed to dendropy
+    repo_dir: a local clone of phylesystem to read studies from. Defaults to None, and uses the API.
+    fresh: if False will re-use cached estimates. If True will re-map all studies.
+
+    Returns
+    -------
+    A dictionary {source_id: map_conflict_ages output}, in the order of source_ids.
+    Sources that failed with a ValueError are left out.
+    """
+    if workers is None:
+        workers = int(config.get('params', 'workers', fallback='1'))
+    if ultrametricity_precision is None:
+        ultrametricity_precision = float(config.get('params', 'ultrametricity_precision',
+                                                    fallback='0.01'))
+    maps_cache = source_map_cache()
+    ages_cache = source_map_cache(table='source_ages')
+    synth_tree_about = get_synth_tree_about()
+    synth_id = synth_tree_about.get('synth_id')
+    map_versions = {}
+    age_versions = {}
+    if fresh == False:
+        map_versions = maps_cache.versions(source_ids)
+        age_versions = ages_cache.versions(source_ids)
+    else:
+        for source_id in source_ids:
+            SOURCE_CACHE.evict(source_id)
+    study_shas = {}
+    phylesystem_sha = None
+    if repo_dir:
+        study_shas = local_study_shas(repo_dir, set(source_id.split('@')[0] for source_id in source_ids))
+    else:
+        phylesystem_sha = get_phylesystem_sha() or None
+    results = {}
+    confirmed = []
+    n_cached = 0
+    with _started_process_pool(workers) as map_pool, \
+         concurrent.futures.ThreadPoolExecutor(max_workers=workers) as fetch_pool:
+        fetches = {fetch_pool.submit(_fetch_source,
+                                     source_id,
+                                     synth_id,
+                                     repo_dir,
+                                     study_shas.get(source_id.split('@')[0]),
+                                     map_versions.get(source_id),
+                                     ultrametricity_precision,
+                                     phylesystem_sha): source_id for source_id in source_ids}
+        mappings = {}
+        fetched_shas = {}
+        for fut in concurrent.futures.as_completed(fetches):
+            source_id = fetches[fut]
+            try:
+                fetched = fut.result()
+            except ValueError:
+                log.info('{}, fetch error\n'.format(source_id))
+                continue
+            fetched_shas[source_id] = fetched['study_sha']
+            if fetched['cached']:
+                results[source_id] = maps_cache.get(source_id)
+                if fetched['confirmed']:
+                    confirmed.append(source_id)
+                n_cached += 1
+                continue
+            ages_data = None
+            if source_id in age_versions:
+                ages_data = ages_cache.get(source_id, study_sha=fetched['study_sha'],
+                                           precision=ultrametricity_precision)
+            mappings[source_id] = map_pool.submit(instrument.collected,
+                                                  _map_fetched_source,
+                                                  source_id,
+                                                  fetched['study_nexson'],
+                                                  fetched['conf'],
+                                                  synth_tree_about,
+                                                  ultrametricity_precision,
+                                                  repo_dir,
+                                                  fetched['study_sha'],
+                                                  ages_data)
+        for source_id in source_ids:
+            if source_id not in mappings:
+                continue
+            try:
+                (ages_data, res), records = mappings[source_id].result()
+            except ValueError:
+                log.info('{}, conflict error\n'.format(source_id))
+                continue
+            instrument.metrics.extend(records)
+            study_sha = fetched_shas[source_id]
+            if res is not None:
+                maps_cache.put(source_id, res, synth_id=synth_id, study_sha=study_sha,
+                               precision=ultrametricity_precision, phylesystem_sha=phylesystem_sha)
+            if ages_data is not None and \
+                    age_versions.get(source_id, ())[1:3] != (study_sha, ultrametricity_precision):
+                ages_cache.put(source_id, ages_data, study_sha=study_sha, precision=ultrametricity_precision)
+            results[source_id] = res
+    maps_cache.confirm(confirmed, phylesystem_sha)
+    sys.stdout.write("Loaded {} current sources from {}\n".format(n_cached, maps_cache.path))
+    return {source_id: results[source_id] for source_id in source_ids if source_id in results}
+
+
+def map_conflict_nodes(source_id, repo_dir=None):
     """
     Takes a source id in format study_id@tree_id
+    repo_dir: a local clone of phylesystem to read the study from. Defaults to None, and uses the API.
 
     returns a dictionary of:
     {
@@ -191,12 +751,12 @@ def map_conflict_nodes(source_id):
     """
     study_id = source_id.split('@')[0]
     tree_id = source_id.split('@')[1]
-    dp_tree = as_dendropy(source_id)
+    study_sha, study_nexson = study_version(study_id, repo_dir=repo_dir)
+    dp_tree = as_dendropy(source_id, repo_dir=repo_dir, study_nexson=study_nexson, study_sha=study_sha)
     time_unit = dp_tree.annotations.get_value("branchLengthTimeUnit")
     assert time_unit == "Mya"
     metadata = {'study_id': study_id, 'tree_id': tree_id}
-    output_conflict = OT.conflict_info(study_id, tree_id)
-    conf = output_conflict.response_dict
+    conf = conflict_info(source_id, study_nexson=study_nexson, repo_dir=repo_dir, study_sha=study_sha)
     if conf is None:
         url = "https://tree.opentreeoflife.org/curator/study/view/{}/?tab=home&tree={}".format(metadata['study_id'],
                                                                                                metadata['tree_id'])
@@ -218,14 +778,25 @@ def map_conflict_nodes(source_id):
 def combine_ages_from_sources(source_ids,
                               ultrametricity_precision=None,
                               json_out=None,
-                              fresh=False):
+                              fresh=False,
+                              workers=None,
+                              repo_dir=None,
+                              metrics_out=None):
     """
     inputs
     ------
     source_ids = a list of source ids in format study_id@tree_id
     ultrametricity_precision = a float passed to dendropy
-    json_out = output file
+    json_out = output file. A path ending in .npz gets the compact binary table (see node_store.write_node_age_table),
+               anything else JSON.
     fresh = if False will re-use cached estimates. If True will re-map all studies.
+    workers = number of sources to map at once. Defaults to 'workers' in config params,
+              and 1 maps them one at a time.
+              Entries are merged in the order of source_ids whatever the number of workers.
+    repo_dir = a local clone of phylesystem to read studies from. Defaults to None, and uses the API.
+    metrics_out = path to dump the run's timings and API calls to as JSON (see instrument.Metrics).
+                  Defaults to metrics_file in config paths, if set.
+                  A summary is written to stdout at the end of the run, whether metrics_out is set or not.
 
     Outputs
     -------
@@ -242,20 +813,51 @@ def combine_ages_from_sources(source_ids,
                           'node_label':node_label
                            ],
                            }
+     'node_ages' is a NodeAgeTable: ages are held as interned id tables and index and age arrays,
+     and it reads like the dict above.
+     synth_node_ages['node_summary']:
+     {mrcaott123ott456 : {'n': 2, 'min': 48, 'max': 52, 'mean': 50, 'median': 50, 'variance': 8}}
+     (see node_store.summarize_node_ages)
 
     """
-    synth_node_ages = {'metadata':{}, 'node_ages':{}}
-    versions = OT.about()
-    synth_node_ages['metadata']['synth_tree_about'] = versions['synth_tree_about']
+    if workers is None:
+        workers = int(config.get('params', 'workers', fallback='1'))
+    if metrics_out is None:
+        metrics_out = config.get('paths', 'metrics_file', fallback=None)
+    with instrument.run(metrics_out):
+        return _combine_ages_from_sources(source_ids, ultrametricity_precision, json_out, fresh, workers, repo_dir)
+
+
+def _combine_ages_from_sources(source_ids, ultrametricity_precision, json_out, fresh, workers, repo_dir):
+    synth_node_ages = {'metadata':{}}
+    builder = NodeAgeTableBuilder()
+    synth_node_ages['metadata']['synth_tree_about'] = get_synth_tree_about()
     synth_node_ages['metadata']['date'] = str(datetime.date.today())
-    synth_node_ages['metadata']['phylesystem_sha'] = get_phylesystem_sha()
+    synth_node_ages['metadata']['phylesystem_sha'] = get_phylesystem_sha(repo_dir=repo_dir)
+    if repo_dir and workers <= 1:
+        # One walk of the git log for every study, rather than one per map_conflict_ages call
+        local_study_shas(repo_dir, set(source_id.split('@')[0] for source_id in source_ids))
+    if workers > 1:
+        mapped = map_conflict_ages_parallel(source_ids,
+                                            workers=workers,
+                                            ultrametricity_precision=ultrametricity_precision,
+                                            repo_dir=repo_dir,
+                                            fresh=fresh)
     for tag in source_ids:
-        try:
-            res = map_conflict_ages(tag, ultrametricity_precision=ultrametricity_precision, fresh=fresh)
-        except ValueError:
-#            time_unit = res['metadata']['time_unit']
-            log.info('{}, conflict error\n'.format(tag))
-            continue
+        if workers > 1:
+            if tag not in mapped:
+                continue
+            res = mapped[tag]
+        else:
+            try:
+                res = map_conflict_ages(tag,
+                                        ultrametricity_precision=ultrametricity_precision,
+                                        repo_dir=repo_dir,
+                                        fresh=fresh)
+            except ValueError:
+#                time_unit = res['metadata']['time_unit']
+                log.info('{}, conflict error\n'.format(tag))
+                continue
         if res is None:
             log.info('{}, conflict empty\n'.format(tag))
         else:
@@ -265,36 +867,173 @@ def combine_ages_from_sources(source_ids,
             time_unit = res['metadata']['time_unit']
             if time_unit == 'Myr':
                 assert tag == "{}@{}".format(res['metadata']['study_id'], res['metadata']['tree_id']), tag
-                for synth_node in res['supported_nodes']:
-                    if synth_node not in synth_node_ages['node_ages']: #if not a record yet, we need to create one
-                        synth_node_ages['node_ages'][synth_node] = []
-                    age = res['supported_nodes'][synth_node]['age']
-                    source_node = res['supported_nodes'][synth_node]['node_label']
-                    entry = {'source_id': source_id, 'age':age, 'source_node':source_node}
-                    synth_node_ages['node_ages'][synth_node].append(entry)
+                with instrument.stage('merge', source_id):
+                    for synth_node in res['supported_nodes']:
+                        age = res['supported_nodes'][synth_node]['age']
+                        source_node = res['supported_nodes'][synth_node]['node_label']
+                        builder.add(synth_node, source_id, age, source_node)
             else:
                 #skips all tree not in mya
                 pass
 
-    sf = json.dumps(synth_node_ages, sort_keys=True, indent=2, separators=(',', ': '), ensure_ascii=True)
+    synth_node_ages['node_ages'] = builder.build()
+    with instrument.stage('summarize'):
+        synth_node_ages['node_summary'] = summarize_node_ages(synth_node_ages['node_ages'])
     if json_out is not None:
-        ofi = open(json_out, 'w')
-        ofi.write(sf)
-        ofi.close()
+        if json_out.endswith('.npz'):
+            write_node_age_table(synth_node_ages, json_out)
+        else:
+            _write_node_ages(synth_node_ages, json_out)
     return synth_node_ages
 
 
+def node_summary(dates):
+    """
+    The per node age summaries of a node age store or combine_ages_from_sources style dict,
+    {synth_node: {'n':, 'min':, 'max':, 'mean':, 'median':, 'variance':}}.
+    They are computed here only for dicts saved without them.
+    """
+    if 'node_summary' in dates.keys():
+        return dates['node_summary']
+    return summarize_node_ages(dates['node_ages'])
+
+
+def _write_node_ages(synth_node_ages, json_out):
+    if isinstance(synth_node_ages['node_ages'], NodeAgeTable):
+        synth_node_ages = dict(synth_node_ages, node_ages=synth_node_ages['node_ages'].to_dict())
+    sf = json.dumps(synth_node_ages, sort_keys=True, indent=2, separators=(',', ': '), ensure_ascii=True)
+    ofi = open(json_out, 'w')
+    ofi.write(sf)
+    ofi.close()
+
+
+def source_index(node_ages):
+    """
+    Reverse index of combined node ages.
+    Takes the 'node_ages' dict output by combine_ages_from_sources and returns
+    {source_id: [synth_node_id, ...]} listing the synth nodes each source contributed to.
+    """
+    index = {}
+    for synth_node in node_ages:
+        for entry in node_ages[synth_node]:
+            index.setdefault(entry['source_id'], []).append(synth_node)
+    return index
+
+
+def changed_study_ids(repo_dir, since_sha):
+    """
+    Study ids added, changed or deleted in a local clone of phylesystem since commit since_sha,
+    or None if git could not tell, e.g. since_sha is not in the clone's history.
+    """
+    repo = PhylesystemGitAction(repo=repo_dir)
+    changed_docs = repo.get_changed_docs(since_sha)
+    # peyotl returns False when git fails
+    if changed_docs is False or changed_docs is None:
+        log.info("Could not list studies changed in %s since %s", repo_dir, since_sha)
+        return None
+    # Accepts doc ids or paths to study files
+    return set(os.path.splitext(os.path.basename(doc))[0] for doc in changed_docs)
+
+
+def update_synth_node_source_ages(store,
+                                  changed_studies,
+                                  sources,
+                                  ultrametricity_precision=None,
+                                  repo_dir=None,
+                                  workers=None):
+    """
+    Updates a node age store in place for studies that changed in phylesystem.
+    Entries from changed or deleted studies are removed, and the chronograms
+    those studies hold now are re-mapped and spliced in.
+    Cost scales with the number of changed trees.
+
+    Inputs
+    ------
+    store: NodeAgeStore, as returned by build_synth_node_source_ages
+    changed_studies: study ids that were added, changed or deleted
+    sources: current list of chronogram source ids, e.g. from find_trees()
+    ultrametricity_precision: a float passed to dendropy
+    repo_dir: a local clone of phylesystem to read studies from. Defaults to None, and uses the API.
+    workers: number of sources to map at once, passed to combine_ages_from_sources
+
+    Returns
+    -------
+    the updated store
+    """
+    changed_studies = set(changed_studies)
+    changed_sources = [source_id for source_id in sources if source_id.split('@')[0] in changed_studies]
+    log.info("Re-mapping {} chronograms from {} changed studies".format(len(changed_sources), len(changed_studies)))
+    remapped = combine_ages_from_sources(changed_sources,
+                                         ultrametricity_precision=ultrametricity_precision,
+                                         fresh=True,
+                                         workers=workers,
+                                         repo_dir=repo_dir)
+    store.replace_studies(changed_studies, remapped['node_ages'])
+    # The remapped metadata only describes the changed studies; keep the rest of the build's
+    metadata = store.metadata
+    metadata.update({key: remapped['metadata'][key] for key in ('date', 'phylesystem_sha')})
+    store.set_metadata(metadata)
+    return store
+
+
+_phylesystem_shas = {}
+
+def read_head_sha(repo_dir):
+    """
+    Commit of HEAD in a local git clone, read from the files in .git
+    (HEAD, then the loose ref or packed-refs) rather than by running git.
+    """
+    git_dir = os.path.join(repo_dir, '.git')
+    if os.path.isfile(git_dir):
+        # Worktrees and submodules point to their git dir
+        with open(git_dir) as git_file:
+            git_dir = os.path.join(repo_dir, git_file.read().strip()[len('gitdir: '):])
+    common_dir = git_dir
+    if os.path.exists(os.path.join(git_dir, 'commondir')):
+        with open(os.path.join(git_dir, 'commondir')) as common_file:
+            common_dir = os.path.join(git_dir, common_file.read().strip())
+    with open(os.path.join(git_dir, 'HEAD')) as head_file:
+        head = head_file.read().strip()
+    if not head.startswith('ref: '):
+        return head
+    ref = head[len('ref: '):]
+    for ref_dir in (git_dir, common_dir):
+        ref_path = os.path.join(ref_dir, ref)
+        if os.path.exists(ref_path):
+            with open(ref_path) as ref_file:
+                return ref_file.read().strip()
+    packed_refs = os.path.join(common_dir, 'packed-refs')
+    if os.path.exists(packed_refs):
+        with open(packed_refs) as packed_file:
+            for line in packed_file:
+                if line.startswith('#') or line.startswith('^'):
+                    continue
+                sha, _, name = line.strip().partition(' ')
+                if name == ref:
+                    return sha
+    raise ValueError("Can't resolve {} in {}".format(ref, repo_dir))
+
+
 #This should probably go in peyotl or somethings
-def get_phylesystem_sha(repo_url="https://github.com/OpenTreeOfLife/phylesystem-1.git", repo_dir=None):
+def get_phylesystem_sha(repo_url="https://github.com/OpenTreeOfLife/phylesystem-1.git", repo_dir=None, ttl=None):
     """Get current phylesystem sha
+    For a local clone, HEAD is read from its .git directory.
+    Otherwise the remote is asked with git ls-remote, and the answer is reused for ttl seconds.
+    ttl: defaults to phylesystem_sha_ttl in config params, or 300. 0 always asks the remote.
     """
     if repo_dir:
         assert os.path.exists(repo_dir)
-        sha = peyotl.git_storage.git_action.get_HEAD_SHA1('{}/.git'.format(repo_dir))
-    else:
-        process = subprocess.Popen(["git", "ls-remote", repo_url], stdout=subprocess.PIPE)
-        stdout, stderr = process.communicate()
-        sha = re.split(r'\t+', stdout.decode('ascii'))[0]
+        return read_head_sha(repo_dir)
+    if ttl is None:
+        ttl = float(config.get('params', 'phylesystem_sha_ttl', fallback='300'))
+    now = time.monotonic()
+    cached = _phylesystem_shas.get(repo_url)
+    if cached and now - cached[0] < ttl:
+        return cached[1]
+    process = instrument.run_subprocess('git ls-remote', ["git", "ls-remote", repo_url, "HEAD"], stdout=subprocess.PIPE)
+    sha = re.split(r'\t+', process.stdout.decode('ascii'))[0]
+    if process.returncode == 0 and sha:
+        _phylesystem_shas[repo_url] = (now, sha)
     return sha
 
 
@@ -305,51 +1044,88 @@ def pull_phylesystem(repo_dir, repo_url="https://github.com/OpenTreeOfLife/phyle
     git(git_dir_arg, 'pull', repo_url)
 
 
-def build_synth_node_source_ages(cache_file_path=None, ultrametricity_precision=None, repo_dir=None, fresh=False):
+def _node_age_store_path(cache_file_path=None):
+    if cache_file_path is None:
+        cache_file_dir = config.get('paths', 'cache_file_dir',
+                                    fallback='/tmp/')
+        cache_file_path = cache_file_dir + '/node_ages.db'
+    return cache_file_path
+
+
+def node_age_store(cache_file_path=None):
+    """
+    Opens the node age store written by build_synth_node_source_ages,
+    without checking whether it is up to date.
+    cache_file_path: Defaults to node_ages.db in the cache_file_dir set in config
+    """
+    cache_file_path = _node_age_store_path(cache_file_path)
+    if not os.path.exists(cache_file_path):
+        raise ValueError("No node age store at {}, run build_synth_node_source_ages".format(cache_file_path))
+    return NodeAgeStore(cache_file_path)
+
+
+def build_synth_node_source_ages(cache_file_path=None, ultrametricity_precision=None, repo_dir=None, fresh=False, workers=None,
+                                 metrics_out=None, report=True):
     """
-    This combines all of the input node ages mapped using "map conflict ages".
-    Returns a dictionary, and caches the dict in
+    This combines all of the input node ages mapped using "map conflict ages",
+    and caches them in an indexed store (see node_store.NodeAgeStore).
+    Returns the store, which can be read like the dict output by combine_ages_from_sources:
+    store['metadata'], store['node_ages'][synth_node_id], store['node_summary'][synth_node_id],
+    and store['source_index'][source_id] for the synth nodes each source contributed to.
+    When phylesystem has moved on and repo_dir is given, only the changed studies are re-mapped.
     Args:
-    cache_file_path (str): Json output. can be given as arg or
-                            Defaults to node_ages.json, dir set in config,
-                            or defaults /tmp/node_ages.json
+    cache_file_path (str): SQLite output. can be given as arg or
+                            Defaults to node_ages.db, dir set in config,
+                            or defaults /tmp/node_ages.db
     ultrametricity_precision: a float passed to dendropy
-    repo_dir: a local clone of phylesystem. Defaults to None, and uses remote
+    repo_dir: a local clone of phylesystem, used for the sha, to find chronograms and to read studies.
+              Defaults to None, and uses remote
     fresh: Whether to re-map trees to synth and est ages
+    workers: number of sources to map at once, passed to combine_ages_from_sources
+    metrics_out: path to dump the run's timings and API calls to as JSON,
+                 defaults to metrics_file in config paths, if set.
+    report: whether to write a summary of the run to stdout, see instrument.run
     """
-    if cache_file_path is None:
-        cache_file_dir = config.get('paths', 'cache_file_dir',
-                                    fallback='/tmp/')
-        cache_file_path = cache_file_dir + '/node_ages.json'
-    sources = find_trees()
+    if metrics_out is None:
+        metrics_out = config.get('paths', 'metrics_file', fallback=None)
+    with instrument.run(metrics_out, report=report):
+        return _build_synth_node_source_ages(cache_file_path, ultrametricity_precision, repo_dir, fresh, workers)
+
+
+def _build_synth_node_source_ages(cache_file_path, ultrametricity_precision, repo_dir, fresh, workers):
+    cache_file_path = _node_age_store_path(cache_file_path)
     if os.path.exists(cache_file_path) and fresh == False:
-        dates = json.load(open(cache_file_path))
+        store = NodeAgeStore(cache_file_path)
         current_sha = get_phylesystem_sha(repo_dir=repo_dir)
-        cached_sha = dates['metadata'].get('phylesystem_sha')
+        cached_sha = store.metadata.get('phylesystem_sha')
         if cached_sha == current_sha:
             sys.stdout.write("No new changes to phylesystem, using cached dates at {}\n".format(cache_file_path))
-            return dates
-        if cached_sha != current_sha:
-            if repo_dir:
-                repo = PhylesystemGitAction(repo=repo_dir)
-                changed_studies = repo.get_changed_docs(cached_sha)
-                sys.stdout.write("Mapping changed studies")
-                ## Re-est conflict and BL's for changed studies
-                changed_trees = [source for source in sources if source.split('@') in changed_studies]
-                for source_id in changed_trees:
-                    map_conflict_ages(source_id,
-                                      ultrametricity_precision=ultrametricity_precision,
-                                      repo_dir=repo_dir,
-                                      fresh=True)
-            else:
-                sys.stdout.write("Phylesystem has changed since dates were cached, reloading and saving to {}\n".format(cache_file_path))
+            return store
+        sources = find_trees(repo_dir=repo_dir)
+        # Every mapping is stale once the synth tree has moved on, not only those of changed studies
+        cached_synth_id = store.metadata.get('synth_tree_about', {}).get('synth_id')
+        changed_studies = None
+        if repo_dir and cached_sha and cached_synth_id == synth_version():
+            changed_studies = changed_study_ids(repo_dir, cached_sha)
+        if changed_studies is not None:
+            sys.stdout.write("Mapping {} changed studies and saving to {}\n".format(len(changed_studies), cache_file_path))
+            return update_synth_node_source_ages(store,
+                                                 changed_studies,
+                                                 sources,
+                                                 ultrametricity_precision=ultrametricity_precision,
+                                                 repo_dir=repo_dir,
+                                                 workers=workers)
+        store.close()
+        sys.stdout.write("Phylesystem has changed since dates were cached, reloading and saving to {}\n".format(cache_file_path))
     else:
         sys.stdout.write("No date cache found. Loading dates and saving to {}\n".format(cache_file_path))
+        sources = find_trees(repo_dir=repo_dir)
     dates = combine_ages_from_sources(sources,
                                       ultrametricity_precision=ultrametricity_precision,
-                                      json_out=cache_file_path,
-                                      fresh=fresh)
-    return dates
+                                      fresh=fresh,
+                                      workers=workers,
+                                      repo_dir=repo_dir)
+    return write_node_age_store(dates, cache_file_path)
 
 
 def synth_node_source_ages(node, cache_file_path=None):
@@ -357,32 +1133,95 @@ def synth_node_source_ages(node, cache_file_path=None):
     Return age estimates for a node.
     Arguemnts:
     node: Opentree node id
-    cache_file_path: path to a stored json with dates. default None.
+    cache_file_path: path to the node age store. default None, uses node_ages.db in the cache_file_dir.
     """
-    if cache_file_path is None:
-        cache_file_path = config.get('Paths', 'cache_file_path',
-                                     fallback='/tmp/node_ages.json')
+    return synth_nodes_source_ages([node], cache_file_path=cache_file_path)[node]
+
+
+def _synth_node_info_batch(nodes, batch_size):
+    """
+    Resolves node ids with as few tree_of_life/node_info calls as possible.
+    A batch that fails is split in halves until the ids that can't be resolved are isolated.
+    Returns ({node: node_info}, {node: failed call record})
+    """
+    found = {}
+    failed = {}
+    to_query = [nodes[i:i + batch_size] for i in range(0, len(nodes), batch_size)]
+    while to_query:
+        batch = to_query.pop()
+        synth_resp = OT.synth_node_info(node_ids=batch)
+        if synth_resp.status_code == 200 and len(synth_resp.response_dict) == len(batch):
+            for node, node_info in zip(batch, synth_resp.response_dict):
+                found[node] = node_info
+        elif len(batch) == 1:
+            failed[batch[0]] = synth_resp
+        else:
+            half = len(batch) // 2
+            to_query.append(batch[half:])
+            to_query.append(batch[:half])
+    return found, failed
+
+
+def synth_nodes_source_ages(nodes, cache_file_path=None, batch_size=500):
+    """
+    Return age estimates for many nodes at once.
+    Node ids are resolved in batched synth node_info calls, and the node age store
+    is checked for updates once for the whole batch.
+
+    Arguments:
+    nodes: list of Opentree node ids or ott ids ('ott123' or 123)
+    cache_file_path: path to the node age store. default None, uses node_ages.db in the cache_file_dir.
+    batch_size: maximum number of node ids per node_info call
+
+    Returns
+    -------
+    {query: record}, in the order of nodes, where each record is the dict returned by synth_node_source_ages
+    """
+    cache_file_path = _node_age_store_path(cache_file_path)
     log.debug("cache file path %s" % cache_file_path)
-    ##check if node is in synth?
+    queries = []
+    for node in nodes:
+        if isinstance(node, int):
+            node = 'ott{}'.format(node)
+        if node not in queries:
+            queries.append(node)
+    found, failed = _synth_node_info_batch(queries, batch_size)
+    dates = None
+    if found:
+        dates = build_synth_node_source_ages(cache_file_path, report=False)
+    ret = {}
+    try:
+        for node in queries:
+            if node in found:
+                ret[node] = _source_ages_record(node, found[node], dates)
+            else:
+                ret[node] = _missing_node_record(node, failed[node])
+    finally:
+        # The records are read, so the store's connection isn't kept open between lookups
+        if dates is not None:
+            dates.close()
+    return ret
 
-    synth_resp = OT.synth_node_info(node)
+
+def _source_ages_record(node, node_info, dates):
     retdict = {}
     retdict['query'] = node
-    if synth_resp.status_code == 200:
-        resp_node = synth_resp.response_dict[0]['node_id']
-        retdict['synth_node_id'] = resp_node
-        if node.startswith('ott'):
-            if node != resp_node:
-                msg = "Taxon {} is not monophyletic.\
-                    resolving to MRCA: synth_node {}, and reporting dates for that\n".format(node, synth_resp)
-                retdict['msg'] = msg
-        dates = build_synth_node_source_ages(cache_file_path)
-        retdict['ot:source_node_ages'] = dates['node_ages'].get(node)
-    elif node.startswith('ott') and node.strip('ott').isnumeric():
+    resp_node = node_info['node_id']
+    retdict['synth_node_id'] = resp_node
+    if node.startswith('ott'):
+        if node != resp_node:
+            msg = "Taxon {} is not monophyletic.\
+                resolving to MRCA: synth_node {}, and reporting dates for that\n".format(node, resp_node)
+            retdict['msg'] = msg
+    retdict['ot:source_node_ages'] = dates['node_ages'].get(resp_node)
+    return retdict
+
+
+def _missing_node_record(node, synth_resp):
+    if node.startswith('ott') and node.strip('ott').isnumeric():
         tax_resp = OT.taxon_info(node)
         if tax_resp.status_code == 200:
             msg = "Taxon {} is in the taxonomy, but cannot be found in the synth tree\n".format(node)
-            retdict['msg'] = msg
             retdict = {'msg': msg, 'synth_response': synth_resp.response_dict, 'tax_response': tax_resp.response_dict}
         else:
             msg = "node {} not found in synthetic tree or taxonomy".format(node)
@@ -393,107 +1232,524 @@ def synth_node_source_ages(node, cache_file_path=None):
     return retdict
 
 
-def write_fastdate_prior(subtree, dates, var_mult=0.1, outputfile='node_prior.txt'):
+def write_fastdate_prior(subtree, dates, var_mult=0.1, outputfile='node_prior.txt', validate=False, prior=None):
     """
     Writes out a node prior file for fatsdate input, with normal prior on each  node with any dates.
     Where multiple dates exist, variance for normal is estimated from dates.
     Where only one date, variance is date * var_mult.
+    Tip sets are collected and matched to dates in a single post-order pass,
+    and each calibration is written out as soon as its node is reached.
 
     Inputs:
     subtree: dendropy tree object labeled with ottids and synth node ids
-    dates: dictionary output by synth_node_ages()
+    dates: node age store or dictionary output by build_synth_node_source_ages()
     var_mult: Hacky approach to choosing a variance
     outputfile: defaults to node_prior.txt
+    validate: if True, checks that the MRCA of each calibrated tip set is still the dated node,
+              and raises a ValueError if not, e.g. for unifurcations or tip labels that occur twice.
+              The partly written outputfile is removed.
+    prior: optional function of a node's age summary (see node_store.summarize_node_ages) returning the
+           (variance, mean) of its normal prior, in place of the defaults above.
     """
-    mrca_dict = {}
-    for node in subtree:
-        lab = None
-        if node.label:
+    summary = node_summary(dates)
+    if validate:
+        tip_counts = collections.Counter(leaf.taxon.label.replace(' ', '_') for leaf in subtree.leaf_node_iter())
+    # Leaves in post-order, so the tips of each node are a contiguous slice
+    tips = []
+    spans = {}
+    done = set()
+    fi = None
+    try:
+        for node in subtree.postorder_node_iter():
+            children = node.child_nodes()
+            if children:
+                spans[node] = (spans[children[0]][0], spans[children[-1]][1])
+                for child in children:
+                    del spans[child]
+            else:
+                spans[node] = (len(tips), len(tips) + 1)
+                tips.append(node.taxon.label.replace(' ', '_'))
+            if not node.label:
+                continue
             lab = str(node.label)
-            if lab in dates['node_ages']:
-                mrca_dict[lab] = {}
-                mrca_dict[lab]['ages'] = dates['node_ages'][lab]
-                nd = subtree.find_node_with_label(lab)
-                mrca_dict[lab]['tips'] = [ti.taxon.label.replace(' ', '_') for ti in nd.leaf_iter()]
-    if len(mrca_dict) == 0:
+            if lab in done:
+                continue
+            stats = summary.get(lab)
+            if not stats:
+                continue
+            done.add(lab)
+            start, stop = spans[node]
+            if validate:
+                _validate_calibration(lab, node, tips[start:stop], tip_counts)
+            if prior is not None:
+                var, avgage = prior(stats)
+            else:
+                avgage = stats['mean']
+                if stats['n'] > 1:
+                    var = stats['variance']
+                else:
+                    var = var_mult*avgage
+            if fi is None:
+                fi = open(outputfile, 'w')
+            fi.write("'")
+            fi.write("','".join(tips[start:stop]))
+            fi.write("'")
+            fi.write(' ')
+            fi.write('norm({},{},{})\n'.format(0, var, avgage))
+    except BaseException:
+        if fi is not None:
+            fi.close()
+            os.remove(outputfile)
+        raise
+    if fi is None:
         sys.stderr.write("no calibrations\n")
         return None
-    fi = open(outputfile, 'w')
-    for dated_node in mrca_dict:
-        fi.write("'")
-        fi.write("','".join(mrca_dict[dated_node]['tips']))
-        fi.write("'")
-        fi.write(' ')
-        ages = [source['age'] for source in mrca_dict[dated_node]['ages']]
-        avgage = sum(ages)/len(ages)
-        if len(ages) > 1:
-            var = statistics.variance(ages)
-        else:
-            var = var_mult*avgage
-        fi.write('norm({},{},{})\n'.format(0, var, avgage))
     fi.close()
     return outputfile
 
+
+def _validate_calibration(lab, node, node_tips, tip_counts):
+    """Raises a ValueError if the MRCA of node_tips is not node"""
+    if len(node.child_nodes()) == 1:
+        raise ValueError("Calibrated node {} is a unifurcation, the MRCA of its tips is its child".format(lab))
+    repeated = [tip for tip in node_tips if tip_counts[tip] > 1]
+    if repeated:
+        raise ValueError("Tips of calibrated node {} occur more than once in the tree: {}".format(lab,
+                                                                                            ', '.join(repeated)))
+
+
+def _as_array_tree(subtree):
+    """ArrayTree from a path to a newick file, a dendropy tree or an ArrayTree"""
+    if isinstance(subtree, ArrayTree):
+        return subtree
+    if isinstance(subtree, str):
+        subtree = dendropy.Tree.get_from_path(subtree, schema="newick")
+    return ArrayTree.from_dendropy(subtree)
+
+
+def resolved_trees(subtree, seeds, br_len=0.01, polytomy_br=0.001):
+    """
+    Generator of randomly resolved copies of a synth subtree, e.g. for fastdate replicates.
+    The subtree is parsed once, and each copy has its polytomies resolved with its own seed,
+    unifurcations suppressed, and arbitrary branch lengths applied (see arraytree.resolve_polytomies).
+
+    Inputs:
+    subtree: path to newick tree file, dendropy tree or ArrayTree
+    seeds: random seeds, one per copy. A seed of None uses the global random state.
+    br_len: branch length to assign to branches
+    polytomy_br: branch length to assign to arbitrarily resolved polytomies
+
+    Yields (seed, ArrayTree). ArrayTree.to_newick() gives the tree as write_fastdate_tree writes it.
+    """
+    tree = _as_array_tree(subtree)
+    for seed in seeds:
+        rng = random if seed is None else random.Random(seed)
+        yield seed, resolve_polytomies(tree, rng, br_len=br_len, polytomy_br=polytomy_br)
+
+
 def write_fastdate_tree(subtreepath,
                         br_len=0.01,
                         polytomy_br=0.001,
-                        outputfile='fastdate_input.tre'):
+                        outputfile='fastdate_input.tre',
+                        seed=None):
     """Takes a subtree from OpenTree synth, with id formatted labels,
     and resolves polytomies and applies arbitrarty branch lengths.
     Uses random to randomies polytomy resolution each time.
+    For many replicates use resolved_trees, which parses the subtree only once.
 
     Inputs:
-    subtreepath: path to newick tree file
+    subtreepath: path to newick tree file, or an already parsed dendropy tree or ArrayTree
     br_len: branch length to assign to branches
     polytomy_br: branch length to assign to arbitrarily resolved polytomies
     outputfile: default fastdate_input.tre
+    seed: random seed for the polytomy resolution. Default None, uses the global random state.
 
     """
-    subtree = dendropy.Tree.get_from_path(subtreepath, schema="newick")
-    subtree.resolve_polytomies(rng=random)
-    subtree.suppress_unifurcations()
-    for edge in subtree.levelorder_edge_iter():
-        if (edge.tail_node is not None) and (edge.length is None):
-            edge.length = br_len
-        if edge.length == 0:
-            edge.length = polytomy_br
-    subtree.write(path=outputfile, schema="newick")
+    seed, tree = next(resolved_trees(subtreepath, [seed], br_len=br_len, polytomy_br=polytomy_br))
+    with open(outputfile, 'w') as out:
+        out.write(tree.to_newick())
+        out.write('\n')
+    return outputfile
+
+
+GRAFTED_SOLUTION_URL = "https://files.opentreeoflife.org/synthesis/{synth_id}/output/grafted_solution/grafted_solution.tre"
+
+_phylo_ottids = {}
+_OTTID = re.compile(r'ott(\d+)$')
+
+def read_grafted_ottids(grafted_solution):
+    """
+    Sorted array of the ott ids of the tips of a grafted solution newick file.
+    The file is scanned in place with mmap, rather than read into memory.
+    """
+    with open(grafted_solution, 'rb') as tree_file:
+        with mmap.mmap(tree_file.fileno(), 0, access=mmap.ACCESS_READ) as tree_map:
+            # Tips follow '(' or ','; internal labels follow ')'
+            ids = np.fromiter((int(match.group(1)) for match in re.finditer(rb'[(,]ott(\d+)', tree_map)),
+                              dtype=np.int64)
+    return np.unique(ids)
 
 
-def prune_to_phylo_only(tree,
-                        grafted_solution="/home/ejmctavish/projects/otapi/opentree13.4_tree/grafted_solution/grafted_solution.tre"):
+def phylo_ottids(grafted_solution=None, synth_id=None):
+    """
+    Ott ids of taxa with some phylogenetic information in OpenTree synth, i.e. the tips of the grafted solution,
+    as a sorted numpy array.
+    The grafted solution is parsed once per synth version, and the ids cached in cache_file_dir
+    as a .npy file that loads instantly, and in memory for the rest of the session.
+
+    grafted_solution: path to a grafted_solution.tre. Defaults to grafted_solution in config paths,
+                      or downloads the one for synth_id to cache_file_dir.
+    synth_id: synth version, e.g. opentree13.4. Defaults to the current one.
+    """
+    cache_file_dir = config.get('paths', 'cache_file_dir', fallback='/tmp/')
+    if grafted_solution is None:
+        grafted_solution = config.get('paths', 'grafted_solution', fallback=None)
+    if grafted_solution is None:
+        if synth_id is None:
+            synth_id = OT.about()['synth_tree_about']['synth_id']
+        key = synth_id
+    else:
+        stat = os.stat(grafted_solution)
+        key = hashlib.sha1('{}:{}:{}'.format(os.path.abspath(grafted_solution),
+                                            stat.st_size,
+                                            stat.st_mtime).encode('utf-8')).hexdigest()
+    cache_path = os.path.join(cache_file_dir, 'phylo_ottids_{}.npy'.format(key))
+    if cache_path in _phylo_ottids:
+        return _phylo_ottids[cache_path]
+    if os.path.exists(cache_path):
+        ottids = np.load(cache_path)
+    else:
+        if grafted_solution is None:
+            grafted_solution = os.path.join(cache_file_dir, 'grafted_solution_{}.tre'.format(synth_id))
+            if not os.path.exists(grafted_solution):
+                url = GRAFTED_SOLUTION_URL.format(synth_id=synth_id)
+                sys.stdout.write("Downloading {}\n".format(url))
+                urllib.request.urlretrieve(url, grafted_solution + '.tmp')
+                os.replace(grafted_solution + '.tmp', grafted_solution)
+        ottids = read_grafted_ottids(grafted_solution)
+        tmp_path = '{}.{}.tmp.npy'.format(cache_path[:-4], os.getpid())
+        np.save(tmp_path, ottids)
+        os.replace(tmp_path, cache_path)
+    _phylo_ottids[cache_path] = ottids
+    return ottids
+
+
+def prune_to_phylo_only(tree, grafted_solution=None, synth_id=None):
     """
     Prune tree to only taxa with some phylogenetic information in OpenTree
     Inputs:
-    tree: dendropy formatted tree
-    grafted solution: path to current synth grafted solution TODO current default hardcoded hack
+    tree: dendropy formatted tree, with tips labelled by ott id, e.g. ott123
+    grafted solution: path to a synth grafted solution, see phylo_ottids
     https://files.opentreeoflife.org/synthesis/opentree13.4/output/grafted_solution/grafted_solution.tre
+    synth_id: synth version of the grafted solution to use. Defaults to the current one.
     """
-    fi = open(grafted_solution).readlines()
-    for lin in fi:
-        lin = lin.replace('(', ',')
-        lin = lin.replace(')', ',')
-        lii = lin.split(',')
-    synth_ottids = set(lii)
-    taxa_to_retain = []
-    for leaf in tree.leaf_nodes():
+    synth_ottids = phylo_ottids(grafted_solution=grafted_solution, synth_id=synth_id)
+    taxa = []
+    ottids = []
+    for leaf in tree.leaf_node_iter():
         tax = leaf.taxon
-        if tax:
-            ottid = tax.label
-        else:
-            ottid = None
-        if ottid in synth_ottids:
-            taxa_to_retain.append(tax)
-    tree.retain_taxa(taxa_to_retain)
+        match = _OTTID.match(tax.label) if tax and tax.label else None
+        if match:
+            taxa.append(tax)
+            ottids.append(int(match.group(1)))
+    keep = np.isin(np.array(ottids, dtype=np.int64), synth_ottids, assume_unique=False)
+    tree.retain_taxa([tax for tax, kept in zip(taxa, keep.tolist()) if kept])
     return tree
 
 
+_synth_tree_indexes = {}
+
+def synth_subtree_newick(node_id, synth_tree=None):
+    """
+    Newick string of the synth subtree below node_id, labelled with node ids.
+    If a local synth tree is given, or set as synth_tree in config paths, the subtree is sliced from
+    that file using a node id to byte range index (see synth_index.SynthTreeIndex),
+    built the first time the file is used and saved next to it.
+    Otherwise, or if node_id is not in the local tree, it is fetched with OT.synth_subtree.
+
+    synth_tree: path to a labelled_supertree.tre or grafted_solution.tre newick file
+    """
+    if synth_tree is None:
+        synth_tree = config.get('paths', 'synth_tree', fallback=None)
+    if synth_tree:
+        if synth_tree not in _synth_tree_indexes:
+            with instrument.stage('index synth tree'):
+                _synth_tree_indexes[synth_tree] = SynthTreeIndex(synth_tree)
+        index = _synth_tree_indexes[synth_tree]
+        if node_id in index:
+            with instrument.stage('extract subtree'):
+                return index.subtree_newick(node_id, label_format='id')
+        log.debug("%s not in %s, fetching from synth_subtree", node_id, synth_tree)
+    output = OT.synth_subtree(node_id=node_id, label_format='id')
+    return output.response_dict['newick']
+
+
+_synth_conflicts = {}
+_synth_conflicts_lock = threading.Lock()
+
+def conflict_info(source_id, study_nexson=None, repo_dir=None, synth_tree=None, study_sha=None):
+    """
+    Conflict statuses of the nodes of a source tree with the synth tree, as
+    {node_id: {'status': status, 'witness': synth node id}}, the response_dict of OT.conflict_info.
+    If a local synth tree is given, or set as synth_tree in config paths, they are computed locally
+    with conflict.SynthConflict, loading the tree once per process. Otherwise the web service is called.
+
+    source_id: study_id@tree_id
+    study_nexson: NexSON of the study, read from repo_dir or the API if not given, for local conflict only
+    synth_tree: path to a labelled_supertree.tre newick file, of the same synth version as the API
+    study_sha: the commit of the study. With a repo_dir it defaults to the local one.
+    Results are kept in SOURCE_CACHE under the study commit, per synth tree version (see synth_tree_version).
+    Without a study commit they aren't cached.
+    """
+    if study_sha is None and repo_dir:
+        study_sha = study_version(source_id.split('@')[0], repo_dir=repo_dir)[0]
+    if study_sha is None:
+        return _conflict_info(source_id, study_nexson, repo_dir, synth_tree)
+    return _cached_source(source_id, study_sha, ('conflict', synth_tree_version(synth_tree)),
+                          lambda: _conflict_info(source_id, study_nexson, repo_dir, synth_tree))
+
+
+def _local_synth_tree(synth_tree=None):
+    """synth_tree, or the synth_tree set in config paths, or None for the web service"""
+    if synth_tree is None:
+        synth_tree = config.get('paths', 'synth_tree', fallback=None)
+    return synth_tree or None
+
+
+def synth_tree_version(synth_tree=None):
+    """
+    Version of the synth tree conflict is computed against: the path and modification time
+    of a local synth tree (see conflict_info), read without calling the API, or else synth_version().
+    """
+    synth_tree = _local_synth_tree(synth_tree)
+    if synth_tree:
+        return '{}@{}'.format(os.path.abspath(synth_tree), os.path.getmtime(synth_tree))
+    return synth_version()
+
+
+def _conflict_info(source_id, study_nexson, repo_dir, synth_tree):
+    study_id, tree_id = source_id.split('@')
+    synth_tree = _local_synth_tree(synth_tree)
+    if not synth_tree:
+        return OT.conflict_info(study_id=study_id, tree_id=tree_id).response_dict
+    with _synth_conflicts_lock:
+        if synth_tree not in _synth_conflicts:
+            with instrument.stage('load synth tree'):
+                _synth_conflicts[synth_tree] = SynthConflict(synth_tree)
+    if study_nexson is None:
+        study_nexson = get_study_nexson(study_id, repo_dir=repo_dir)
+    try:
+        return _synth_conflicts[synth_tree].nexson_conflict(study_nexson, tree_id)
+    except KeyError:
+        log.info("No tree %s in study %s", tree_id, study_id)
+        return None
+
+
+def synth_label_id(label):
+    """
+    Node id of a synth tree label: labels starting with mrca or ott are ids,
+    otherwise it is the last word, e.g. 'Homo sapiens ott770315' -> 'ott770315'
+    """
+    if label.startswith('mrca') or label.startswith('ott'):
+        return label
+    return label.split()[-1]
+
+
+def _mean_node_ages(dates):
+    """{synth node id: mean age} from a node age store or combine_ages_from_sources style dict"""
+    if isinstance(dates, NodeAgeStore):
+        return dates.mean_ages()
+    return {node_id: stats['mean'] for node_id, stats in node_summary(dates).items()}
+
+
+def date_synth_tree(synth_tree=None, dates=None, root_age=None, outputfile=None, ages_out=None, metrics_out=None):
+    """
+    Dates the whole synth tree BLADJ style: each synth node with ages in the node age store
+    is fixed at the average of its ages, and the other nodes are spaced evenly between them
+    (see arraytree.bladj_ages).
+    The tree is read straight into arrays (see synth_index.read_tree_nodes) rather than into dendropy,
+    so all ~2.3M synth nodes are dated in about a minute, in a few hundred MB.
+
+    Inputs
+    ------
+    synth_tree: path to a labelled_supertree.tre or grafted_solution.tre,
+                defaults to synth_tree in config paths
+    dates: node age store or combine_ages_from_sources style dict. Defaults to build_synth_node_source_ages()
+    root_age: age of the root, default None uses its calibration or 1.25 times the oldest age below it
+    outputfile: if given, the tree is written there with edge lengths from the node ages
+    ages_out: if given, "node_id\tage" is written there for each labelled internal node, as for BLADJ
+    metrics_out: path to dump the run's timings to as JSON, defaults to metrics_file in config paths, if set.
+
+    Returns
+    -------
+    dict of arrays over the nodes of the tree in preorder, from synth_index.read_tree_nodes, plus
+    'age': node ages, and 'fixed': whether the node's age was fixed rather than interpolated
+    """
+    if metrics_out is None:
+        metrics_out = config.get('paths', 'metrics_file', fallback=None)
+    with instrument.run(metrics_out):
+        return _date_synth_tree(synth_tree, dates, root_age, outputfile, ages_out)
+
+
+def _date_synth_tree(synth_tree, dates, root_age, outputfile, ages_out):
+    if synth_tree is None:
+        synth_tree = config.get('paths', 'synth_tree', fallback=None)
+    if synth_tree is None:
+        raise ValueError("No synth tree given, set synth_tree in config paths")
+    if dates is None:
+        dates = build_synth_node_source_ages(ultrametricity_precision=0.01)
+    with instrument.stage('read synth tree'):
+        nodes = synth_index.read_tree_nodes(synth_tree)
+    with instrument.stage('date'):
+        mean_ages = _mean_node_ages(dates)
+        cal_keys = []
+        cal_ages = []
+        for node_id, age in mean_ages.items():
+            key = synth_index.node_key(synth_label_id(node_id))
+            if key is not None:
+                cal_keys.append(key)
+                cal_ages.append(age)
+        cal_keys = np.array(cal_keys, dtype=np.uint64)
+        cal_ages = np.array(cal_ages, dtype=np.float64)
+        order = np.argsort(cal_keys)
+        cal_keys, cal_ages = cal_keys[order], cal_ages[order]
+        calibration = np.full(len(nodes['key']), np.nan)
+        if len(cal_keys):
+            pos = np.minimum(np.searchsorted(cal_keys, nodes['key']), len(cal_keys) - 1)
+            found = cal_keys[pos] == nodes['key']
+            calibration[found] = cal_ages[pos[found]]
+        age, fixed = bladj_ages(nodes['parent'], calibration, root_age=root_age)
+    sys.stdout.write("{} of {} nodes dated from calibrations, root age {}\n".format(int((fixed & ~np.isnan(calibration)).sum()),
+                                                                                  len(age),
+                                                                                  age[0]))
+    nodes['age'] = age
+    nodes['fixed'] = fixed
+    if outputfile:
+        with instrument.stage('write'):
+            edge_length = np.full(len(age), np.nan)
+            edge_length[1:] = age[nodes['parent'][1:]] - age[1:]
+            synth_index.write_newick_with_lengths(synth_tree, nodes, edge_length, outputfile)
+    if ages_out:
+        internal = np.zeros(len(age), dtype=bool)
+        internal[nodes['parent'][1:]] = True
+        with open(ages_out, 'w') as out:
+            for key, node_age in zip(nodes['key'][internal].tolist(), age[internal].tolist()):
+                if key != synth_index.NO_KEY:
+                    out.write("{}\t{}\n".format(synth_index.node_id_of_key(key), node_age))
+    return nodes
+
+
+_replicate_tree = None
+
+def _set_replicate_tree(tree):
+    """Worker initializer, so the subtree is sent to each worker once rather than with every replicate"""
+    global _replicate_tree
+    _replicate_tree = tree
+
+
+def _fastdate_replicate(i, prior_path, max_age_est, run_dir, timeout=None, seed=None):
+    """
+    Runs one fastdate replicate in its own scratch directory, run_dir/rep{i},
+    on the worker's subtree with its polytomies resolved using random seed seed.
+    Returns {'rep': i, 'seed': seed, 'rep_dir': rep_dir, 'out_file': dated tree, 'returncode': returncode, 'timed_out': bool}
+    """
+    rep_dir = os.path.join(run_dir, 'rep{}'.format(i))
+    os.makedirs(rep_dir, exist_ok=True)
+    tree_file = os.path.join(rep_dir, 'fastdate_input.tre')
+    out_file = os.path.join(rep_dir, 'node_prior.tre')
+    write_fastdate_tree(_replicate_tree, br_len=0.01, polytomy_br=0.001, outputfile=tree_file, seed=seed)
+    args = ["fastdate", "--method_nodeprior",
+            "--tree_file", tree_file,
+            "--prior_file", prior_path,
+            "--out_file", out_file,
+            "--max_age", str(max_age_est),
+            "--bd_rho", "1",
+            "--grid", str(max_age_est*2)]
+    ret = {'rep': i, 'seed': seed, 'rep_dir': rep_dir, 'out_file': out_file, 'returncode': None, 'timed_out': False}
+    with open(os.path.join(rep_dir, 'fastdate.out'), 'w') as fastdate_out:
+        try:
+            process = instrument.run_subprocess('fastdate', args, cwd=rep_dir, stdout=fastdate_out,
+                                                stderr=subprocess.STDOUT, timeout=timeout)
+            ret['returncode'] = process.returncode
+        except subprocess.TimeoutExpired:
+            ret['timed_out'] = True
+    return ret
+
+
+def run_fastdate_replicates(subtree,
+                            prior_path,
+                            reps,
+                            max_age_est,
+                            run_dir,
+                            workers=None,
+                            timeout=None,
+                            seed=None):
+    """
+    Runs fastdate replicates in a pool of worker processes, each in its own scratch directory
+    under run_dir, so replicates and separate jobs never share files.
+
+    Inputs
+    ------
+    subtree: synth subtree, as a path to a newick file, dendropy tree or ArrayTree. It is parsed once,
+             and its polytomies are resolved at random for each replicate.
+    prior_path: node prior file, as written by write_fastdate_prior
+    reps: number of replicates
+    max_age_est: maximum root age
+    run_dir: directory for the replicate scratch directories
+    workers: number of replicates run at once. Defaults to fastdate_workers in config params, or the number of cpus.
+    timeout: seconds after which a replicate is stopped. Defaults to fastdate_timeout in config params, or no limit.
+    seed: replicate i resolves polytomies with random seed seed + i, so runs can be repeated.
+          Default None, picks a seed at random.
+
+    Returns
+    -------
+    A list, in replicate order, of {'rep':, 'seed':, 'rep_dir':, 'out_file':, 'returncode':, 'timed_out':}
+    """
+    if workers is None:
+        workers = int(config.get('params', 'fastdate_workers', fallback=str(os.cpu_count() or 1)))
+    if timeout is None and config.get('params', 'fastdate_timeout', fallback=None):
+        timeout = float(config.get('params', 'fastdate_timeout'))
+    if seed is None:
+        seed = random.randrange(2**32)
+    tree = _as_array_tree(subtree)
+    results = []
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max(1, min(workers, reps)),
+                                                initializer=_set_replicate_tree,
+                                                initargs=(tree,)) as pool:
+        futures = [pool.submit(instrument.collected,
+                               _fastdate_replicate,
+                               i,
+                               os.path.abspath(prior_path),
+                               max_age_est,
+                               os.path.abspath(run_dir),
+                               timeout,
+                               seed + i) for i in range(reps)]
+        for fut in futures:
+            res, records = fut.result()
+            instrument.metrics.extend(records)
+            results.append(res)
+    for res in results:
+        if res['timed_out']:
+            sys.stderr.write("fastdate replicate {} timed out after {} seconds\n".format(res['rep'], timeout))
+        elif res['returncode'] != 0:
+            sys.stderr.write("fastdate replicate {} failed with exit code {}, see {}\n".format(res['rep'],
+                                                                                          res['returncode'],
+                                                                                          os.path.join(res['rep_dir'], 'fastdate.out')))
+    return results
+
 
 def date_synth_subtree(node_id,
                        reps,
                        max_age=None,
                        summary='sumtre.tre',
-                       phylo_only=False):
+                       phylo_only=False,
+                       workers=None,
+                       timeout=None,
+                       run_dir=None,
+                       seed=None,
+                       quantiles=None,
+                       metrics_out=None,
+                       synth_tree=None):
     """
     Takes a synth subtree subtenting from node_id and assigns dates using fastdate.
     Inputs
@@ -503,34 +1759,71 @@ def date_synth_subtree(node_id,
     max_age: maximum age for root node. Default None - will be estimated from data if avail, but is required input if no data
     phylo_only: Prune to only synth tips with phylogenetic information (default False)
     summary: Output. deafult sumtre.tre
+             The subtree with edge lengths from the mean age of each node over the runs,
+             and the mean, variance and any quantiles of each node's age in newick comments.
+    workers: number of fastdate runs at once. Defaults to fastdate_workers in config params, or the number of cpus.
+    timeout: seconds after which a fastdate run is stopped. Defaults to fastdate_timeout in config params, or no limit.
+    run_dir: directory for the subtree, priors and one scratch directory per run.
+             Default None, makes a new directory in the current working directory.
+    seed: random seed for the first run's polytomy resolution, run i uses seed + i. Default None, picks one at random.
+    quantiles: optional list of node age quantiles to add to the summary, e.g. [0.025, 0.5, 0.975]
+    metrics_out: path to dump the run's timings, API calls and fastdate runs to as JSON,
+                 defaults to metrics_file in config paths, if set.
+    synth_tree: local labelled_supertree.tre or grafted_solution.tre to take the subtree from,
+                defaults to synth_tree in config paths, if set, otherwise the subtree is fetched from the API.
+                See synth_subtree_newick.
     """
+    if metrics_out is None:
+        metrics_out = config.get('paths', 'metrics_file', fallback=None)
+    with instrument.run(metrics_out):
+        return _date_synth_subtree(node_id, reps, max_age, summary, phylo_only, workers, timeout, run_dir, seed,
+                                   quantiles, synth_tree)
+
+
+def _date_synth_subtree(node_id, reps, max_age, summary, phylo_only, workers, timeout, run_dir, seed, quantiles,
+                        synth_tree):
     dates = build_synth_node_source_ages(ultrametricity_precision=0.01)
+    root_stats = node_summary(dates).get(node_id)
     if max_age:
-        max_age_est = max_age
-    elif node_id in dates['node_ages']:
-        max_age_est = max([source['age'] for source in dates['node_ages'][node_id]]) * 1.25
+        max_age_est = float(max_age)
+    elif root_stats:
+        max_age_est = root_stats['max'] * 1.25
     else:
-        sys.stderr.write("ERROR: no age estimate for root - please provide max root age using --max_age")
+        sys.stderr.write("ERROR: no age estimate for root - please provide max root age using --max_age\n")
         return None
 
-    output = OT.synth_subtree(node_id=node_id, label_format='id')
-    subtree = dendropy.Tree.get_from_string(output.response_dict['newick'], schema='newick')
+    subtree = dendropy.Tree.get_from_string(synth_subtree_newick(node_id, synth_tree=synth_tree), schema='newick')
     sys.stdout.write("{} leaves in tree\n".format(len(subtree)))
     if phylo_only:
         subtree = prune_to_phylo_only(subtree)
         sys.stdout.write("{} phylo informed leaves in tree\n".format(len(subtree)))
-    subtree.write(path="unresolved.tre", schema="newick")
+    if run_dir is None:
+        run_dir = tempfile.mkdtemp(prefix='fastdate_{}_'.format(node_id), dir=os.getcwd())
+    elif not os.path.exists(run_dir):
+        os.makedirs(run_dir)
+    unresolved_path = os.path.join(run_dir, "unresolved.tre")
+    subtree.write(path=unresolved_path, schema="newick")
 
-    pr = write_fastdate_prior(subtree, dates, var_mult=0.1, outputfile='node_prior.txt')
+    pr = write_fastdate_prior(subtree, dates, var_mult=0.1, outputfile=os.path.join(run_dir, 'node_prior.txt'))
     if pr:
-        for i in range(int(reps)):
-            write_fastdate_tree("unresolved.tre", br_len=0.01, polytomy_br=0.001, outputfile='fastdate_input{}.tre'.format(i))
-            os.system("fastdate --method_nodeprior --tree_file fastdate_input{}.tre --prior_file node_prior.txt --out_file node_prior{}.tre --max_age {} --bd_rho 1 --grid {} > fastdate.out".format(i,
-                                                                                                                                                                                                     i,
-                                                                                                                                                                                                     max_age_est,
-                                                                                                                                                                                                     max_age_est*2))
-
-        os.system("sumtrees.py --set-edges=mean-age --summarize-node-ages node_prior*.tre > {}".format(summary))
+        if seed is None:
+            seed = random.randrange(2**32)
+        results = run_fastdate_replicates(subtree,
+                                          pr,
+                                          int(reps),
+                                          max_age_est,
+                                          run_dir,
+                                          workers=workers,
+                                          timeout=timeout,
+                                          seed=seed)
+        dated = [res['out_file'] for res in results if res['returncode'] == 0]
+        sys.stdout.write("{} of {} fastdate runs succeeded with seeds from {}, outputs in {}\n".format(len(dated),
+                                                                                                   len(results),
+                                                                                                   seed,
+                                                                                                   run_dir))
+        if not dated:
+            return None
+        with instrument.stage('summarize'):
+            summarize_replicates(subtree, dated, outputfile=summary, quantiles=quantiles)
         return summary
     return None
-
@@ -0,0 +1,199 @@
+"""Conflict of source trees with a local copy of the synth tree, as reported by the conflict_info web service"""
+#!/usr/bin/env python3
+import numpy as np
+
+from chronosynth import synth_index
+from chronosynth.arraytree import ArrayTree, _chain_rank, _level_groups
+
+
+def _accumulate(parent, values, ufunc=np.add):
+    """Folds values up a preorder parent array with ufunc, so each node holds the result over its subtree"""
+    for level in reversed(_level_groups(_chain_rank(parent))[1:]):
+        ufunc.at(values, parent[level], values[level])
+    return values
+
+
+def _nexson_tree(nexson, tree_id):
+    """(tree set, tree) dicts of tree_id in a NexSON study"""
+    for tree_set in nexson['nexml'].get('treesById', {}).values():
+        tree_obj = tree_set.get('treeById', {}).get(tree_id)
+        if tree_obj:
+            return tree_set, tree_obj
+    raise KeyError('Tree with id "{}" not found in NexSON'.format(tree_id))
+
+
+def nexson_tip_ottids(nexson, tree_id):
+    """{node id: ott id} of the tips of a NexSON tree whose otus are mapped to OTT"""
+    tree_set, tree_obj = _nexson_tree(nexson, tree_id)
+    otus = nexson['nexml']['otusById'][tree_set['@otus']]['otuById']
+    ottids = {}
+    for node_id, node in tree_obj['nodeById'].items():
+        otu = otus.get(node.get('@otu'), {})
+        if otu.get('^ot:ottId') is not None:
+            ottids[node_id] = int(otu['^ot:ottId'])
+    return ottids
+
+
+def clade(tree, i):
+    """The subtree of an ArrayTree below node i, as an ArrayTree"""
+    size = _accumulate(tree.parent, np.ones(len(tree), dtype=np.int64))
+    end = i + size[i]
+    parent = tree.parent[i:end] - i
+    parent[0] = -1
+    return ArrayTree(tree.labels[i:end], parent, tree.edge_length[i:end], tree.annotations)
+
+
+class SynthConflict(object):
+    """
+    The synth tree held as preorder arrays (see synth_index.read_tree_nodes), to compare source trees with it
+    locally rather than through the conflict_info web service.
+
+    For each source tree, the synth tree is induced on the synth nodes of its tips: those nodes plus
+    the MRCAs of every pair of them. Clades of both trees are then hashed as sums of random 64 bit tip
+    hashes (as in arraytree.clade_hashes), so a source node is supported when its hash is a clade hash of
+    the induced tree. Only the unsupported nodes are checked against the children of their synth MRCA.
+
+    synth_tree: path to labelled_supertree.tre, whose nodes are all labelled with their node ids.
+    """
+    def __init__(self, synth_tree, seed=1):
+        nodes = synth_index.read_tree_nodes(synth_tree)
+        self.synth_tree = synth_tree
+        self.seed = seed
+        self.parent = nodes['parent']
+        self.key = nodes['key']
+        self.size = _accumulate(self.parent, np.ones(len(self.parent), dtype=np.int64))
+        self._key_order = np.argsort(self.key, kind='stable')
+        self._sorted_keys = self.key[self._key_order]
+
+    def __len__(self):
+        return len(self.parent)
+
+    def node_index(self, node_ids):
+        """Preorder index of each synth node id, -1 where it is not in the tree"""
+        keys = np.array([synth_index.node_key(node_id) or 0 for node_id in node_ids], dtype=np.uint64)
+        pos = np.minimum(np.searchsorted(self._sorted_keys, keys), len(self._sorted_keys) - 1)
+        return np.where(self._sorted_keys[pos] == keys, self._key_order[pos], -1)
+
+    def node_id(self, i):
+        """Synth node id of the node at preorder index i, None if it is unlabelled"""
+        if self.key[i] == synth_index.NO_KEY:
+            return None
+        return synth_index.node_id_of_key(self.key[i])
+
+    def lca(self, u, v):
+        """Most recent common ancestors of the node index arrays u and v, climbing from u until v is below"""
+        anc = np.array(u, dtype=np.int64)
+        v = np.asarray(v, dtype=np.int64)
+        climb = np.flatnonzero((v < anc) | (v >= anc + self.size[anc]))
+        while len(climb):
+            anc[climb] = self.parent[anc[climb]]
+            up = anc[climb]
+            climb = climb[(v[climb] < up) | (v[climb] >= up + self.size[up])]
+        return anc
+
+    def induced(self, leaves):
+        """
+        Synth tree induced on sorted leaves, none of which is above another.
+        Returns (nodes, parent): its synth node indices in preorder, and its own parent array.
+        """
+        nodes = np.unique(np.concatenate([leaves, self.lca(leaves[:-1], leaves[1:])]))
+        # In an LCA closed set in preorder, the parent of a node is its LCA with the node before
+        parent = np.concatenate([[-1], np.searchsorted(nodes, self.lca(nodes[:-1], nodes[1:]))])
+        return nodes, parent
+
+    def conflict(self, tree, tip_ottids):
+        """
+        Conflict statuses of the nodes of a source tree, like the response of the conflict_info web service:
+        {node label: {'status': status, 'witness': synth node id}}, where status is
+        - 'terminal' for tips, witnessed by their synth node
+        - 'supported_by' for nodes whose tips form a synth clade, witnessed by its MRCA
+        - 'partial_path_of' for nodes above a supported one with the same synth tips
+        - 'resolved_by' for nodes compatible with the synth tree but not in it, witnessed by the
+          synth polytomy they resolve
+        - 'conflicts_with' for nodes incompatible with the synth tree, witnessed by a conflicting synth node.
+        Tips are mapped to the synth node of their taxon; tips whose taxon is not in the synth tree,
+        is shared with an earlier tip or contains another tip's taxon are left out, as are the root
+        and nodes with fewer than two mapped tips.
+
+        tree: ArrayTree of the source tree
+        tip_ottids: {label: ott id} of its mapped tips
+        """
+        internal = tree.is_internal()
+        tips = [i for i in np.flatnonzero(~internal).tolist() if tree.labels[i] in tip_ottids]
+        synth_node = np.full(len(tree), -1, dtype=np.int64)
+        if tips:
+            synth_node[tips] = self.node_index(['ott{}'.format(tip_ottids[tree.labels[i]]) for i in tips])
+        mapped = np.flatnonzero(synth_node >= 0)
+        leaves, first = np.unique(synth_node[mapped], return_index=True)
+        nested = np.append(leaves[:-1] + self.size[leaves[:-1]] > leaves[1:], False)
+        leaves, kept = leaves[~nested], mapped[first[~nested]]
+        synth_node[:] = -1
+        synth_node[kept] = leaves
+        conf = {tree.labels[i]: {'status': 'terminal', 'witness': self.node_id(synth_node[i])} for i in kept.tolist()}
+        if len(leaves) < 2:
+            return conf
+
+        rng = np.random.default_rng(self.seed)
+        leaf_hash = rng.integers(0, np.iinfo(np.uint64).max, size=len(leaves), dtype=np.uint64, endpoint=True)
+        nodes, parent = self.induced(leaves)
+        leaf_pos = np.searchsorted(nodes, leaves)
+        induced_hash = np.zeros(len(nodes), dtype=np.uint64)
+        induced_hash[leaf_pos] = leaf_hash
+        induced_hash = _accumulate(parent, induced_hash)
+        induced_count = np.zeros(len(nodes), dtype=np.int64)
+        induced_count[leaf_pos] = 1
+        induced_count = _accumulate(parent, induced_count)
+        clades = dict(zip(induced_hash.tolist(), nodes.tolist()))
+
+        source_hash = np.zeros(len(tree), dtype=np.uint64)
+        source_hash[kept] = leaf_hash[np.searchsorted(leaves, synth_node[kept])]
+        source_hash = _accumulate(tree.parent, source_hash)
+        count = np.zeros(len(tree), dtype=np.int64)
+        count[kept] = 1
+        count = _accumulate(tree.parent, count)
+        size = _accumulate(tree.parent, np.ones(len(tree), dtype=np.int64))
+        # Mapped tips in preorder span the synth MRCA from their first to last synth node
+        first_leaf = _accumulate(tree.parent, np.where(synth_node >= 0, synth_node, len(self)), np.minimum)
+        last_leaf = _accumulate(tree.parent, synth_node.copy(), np.maximum)
+
+        # A node with a child of the same count is above it on a path, and takes its status from it
+        same_below = np.full(len(tree), -1, dtype=np.int64)
+        same = np.flatnonzero(count[1:] == count[tree.parent[1:]]) + 1
+        same_below[tree.parent[same]] = same
+        ranked = np.flatnonzero(internal & (count >= 2) & (same_below < 0))
+        ranked = ranked[ranked > 0]
+        unsupported = [i for i in ranked.tolist() if source_hash[i].item() not in clades]
+        mrca = dict(zip(unsupported, self.lca(first_leaf[unsupported], last_leaf[unsupported]).tolist()))
+        children = {}
+        for child, par in enumerate(parent.tolist()):
+            children.setdefault(par, []).append(child)
+        for i in ranked.tolist():
+            label = tree.labels[i]
+            if i not in mrca:
+                conf[label] = {'status': 'supported_by', 'witness': self.node_id(clades[source_hash[i].item()])}
+                continue
+            kids = np.array(children[np.searchsorted(nodes, mrca[i])])
+            tip_nodes = synth_node[i:i + size[i]]
+            tip_nodes = tip_nodes[tip_nodes >= 0]
+            # Count the node's tips below each child of the synth MRCA
+            hits = np.bincount(np.searchsorted(nodes[kids], tip_nodes, side='right') - 1, minlength=len(kids))
+            partial = np.flatnonzero((hits > 0) & (hits < induced_count[kids]))
+            if len(partial):
+                conf[label] = {'status': 'conflicts_with', 'witness': self.node_id(nodes[kids[partial[0]]])}
+            else:
+                conf[label] = {'status': 'resolved_by', 'witness': self.node_id(mrca[i])}
+        for i in reversed(np.flatnonzero(internal & (count >= 2) & (same_below >= 0)).tolist()):
+            if i == 0:
+                continue
+            below = conf[tree.labels[same_below[i]]]
+            status = 'partial_path_of' if below['status'] == 'supported_by' else below['status']
+            conf[tree.labels[i]] = {'status': status, 'witness': below['witness']}
+        return conf
+
+    def nexson_conflict(self, nexson, tree_id):
+        """Conflict statuses of the ingroup of a NexSON tree, see conflict"""
+        tree = ArrayTree.from_nexson(nexson, tree_id)
+        ingroup = _nexson_tree(nexson, tree_id)[1].get('^ot:inGroupClade')
+        if ingroup in tree.labels:
+            tree = clade(tree, tree.labels.index(ingroup))
+        return self.conflict(tree, nexson_tip_ottids(nexson, tree_id))
@@ -0,0 +1,213 @@
+"""Timings and counts for the stages, API calls and subprocesses of a chronosynth run"""
+#!/usr/bin/env python3
+import os
+import sys
+import json
+import time
+import logging
+import threading
+import contextlib
+import subprocess
+
+log = logging.getLogger(__name__)
+# Each record is logged below DEBUG, on its own logger, so only asking for it shows them
+record_log = logging.getLogger(__name__ + '.records')
+RECORD_LEVEL = 5
+
+
+class Metrics(object):
+    """
+    Thread safe record of a run.
+    Records are only kept while active, i.e. inside run or collected, so calls made
+    outside a run don't pile up.
+
+    stages: [{'stage': name, 'source_id': source_id or None, 'seconds': seconds}]
+    api_calls: [{'method': name, 'seconds': seconds, 'bytes': response size or None, 'status': status code or None}]
+    subprocesses: [{'command': name, 'seconds': seconds, 'returncode': returncode}]
+    """
+    kinds = ('stages', 'api_calls', 'subprocesses')
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.active = 0
+        self.reset()
+        # A worker process forked while a thread held the lock would otherwise never get it
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._new_lock)
+
+    def _new_lock(self):
+        self._lock = threading.Lock()
+
+    def reset(self):
+        with self._lock:
+            self.records = {kind: [] for kind in self.kinds}
+
+    def add(self, kind, **record):
+        record_log.log(RECORD_LEVEL, "%s %s", kind, record)
+        if not self.active:
+            return
+        with self._lock:
+            self.records[kind].append(record)
+
+    def mark(self):
+        """Position to pass to records_since"""
+        return {kind: len(self.records[kind]) for kind in self.kinds}
+
+    def records_since(self, mark):
+        """Records added since mark, e.g. to send them back from a worker process"""
+        with self._lock:
+            return {kind: self.records[kind][mark[kind]:] for kind in self.kinds}
+
+    def extend(self, records):
+        """Adds records collected elsewhere, e.g. by a worker process"""
+        with self._lock:
+            for kind in self.kinds:
+                self.records[kind].extend(records.get(kind, []))
+
+    def summary(self):
+        """
+        Totals by stage, API method and subprocess:
+        {kind: {name: {'count':, 'seconds':, 'max_seconds':, ...}}}
+        API methods also have 'bytes' and 'failed', subprocesses 'failed'.
+        """
+        ret = {}
+        with self._lock:
+            for kind, name_key in (('stages', 'stage'), ('api_calls', 'method'), ('subprocesses', 'command')):
+                totals = {}
+                for record in self.records[kind]:
+                    total = totals.setdefault(record[name_key], {'count': 0, 'seconds': 0.0, 'max_seconds': 0.0})
+                    total['count'] += 1
+                    total['seconds'] += record['seconds']
+                    total['max_seconds'] = max(total['max_seconds'], record['seconds'])
+                    if kind == 'api_calls':
+                        total['bytes'] = total.get('bytes', 0) + (record['bytes'] or 0)
+                        total['failed'] = total.get('failed', 0) + (record['status'] not in (None, 200))
+                    if kind == 'subprocesses':
+                        total['failed'] = total.get('failed', 0) + (record['returncode'] != 0)
+                ret[kind] = totals
+        return ret
+
+    def report(self):
+        """Human readable summary table"""
+        summary = self.summary()
+        lines = []
+        for kind, title in (('stages', 'stage'), ('api_calls', 'API call'), ('subprocesses', 'subprocess')):
+            if not summary[kind]:
+                continue
+            lines.append("{:<30} {:>7} {:>10} {:>10} {:>12}".format(title, 'count', 'seconds', 'max', 'bytes'))
+            for name, total in sorted(summary[kind].items(), key=lambda item: -item[1]['seconds']):
+                size = total.get('bytes', '')
+                lines.append("{:<30} {:>7} {:>10.3f} {:>10.3f} {:>12}".format(name, total['count'], total['seconds'],
+                                                                            total['max_seconds'], size))
+        return '\n'.join(lines) + '\n'
+
+    def dump(self, path):
+        """Writes the summary and all records as JSON"""
+        with self._lock:
+            records = {kind: list(self.records[kind]) for kind in self.kinds}
+        with open(path, 'w') as out:
+            json.dump({'summary': self.summary(), 'records': records}, out, indent=2)
+
+
+metrics = Metrics()
+
+_run_depth = 0
+
+
+@contextlib.contextmanager
+def run(metrics_out=None, out=None, report=True):
+    """
+    Brackets a top level run, e.g. a rebuild of the node ages, during which metrics are recorded.
+    The outermost run clears the metrics on entry. On exit, if report is True it writes the report
+    to out (default stdout), and if metrics_out is a path, it dumps the metrics there as JSON.
+    report: False for point lookups, whose callers don't want a table for every query.
+    Nested runs do nothing, so a run calling another gives one report.
+    """
+    global _run_depth
+    if _run_depth == 0:
+        metrics.reset()
+    _run_depth += 1
+    metrics.active += 1
+    try:
+        yield metrics
+    finally:
+        metrics.active -= 1
+        _run_depth -= 1
+        if _run_depth == 0:
+            if report:
+                (out or sys.stdout).write(metrics.report())
+            if metrics_out:
+                metrics.dump(metrics_out)
+
+
+@contextlib.contextmanager
+def stage(name, source_id=None):
+    """Times a pipeline stage, optionally for one source"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics.add('stages', stage=name, source_id=source_id, seconds=time.perf_counter() - start)
+
+
+def collected(func, *args, **kwargs):
+    """
+    Calls func, and returns (result, the records it added).
+    Used to bring back the records of calls run in worker processes, see Metrics.extend.
+    """
+    mark = metrics.mark()
+    metrics.active += 1
+    try:
+        result = func(*args, **kwargs)
+    finally:
+        metrics.active -= 1
+    return result, metrics.records_since(mark)
+
+
+def _response_size(resp):
+    response = getattr(resp, 'response', None)
+    content = getattr(response, 'content', None)
+    if content is None:
+        return None
+    return len(content)
+
+
+class InstrumentedOT(object):
+    """
+    Wraps an opentree OT object, recording the duration, response size and
+    status code of each method call. Other attributes are passed through.
+    """
+    def __init__(self, ot):
+        self.ot = ot
+
+    def __getattr__(self, name):
+        attr = getattr(self.ot, name)
+        if name.startswith('_') or not callable(attr):
+            return attr
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            resp = None
+            try:
+                resp = attr(*args, **kwargs)
+                return resp
+            finally:
+                metrics.add('api_calls',
+                            method=name,
+                            seconds=time.perf_counter() - start,
+                            bytes=_response_size(resp),
+                            status=getattr(resp, 'status_code', None))
+        return timed
+
+
+def run_subprocess(name, args, **kwargs):
+    """
+    subprocess.run, timed and recorded under name. Returns the CompletedProcess.
+    """
+    start = time.perf_counter()
+    returncode = None
+    try:
+        completed = subprocess.run(args, **kwargs)
+        returncode = completed.returncode
+        return completed
+    finally:
+        metrics.add('subprocesses', command=name, seconds=time.perf_counter() - start, returncode=returncode)
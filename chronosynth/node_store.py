@@ -0,0 +1,707 @@
+"""Indexed on-disk stores of synth node ages, per-source mappings and the phylesystem tree catalog"""
+#!/usr/bin/env python3
+import os
+import json
+import array
+import zlib
+import sqlite3
+from collections.abc import Mapping
+
+import numpy as np
+
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS metadata (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS node_ages (synth_node TEXT NOT NULL,
+                                      source_id TEXT NOT NULL,
+                                      study_id TEXT NOT NULL,
+                                      source_node TEXT,
+                                      age REAL);
+CREATE INDEX IF NOT EXISTS node_ages_synth_node ON node_ages (synth_node);
+CREATE INDEX IF NOT EXISTS node_ages_source_id ON node_ages (source_id);
+CREATE INDEX IF NOT EXISTS node_ages_study_id ON node_ages (study_id);
+CREATE TABLE IF NOT EXISTS node_summary (synth_node TEXT PRIMARY KEY,
+                                         n INTEGER,
+                                         min REAL,
+                                         max REAL,
+                                         mean REAL,
+                                         median REAL,
+                                         variance REAL);
+"""
+
+SUMMARY_FIELDS = ('n', 'min', 'max', 'mean', 'median', 'variance')
+
+
+def _summarize_groups(synth_nodes, group, ages):
+    """
+    Summary of ages grouped by index into synth_nodes, see summarize_node_ages.
+    group: int array of the synth node index of each age
+    """
+    keep = ~np.isnan(ages)
+    group, ages = group[keep], ages[keep]
+    if not len(ages):
+        return {}
+    order = np.lexsort((ages, group))
+    group, ages = group[order], ages[order]
+    starts = np.flatnonzero(np.concatenate([[True], group[1:] != group[:-1]]))
+    counts = np.diff(np.append(starts, len(ages)))
+    mean = np.add.reduceat(ages, starts) / counts
+    deviation = ages - np.repeat(mean, counts)
+    m2 = np.add.reduceat(deviation * deviation, starts)
+    columns = zip(counts.tolist(),
+                  ages[starts].tolist(),
+                  ages[starts + counts - 1].tolist(),
+                  mean.tolist(),
+                  ((ages[starts + (counts - 1) // 2] + ages[starts + counts // 2]) / 2).tolist(),
+                  np.where(counts > 1, m2 / np.maximum(counts - 1, 1), np.nan).tolist())
+    summary = {}
+    for i, row in zip(group[starts].tolist(), columns):
+        stats = dict(zip(SUMMARY_FIELDS, row))
+        if stats['n'] < 2:
+            stats['variance'] = None
+        summary[synth_nodes[i]] = stats
+    return summary
+
+
+def summarize_node_ages(node_ages):
+    """
+    Per synth node summary of the ages in a 'node_ages' dict as output by combine_ages_from_sources,
+    or a NodeAgeTable, computed over all nodes at once on flat arrays.
+    Entries without an age are skipped.
+
+    Returns
+    -------
+    {synth_node: {'n':, 'min':, 'max':, 'mean':, 'median':, 'variance':}}
+    variance is the sample variance, as statistics.variance, and None for single ages
+    """
+    if isinstance(node_ages, NodeAgeTable):
+        return node_ages.summary()
+    synth_nodes = []
+    group = []
+    ages = []
+    for i, synth_node in enumerate(node_ages):
+        synth_nodes.append(synth_node)
+        for entry in node_ages[synth_node]:
+            group.append(i)
+            ages.append(np.nan if entry['age'] is None else float(entry['age']))
+    return _summarize_groups(synth_nodes, np.array(group, dtype=np.int64), np.array(ages, dtype=np.float64))
+
+
+def _pack_strings(strings):
+    """Strings as one utf-8 byte array, for saving without pickle"""
+    joined = '\0'.join(strings)
+    assert len(strings) == 0 or joined.count('\0') == len(strings) - 1, "strings can't hold NUL"
+    return np.frombuffer(joined.encode('utf-8'), dtype=np.uint8), len(strings)
+
+
+def _unpack_strings(packed, count):
+    if count == 0:
+        return []
+    return packed.tobytes().decode('utf-8').split('\0')
+
+
+class NodeAgeTable(Mapping):
+    """
+    Compact columnar form of the 'node_ages' of combine_ages_from_sources.
+
+    Synth node ids, source ids and source node labels are each stored once, in tables,
+    and each age entry is three int32 indices into them and a float64 age (nan for no age),
+    sorted by synth node, so a lookup is a slice.
+    It reads like the dict it replaces: table[synth_node] is the list of
+    {'source_id':, 'age':, 'source_node':} entries, built on each lookup.
+    Saves to and loads from an .npz file, see write_node_age_table.
+    """
+    def __init__(self, synth_nodes, source_ids, source_nodes, node_index, source_index, source_node_index, age):
+        self.synth_nodes = list(synth_nodes)
+        self.source_ids = list(source_ids)
+        self.source_nodes = list(source_nodes)
+        order = np.argsort(np.asarray(node_index, dtype=np.int32), kind='stable')
+        self.node_index = np.asarray(node_index, dtype=np.int32)[order]
+        self.source_index = np.asarray(source_index, dtype=np.int32)[order]
+        self.source_node_index = np.asarray(source_node_index, dtype=np.int32)[order]
+        self.age = np.asarray(age, dtype=np.float64)[order]
+        self.offsets = np.searchsorted(self.node_index, np.arange(len(self.synth_nodes) + 1))
+        self._position = {synth_node: i for i, synth_node in enumerate(self.synth_nodes)}
+
+    @classmethod
+    def from_dict(cls, node_ages):
+        """Table from a 'node_ages' dict"""
+        builder = NodeAgeTableBuilder()
+        for synth_node in node_ages:
+            for entry in node_ages[synth_node]:
+                builder.add(synth_node, entry['source_id'], entry['age'], entry['source_node'])
+        return builder.build()
+
+    def __getitem__(self, synth_node):
+        i = self._position[synth_node]
+        entries = slice(self.offsets[i], self.offsets[i + 1])
+        return [{'source_id': self.source_ids[source],
+                 'age': None if age != age else age,
+                 'source_node': self.source_nodes[source_node]}
+                for source, age, source_node in zip(self.source_index[entries].tolist(),
+                                                    self.age[entries].tolist(),
+                                                    self.source_node_index[entries].tolist())]
+
+    def __contains__(self, synth_node):
+        return synth_node in self._position
+
+    def __iter__(self):
+        return iter(self.synth_nodes)
+
+    def __len__(self):
+        return len(self.synth_nodes)
+
+    def rows(self):
+        """(synth_node, source_id, source_node, age) for every entry, grouped by synth node"""
+        for node, source, source_node, age in zip(self.node_index.tolist(),
+                                                  self.source_index.tolist(),
+                                                  self.source_node_index.tolist(),
+                                                  self.age.tolist()):
+            yield (self.synth_nodes[node], self.source_ids[source], self.source_nodes[source_node],
+                   None if age != age else age)
+
+    def summary(self):
+        """Per synth node age summary, see summarize_node_ages"""
+        return _summarize_groups(self.synth_nodes, self.node_index, self.age)
+
+    def to_dict(self):
+        """The plain 'node_ages' dict, e.g. for JSON"""
+        return {synth_node: self[synth_node] for synth_node in self.synth_nodes}
+
+    def save(self, path, metadata=None):
+        """Writes the table, and optional JSON metadata, as an uncompressed .npz"""
+        arrays = {'node_index': self.node_index,
+                  'source_index': self.source_index,
+                  'source_node_index': self.source_node_index,
+                  'age': self.age,
+                  'metadata': np.frombuffer(json.dumps(metadata or {}).encode('utf-8'), dtype=np.uint8)}
+        for name in ('synth_nodes', 'source_ids', 'source_nodes'):
+            arrays[name], arrays[name + '_count'] = _pack_strings(getattr(self, name))
+        tmp_path = '{}.{}.tmp.npz'.format(path[:-4] if path.endswith('.npz') else path, os.getpid())
+        np.savez(tmp_path, **arrays)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        """(table, metadata) from a file written by save"""
+        with np.load(path, allow_pickle=False) as saved:
+            strings = {name: _unpack_strings(saved[name], int(saved[name + '_count']))
+                       for name in ('synth_nodes', 'source_ids', 'source_nodes')}
+            table = cls(strings['synth_nodes'], strings['source_ids'], strings['source_nodes'],
+                        saved['node_index'], saved['source_index'], saved['source_node_index'], saved['age'])
+            metadata = json.loads(saved['metadata'].tobytes().decode('utf-8'))
+        return table, metadata
+
+
+class NodeAgeTableBuilder(object):
+    """Collects age entries one at a time into growing int and float arrays, for a NodeAgeTable"""
+    def __init__(self):
+        self._tables = ({}, {}, {})
+        self._indices = (array.array('i'), array.array('i'), array.array('i'))
+        self._age = array.array('d')
+
+    def add(self, synth_node, source_id, age, source_node):
+        for table, indices, value in zip(self._tables, self._indices, (synth_node, source_id, source_node)):
+            indices.append(table.setdefault(value, len(table)))
+        self._age.append(np.nan if age is None else float(age))
+
+    def build(self):
+        synth_nodes, source_ids, source_nodes = (list(table) for table in self._tables)
+        node_index, source_index, source_node_index = (np.frombuffer(indices, dtype=np.int32) if len(indices)
+                                                       else np.zeros(0, dtype=np.int32)
+                                                       for indices in self._indices)
+        age = np.frombuffer(self._age, dtype=np.float64) if len(self._age) else np.zeros(0)
+        return NodeAgeTable(synth_nodes, source_ids, source_nodes, node_index, source_index, source_node_index, age)
+
+
+def write_node_age_table(synth_node_ages, path):
+    """
+    Writes a combine_ages_from_sources style dictionary as an .npz NodeAgeTable,
+    which loads many times faster than the same ages as JSON.
+    """
+    node_ages = synth_node_ages['node_ages']
+    if not isinstance(node_ages, NodeAgeTable):
+        node_ages = NodeAgeTable.from_dict(node_ages)
+    node_ages.save(path, synth_node_ages.get('metadata'))
+    return path
+
+
+def read_node_age_table(path):
+    """
+    Reads a file written by write_node_age_table, as a combine_ages_from_sources style dictionary
+    with a NodeAgeTable for 'node_ages'
+    """
+    node_ages, metadata = NodeAgeTable.load(path)
+    return {'metadata': metadata, 'node_ages': node_ages, 'node_summary': node_ages.summary()}
+
+
+class NodeAgesView(Mapping):
+    """
+    Read only mapping of synth node id to its list of age entries,
+    [{'source_id': source_id, 'age': age, 'source_node': source_node}, ...]
+    Each lookup is one indexed query, so nothing is held in memory.
+    """
+    def __init__(self, store):
+        self._store = store
+
+    def __getitem__(self, synth_node):
+        entries = self._store.node_ages(synth_node)
+        if not entries:
+            raise KeyError(synth_node)
+        return entries
+
+    def __contains__(self, synth_node):
+        cur = self._store.conn.execute("SELECT 1 FROM node_ages WHERE synth_node = ? LIMIT 1", (synth_node,))
+        return cur.fetchone() is not None
+
+    def __iter__(self):
+        cur = self._store.conn.execute("SELECT DISTINCT synth_node FROM node_ages ORDER BY synth_node")
+        for row in cur:
+            yield row[0]
+
+    def __len__(self):
+        cur = self._store.conn.execute("SELECT COUNT(DISTINCT synth_node) FROM node_ages")
+        return cur.fetchone()[0]
+
+
+class NodeSummaryView(Mapping):
+    """
+    Read only mapping of synth node id to the summary of its ages,
+    {'n':, 'min':, 'max':, 'mean':, 'median':, 'variance':}, see summarize_node_ages.
+    """
+    def __init__(self, store):
+        self._store = store
+
+    def __getitem__(self, synth_node):
+        cur = self._store.conn.execute("SELECT n, min, max, mean, median, variance FROM node_summary "
+                                       "WHERE synth_node = ?", (synth_node,))
+        row = cur.fetchone()
+        if row is None:
+            raise KeyError(synth_node)
+        return dict(zip(SUMMARY_FIELDS, row))
+
+    def __iter__(self):
+        cur = self._store.conn.execute("SELECT synth_node FROM node_summary ORDER BY synth_node")
+        for row in cur:
+            yield row[0]
+
+    def __len__(self):
+        cur = self._store.conn.execute("SELECT COUNT(*) FROM node_summary")
+        return cur.fetchone()[0]
+
+
+class SourceIndexView(Mapping):
+    """
+    Read only mapping of source id to the synth nodes it contributed to.
+    """
+    def __init__(self, store):
+        self._store = store
+
+    def __getitem__(self, source_id):
+        synth_nodes = self._store.source_nodes(source_id)
+        if not synth_nodes:
+            raise KeyError(source_id)
+        return synth_nodes
+
+    def __iter__(self):
+        return iter(self._store.sources())
+
+    def __len__(self):
+        cur = self._store.conn.execute("SELECT COUNT(DISTINCT source_id) FROM node_ages")
+        return cur.fetchone()[0]
+
+
+class NodeAgeStore(object):
+    """
+    SQLite store of combined node ages, indexed by synth node id and by source id,
+    with the build metadata stored alongside.
+
+    Can be used where the dictionary output by combine_ages_from_sources was used:
+    store['metadata'] is a dict, and store['node_ages'], store['node_summary'] and store['source_index']
+    are read only mappings that query the database on each lookup.
+    The node summaries are kept up to date as entries are added and removed.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self.conn.executescript(_SCHEMA)
+        # Stores written before summaries were kept
+        if self.conn.execute("SELECT 1 FROM node_summary LIMIT 1").fetchone() is None:
+            with self.conn:
+                self._summarize(None)
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __getitem__(self, key):
+        if key == 'metadata':
+            return self.metadata
+        if key == 'node_ages':
+            return NodeAgesView(self)
+        if key == 'node_summary':
+            return NodeSummaryView(self)
+        if key == 'source_index':
+            return SourceIndexView(self)
+        raise KeyError(key)
+
+    def keys(self):
+        return ['metadata', 'node_ages', 'node_summary']
+
+    @property
+    def metadata(self):
+        """The build metadata, e.g. synth_tree_about, date and phylesystem_sha"""
+        cur = self.conn.execute("SELECT key, value FROM metadata ORDER BY key")
+        return {key: json.loads(value) for key, value in cur}
+
+    def set_metadata(self, metadata):
+        """Replaces the build metadata"""
+        with self.conn:
+            self.conn.execute("DELETE FROM metadata")
+            self.conn.executemany("INSERT INTO metadata VALUES (?, ?)",
+                                  [(key, json.dumps(value)) for key, value in metadata.items()])
+
+    def node_ages(self, synth_node):
+        """List of age entries for a synth node, empty if it has no dates"""
+        cur = self.conn.execute("SELECT source_id, age, source_node FROM node_ages "
+                                "WHERE synth_node = ? ORDER BY rowid", (synth_node,))
+        return [{'source_id': source_id, 'age': age, 'source_node': source_node}
+                for source_id, age, source_node in cur]
+
+    def mean_ages(self):
+        """{synth_node: mean age}, from the node summaries"""
+        cur = self.conn.execute("SELECT synth_node, mean FROM node_summary")
+        return dict(cur.fetchall())
+
+    def sources(self):
+        """Source ids with at least one entry"""
+        cur = self.conn.execute("SELECT DISTINCT source_id FROM node_ages ORDER BY source_id")
+        return [row[0] for row in cur]
+
+    def source_nodes(self, source_id):
+        """Synth nodes a source contributed ages to"""
+        cur = self.conn.execute("SELECT synth_node FROM node_ages WHERE source_id = ? ORDER BY rowid",
+                                (source_id,))
+        return [row[0] for row in cur]
+
+    def add_node_ages(self, node_ages):
+        """
+        Appends entries from a 'node_ages' dict as output by combine_ages_from_sources
+        """
+        with self.conn:
+            self._insert(node_ages)
+            self._summarize(list(node_ages))
+
+    def remove_studies(self, study_ids):
+        """Deletes all entries contributed by trees in the given studies"""
+        with self.conn:
+            self._summarize(self._delete_studies(study_ids))
+
+    def replace_studies(self, study_ids, node_ages):
+        """
+        Deletes entries from the given studies and appends the new node_ages,
+        in one transaction so readers see either the old or the new entries.
+        """
+        with self.conn:
+            changed = self._delete_studies(study_ids)
+            self._insert(node_ages)
+            self._summarize(changed | set(node_ages))
+
+    def _insert(self, node_ages):
+        if isinstance(node_ages, NodeAgeTable):
+            self.conn.executemany("INSERT INTO node_ages VALUES (?, ?, ?, ?, ?)",
+                                  ((synth_node, source_id, source_id.split('@')[0], source_node, age)
+                                   for synth_node, source_id, source_node, age in node_ages.rows()))
+            return
+        rows = []
+        for synth_node in node_ages:
+            for entry in node_ages[synth_node]:
+                rows.append((synth_node,
+                             entry['source_id'],
+                             entry['source_id'].split('@')[0],
+                             entry['source_node'],
+                             entry['age']))
+        self.conn.executemany("INSERT INTO node_ages VALUES (?, ?, ?, ?, ?)", rows)
+
+    def _delete_studies(self, study_ids):
+        """Deletes the studies' entries, and returns the synth nodes they were for"""
+        changed = set()
+        for study_id in study_ids:
+            cur = self.conn.execute("SELECT DISTINCT synth_node FROM node_ages WHERE study_id = ?", (study_id,))
+            changed.update(row[0] for row in cur)
+        self.conn.executemany("DELETE FROM node_ages WHERE study_id = ?",
+                              [(study_id,) for study_id in study_ids])
+        return changed
+
+    def _summarize(self, synth_nodes):
+        """Recomputes the summaries of synth_nodes, or of all nodes if None"""
+        if synth_nodes is None:
+            self.conn.execute("DELETE FROM node_summary")
+            cur = self.conn.execute("SELECT synth_node, age FROM node_ages ORDER BY rowid")
+        else:
+            synth_nodes = list(synth_nodes)
+            self.conn.executemany("DELETE FROM node_summary WHERE synth_node = ?",
+                                  [(synth_node,) for synth_node in synth_nodes])
+            self.conn.execute("CREATE TEMP TABLE IF NOT EXISTS summarize (synth_node TEXT PRIMARY KEY)")
+            self.conn.execute("DELETE FROM summarize")
+            self.conn.executemany("INSERT OR IGNORE INTO summarize VALUES (?)",
+                                  [(synth_node,) for synth_node in synth_nodes])
+            cur = self.conn.execute("SELECT synth_node, age FROM node_ages "
+                                    "WHERE synth_node IN (SELECT synth_node FROM summarize) ORDER BY rowid")
+        node_ages = {}
+        for synth_node, age in cur:
+            node_ages.setdefault(synth_node, []).append({'age': age})
+        summary = summarize_node_ages(node_ages)
+        self.conn.executemany("INSERT INTO node_summary VALUES (?, ?, ?, ?, ?, ?, ?)",
+                              [(synth_node,) + tuple(stats[field] for field in SUMMARY_FIELDS)
+                               for synth_node, stats in summary.items()])
+
+    def to_dict(self):
+        """Loads the whole store as a combine_ages_from_sources style dictionary"""
+        node_ages = {}
+        cur = self.conn.execute("SELECT synth_node, source_id, age, source_node FROM node_ages ORDER BY rowid")
+        for synth_node, source_id, age, source_node in cur:
+            node_ages.setdefault(synth_node, []).append({'source_id': source_id,
+                                                         'age': age,
+                                                         'source_node': source_node})
+        return {'metadata': self.metadata, 'node_ages': node_ages}
+
+
+def write_node_age_store(synth_node_ages, path):
+    """
+    Writes a combine_ages_from_sources style dictionary to a new store at path.
+    The store is built next to path and moved into place, so readers never see a partial store.
+    Returns the opened NodeAgeStore.
+    """
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    store = NodeAgeStore(tmp_path)
+    store.set_metadata(synth_node_ages['metadata'])
+    store.add_node_ages(synth_node_ages['node_ages'])
+    store.close()
+    os.replace(tmp_path, path)
+    return NodeAgeStore(path)
+
+
+# Version argument of SourceMapCache.get that matches whatever version a record was made from
+ANY_VERSION = object()
+
+
+class SourceMapCache(object):
+    """
+    Consolidated cache of per-source results, one compressed JSON record per source id
+    in a single SQLite file. Writes are atomic, several processes can share the cache,
+    and lookups are indexed queries rather than one file per source.
+
+    Each record carries the versions of its inputs: the synth tree id, the commit
+    of the study in phylesystem and the ultrametricity precision its ages were estimated with,
+    and the phylesystem commit at which that study commit was last known to be current.
+    Lookups can ask for specific versions, and a record made from other inputs,
+    or from unknown ones, counts as missing.
+    Several caches can share a file by using different tables.
+    """
+    def __init__(self, path, table='source_maps', timeout=60):
+        self.path = path
+        self.table = table
+        self.conn = sqlite3.connect(path, timeout=timeout)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        with self.conn:
+            self.conn.execute("CREATE TABLE IF NOT EXISTS {} (source_id TEXT PRIMARY KEY, "
+                              "synth_id TEXT, study_sha TEXT, value BLOB, precision REAL, "
+                              "phylesystem_sha TEXT)".format(table))
+            columns = [row[1] for row in self.conn.execute("PRAGMA table_info({})".format(table))]
+            for column, column_type in (('synth_id', 'TEXT'), ('study_sha', 'TEXT'), ('precision', 'REAL'),
+                                        ('phylesystem_sha', 'TEXT')):
+                if column not in columns:
+                    self.conn.execute("ALTER TABLE {} ADD COLUMN {} {}".format(table, column, column_type))
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __contains__(self, source_id):
+        cur = self.conn.execute("SELECT 1 FROM {} WHERE source_id = ?".format(self.table), (source_id,))
+        return cur.fetchone() is not None
+
+    def __len__(self):
+        return self.conn.execute("SELECT COUNT(*) FROM {}".format(self.table)).fetchone()[0]
+
+    def get(self, source_id, synth_id=ANY_VERSION, study_sha=ANY_VERSION, precision=ANY_VERSION):
+        """
+        Cached result for a source, or None.
+        If synth_id, study_sha or precision are given, a result made from other versions is ignored.
+        A version given as None is unknown, so it never matches.
+        """
+        row = self.conn.execute("SELECT synth_id, study_sha, precision, value FROM {} "
+                                "WHERE source_id = ?".format(self.table), (source_id,)).fetchone()
+        if row is None:
+            return None
+        for wanted, cached in zip((synth_id, study_sha, precision), row[:3]):
+            if wanted is not ANY_VERSION and (wanted is None or wanted != cached):
+                return None
+        return _decode(row[3])
+
+    def get_many(self, source_ids):
+        """{source_id: cached result} for the source_ids in the cache"""
+        return {source_id: _decode(value) for source_id, value in self._select_many('value', source_ids)}
+
+    def versions(self, source_ids):
+        """{source_id: (synth_id, study_sha, precision, phylesystem_sha)} for the source_ids in the cache"""
+        return {row[0]: tuple(row[1:])
+                for row in self._select_many('synth_id, study_sha, precision, phylesystem_sha', source_ids)}
+
+    def _select_many(self, columns, source_ids):
+        source_ids = list(source_ids)
+        for i in range(0, len(source_ids), 500):
+            chunk = source_ids[i:i + 500]
+            cur = self.conn.execute("SELECT source_id, {} FROM {} WHERE source_id IN ({})".format(
+                columns, self.table, ','.join('?' * len(chunk))), chunk)
+            for row in cur:
+                yield row
+
+    def put(self, source_id, res, synth_id=None, study_sha=None, precision=None, phylesystem_sha=None):
+        """Stores the result for a source and the versions it was made from, replacing any earlier one"""
+        self.put_many({source_id: res}, synth_id=synth_id, study_shas={source_id: study_sha}, precision=precision,
+                      phylesystem_sha=phylesystem_sha)
+
+    def put_many(self, results, synth_id=None, study_shas=None, precision=None, phylesystem_sha=None):
+        """
+        Stores {source_id: result} in one transaction.
+        study_shas: optional {source_id: study_sha}
+        phylesystem_sha: the phylesystem commit the study commits were read at
+        """
+        if study_shas is None:
+            study_shas = {}
+        with self.conn:
+            self.conn.executemany("INSERT OR REPLACE INTO {} (source_id, synth_id, study_sha, value, precision, "
+                                  "phylesystem_sha) VALUES (?, ?, ?, ?, ?, ?)".format(self.table),
+                                  [(source_id, synth_id, study_shas.get(source_id), _encode(res), precision,
+                                    phylesystem_sha)
+                                   for source_id, res in results.items()])
+
+    def confirm(self, source_ids, phylesystem_sha):
+        """Records that the study commits of source_ids are still current at phylesystem commit phylesystem_sha"""
+        with self.conn:
+            self.conn.executemany("UPDATE {} SET phylesystem_sha = ? WHERE source_id = ?".format(self.table),
+                                  [(phylesystem_sha, source_id) for source_id in source_ids])
+
+    def delete(self, source_ids):
+        with self.conn:
+            self.conn.executemany("DELETE FROM {} WHERE source_id = ?".format(self.table),
+                                  [(source_id,) for source_id in source_ids])
+
+
+_CATALOG_SCHEMA = """
+CREATE TABLE IF NOT EXISTS metadata (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS trees (source_id TEXT PRIMARY KEY,
+                                  study_id TEXT NOT NULL,
+                                  tree_id TEXT NOT NULL,
+                                  branch_length_mode TEXT,
+                                  time_unit TEXT,
+                                  tip_count INTEGER,
+                                  study_sha TEXT);
+CREATE INDEX IF NOT EXISTS trees_study_id ON trees (study_id);
+CREATE TABLE IF NOT EXISTS tree_properties (source_id TEXT NOT NULL, property TEXT NOT NULL, value TEXT);
+CREATE INDEX IF NOT EXISTS tree_properties_value ON tree_properties (property, value);
+CREATE INDEX IF NOT EXISTS tree_properties_source_id ON tree_properties (source_id);
+"""
+
+TREE_FIELDS = ('source_id', 'study_id', 'tree_id', 'branch_length_mode', 'time_unit', 'tip_count', 'study_sha')
+
+
+class ChronogramCatalog(object):
+    """
+    SQLite catalog of the trees in a local phylesystem clone, for finding trees without the search API.
+
+    Each tree has a row of TREE_FIELDS, and its search properties, e.g. 'ot:branchLengthMode'
+    or 'ot:studyYear', from both the tree and its study, indexed by property and value.
+    A list valued property matches each of its values.
+    Studies are replaced as a whole, so the catalog can follow phylesystem one changed study at a time.
+    """
+    def __init__(self, path, timeout=60):
+        self.path = path
+        self.conn = sqlite3.connect(path, timeout=timeout)
+        self.conn.executescript(_CATALOG_SCHEMA)
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return self.conn.execute("SELECT COUNT(*) FROM trees").fetchone()[0]
+
+    @property
+    def metadata(self):
+        """e.g. the phylesystem_sha the catalog is up to date with"""
+        cur = self.conn.execute("SELECT key, value FROM metadata ORDER BY key")
+        return {key: json.loads(value) for key, value in cur}
+
+    def set_metadata(self, metadata):
+        with self.conn:
+            self.conn.execute("DELETE FROM metadata")
+            self.conn.executemany("INSERT INTO metadata VALUES (?, ?)",
+                                  [(key, json.dumps(value)) for key, value in metadata.items()])
+
+    def replace_studies(self, study_ids, trees):
+        """
+        Deletes the trees of the given studies and adds the new ones, in one transaction.
+        trees: list of dicts with TREE_FIELDS and 'properties': {property: value}
+        """
+        with self.conn:
+            for study_id in study_ids:
+                self.conn.execute("DELETE FROM tree_properties WHERE source_id IN "
+                                  "(SELECT source_id FROM trees WHERE study_id = ?)", (study_id,))
+                self.conn.execute("DELETE FROM trees WHERE study_id = ?", (study_id,))
+            self.conn.executemany("INSERT OR REPLACE INTO trees VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                  [tuple(tree[field] for field in TREE_FIELDS) for tree in trees])
+            self.conn.executemany("INSERT INTO tree_properties VALUES (?, ?, ?)",
+                                  [(tree['source_id'], prop, _property_value(value))
+                                   for tree in trees for prop, values in tree['properties'].items()
+                                   for value in (values if isinstance(values, list) else [values])])
+
+    def find(self, search_property, value):
+        """Source ids of trees whose tree or study has search_property equal to value"""
+        cur = self.conn.execute("SELECT DISTINCT source_id FROM tree_properties WHERE property = ? AND value = ? "
+                                "ORDER BY source_id", (search_property, _property_value(value)))
+        return [row[0] for row in cur]
+
+    def tree(self, source_id):
+        """The TREE_FIELDS of a tree, or None"""
+        row = self.conn.execute("SELECT {} FROM trees WHERE source_id = ?".format(', '.join(TREE_FIELDS)),
+                                (source_id,)).fetchone()
+        return dict(zip(TREE_FIELDS, row)) if row else None
+
+    def study_ids(self):
+        cur = self.conn.execute("SELECT DISTINCT study_id FROM trees ORDER BY study_id")
+        return [row[0] for row in cur]
+
+
+def _property_value(value):
+    """Strings as they are, anything else as JSON"""
+    if isinstance(value, str):
+        return value
+    return json.dumps(value, sort_keys=True)
+
+
+def _encode(res):
+    return zlib.compress(json.dumps(res, separators=(',', ':')).encode('utf-8'))
+
+
+def _decode(value):
+    return json.loads(zlib.decompress(value).decode('utf-8'))
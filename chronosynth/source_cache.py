@@ -0,0 +1,73 @@
+"""In-memory least recently used cache of per-source trees, ages and conflict maps"""
+#!/usr/bin/env python3
+import threading
+import collections
+
+
+class SourceCache(object):
+    """
+    Size bounded LRU cache shared by the functions that work on one source tree, so a source
+    is fetched, parsed and mapped once per process however many of them are called on it.
+
+    Entries are keyed by (source id, version), the version being the study commit the source was read at,
+    and hold named slots, e.g. 'tree', 'ages' and 'conflict'. Only the latest version of a source is kept,
+    so putting a new one drops the others. Once more than max_sources entries are held, the least recently
+    used is dropped.
+    Cached values are shared between callers, and should not be modified.
+    Counts of hits, misses and evictions are kept in stats.
+    """
+    def __init__(self, max_sources=256):
+        self.max_sources = max_sources
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, source_id, version, slot, default=None):
+        """Value of slot in the entry for (source_id, version), or default"""
+        key = (source_id, version)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or slot not in entry:
+                self.stats['misses'] += 1
+                return default
+            self._entries.move_to_end(key)
+            self.stats['hits'] += 1
+            return entry[slot]
+
+    def put(self, source_id, version, slot, value):
+        """
+        Sets slot in the entry for (source_id, version), dropping other versions of source_id and
+        the least recently used entries over max_sources
+        """
+        key = (source_id, version)
+        with self._lock:
+            if key not in self._entries:
+                stale = [other for other in self._entries if other[0] == source_id]
+                for other in stale:
+                    del self._entries[other]
+                self.stats['evictions'] += len(stale)
+            self._entries.setdefault(key, {})[slot] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_sources:
+                self._entries.popitem(last=False)
+                self.stats['evictions'] += 1
+        return value
+
+    def evict(self, source_id=None, version=None):
+        """
+        Drops the entries of source_id, of version, or of both. With neither, empties the cache.
+        Returns the number of entries dropped.
+        """
+        with self._lock:
+            keys = [key for key in self._entries
+                    if (source_id is None or key[0] == source_id) and (version is None or key[1] == version)]
+            for key in keys:
+                del self._entries[key]
+            self.stats['evictions'] += len(keys)
+        return len(keys)
@@ -0,0 +1,274 @@
+"""Byte offset index of the nodes of a synth tree newick file, for extracting subtrees without parsing the tree"""
+#!/usr/bin/env python3
+import os
+import re
+import mmap
+
+import numpy as np
+
+
+_NODE_ID = re.compile(r'(mrcaott\d+ott\d+|ott\d+)$')
+_MRCA = re.compile(r'mrcaott(\d+)ott(\d+)$')
+_CHUNK = 1 << 24
+_DELIMITERS = b'(),;:['
+
+
+def normalize_node_label(label):
+    """
+    Synth node id of a tree label, e.g. 'Homo sapiens ott770315' -> 'ott770315',
+    'mrcaott1ott2' -> 'mrcaott1ott2', or None if the label holds no node id.
+    """
+    if label is None:
+        return None
+    label = label.strip().strip("'").replace("''", "'").split()
+    if not label:
+        return None
+    match = _NODE_ID.search(label[-1])
+    if match is None:
+        return None
+    return match.group(1)
+
+
+def node_key(node_id):
+    """
+    Integer key of a synth node id: ott ids are (ott id << 32),
+    mrca ids are (first ott id << 32) + second ott id + 1.
+    Returns None if node_id is not a synth node id.
+    """
+    if node_id.startswith('ott') and node_id[3:].isdigit():
+        return int(node_id[3:]) << 32
+    match = _MRCA.match(node_id)
+    if match:
+        return (int(match.group(1)) << 32) + int(match.group(2)) + 1
+    return None
+
+
+def node_id_of_key(key):
+    """Synth node id of a node_key"""
+    key = int(key)
+    first, second = key >> 32, key & 0xffffffff
+    if second:
+        return 'mrcaott{}ott{}'.format(first, second - 1)
+    return 'ott{}'.format(first)
+
+
+def _scan(tree_map):
+    """
+    Positions of the delimiters of a newick file, outside quoted labels and comments,
+    found a chunk at a time. Returns (positions, delimiter bytes) sorted by position.
+    """
+    delimiters = np.frombuffer(_DELIMITERS, dtype=np.uint8)
+    positions = [np.zeros(0, dtype=np.int64)]
+    chars = [np.zeros(0, dtype=np.uint8)]
+    quotes = [np.zeros(0, dtype=np.int64)]
+    comments = [np.zeros(0, dtype=np.int64)]
+    for start in range(0, len(tree_map), _CHUNK):
+        chunk = np.frombuffer(tree_map[start:start + _CHUNK], dtype=np.uint8)
+        found = np.flatnonzero(np.isin(chunk, delimiters))
+        positions.append(found + start)
+        chars.append(chunk[found])
+        quotes.append(np.flatnonzero(chunk == ord("'")) + start)
+        comments.append(np.flatnonzero((chunk == ord('[')) | (chunk == ord(']'))) + start)
+    positions = np.concatenate(positions)
+    quotes = np.concatenate(quotes)
+    comments = np.concatenate(comments)
+    # Inside a quoted label an odd number of quotes come before; doubled quotes cancel out
+    keep = np.searchsorted(quotes, positions) % 2 == 0
+    # Inside a comment an odd number of comment brackets come before
+    keep &= np.searchsorted(comments, positions) % 2 == 0
+    return positions[keep], np.concatenate(chars)[keep]
+
+
+NO_KEY = np.iinfo(np.uint64).max
+
+
+def _node_arrays(tree_map):
+    """
+    The nodes of a newick file as arrays in preorder, without parsing it:
+    {'parent': parent indices, -1 for the root,
+     'start': byte offset where the node's subtree starts,
+     'label_start', 'label_end': byte range of its label,
+     'tail_end': end of its label and any ':length',
+     'edge_length': float edge lengths, nan where missing}
+    Parentheses are matched by depth, with the arrays of delimiter positions:
+    at each depth, opens and closes alternate in file order.
+    """
+    positions, chars = _scan(tree_map)
+    size = len(tree_map)
+    next_pos = np.append(positions[1:], size)
+    next_char = np.append(chars[1:], ord(';'))
+    is_open = chars == ord('(')
+    is_close = chars == ord(')')
+    depth = np.cumsum(np.where(is_open, 1, np.where(is_close, -1, 0)))
+    if len(depth) == 0 or depth[-1] != 0 or depth.min() < 0:
+        raise ValueError("Unbalanced parentheses in newick")
+    paren = np.flatnonzero(is_open | is_close)
+    paren_depth = np.where(is_open[paren], depth[paren], depth[paren] + 1)
+    pairs = paren[np.lexsort((paren, paren_depth))].reshape(-1, 2)
+    pairs = pairs[np.argsort(pairs[:, 0])]
+    open_d, close_d = pairs[:, 0], pairs[:, 1]
+    # Tips follow a '(' or ',' that isn't followed by another '('
+    tip_d = np.flatnonzero((is_open | (chars == ord(','))) & (next_char != ord('(')))
+    start = np.concatenate([positions[open_d], positions[tip_d] + 1])
+    label_d = np.concatenate([close_d, tip_d])
+    # Depth of the clade each node sits in
+    enclosing = np.concatenate([depth[open_d] - 1, depth[tip_d]])
+    # The parent is the last '(' before the node at the enclosing depth
+    open_keys = depth[open_d] * (size + 1) + positions[open_d]
+    open_order = np.argsort(open_keys, kind='stable')
+    j = np.searchsorted(open_keys[open_order], enclosing * (size + 1) + start) - 1
+    found = (j >= 0) & (depth[open_d][open_order][np.maximum(j, 0)] == enclosing)
+    parent = np.where(found, open_order[np.maximum(j, 0)], -1)
+    if (parent == -1).sum() != 1:
+        raise ValueError("Newick should hold exactly one tree")
+    order = np.argsort(start, kind='stable')
+    rank = np.empty_like(order)
+    rank[order] = np.arange(len(order))
+    parent = np.where(parent >= 0, rank[np.maximum(parent, 0)], -1)[order]
+    label_d = label_d[order]
+    label_end = next_pos[label_d]
+    tail_end = label_end.copy()
+    edge_length = np.full(len(order), np.nan)
+    length_d = label_d + 1
+    for i in np.flatnonzero((length_d < len(chars)) & (next_char[label_d] == ord(':'))).tolist():
+        d = length_d[i]
+        tail_end[i] = next_pos[d]
+        edge_length[i] = float(tree_map[positions[d] + 1:next_pos[d]])
+    return {'parent': parent,
+            'start': start[order],
+            'label_start': positions[label_d] + 1,
+            'label_end': label_end,
+            'tail_end': tail_end,
+            'edge_length': edge_length}
+
+
+def _node_keys(tree_map, label_start, label_end):
+    """node_key of each label, NO_KEY where there is no node id"""
+    keys = np.full(len(label_start), NO_KEY, dtype=np.uint64)
+    for i in np.flatnonzero(label_end > label_start).tolist():
+        node_id = normalize_node_label(tree_map[label_start[i]:label_end[i]].decode('utf-8'))
+        key = node_key(node_id) if node_id else None
+        if key is not None:
+            keys[i] = key
+    return keys
+
+
+def read_tree_nodes(tree_path):
+    """
+    The nodes of a synth tree newick file as arrays in preorder, see _node_arrays,
+    plus 'key': the node_key of each node's synth node id, NO_KEY if it has none.
+    Labels are never held as strings, so the 2.3M tip synth tree takes a few hundred MB.
+    """
+    with open(tree_path, 'rb') as tree_file:
+        with mmap.mmap(tree_file.fileno(), 0, access=mmap.ACCESS_READ) as tree_map:
+            nodes = _node_arrays(tree_map)
+            nodes['key'] = _node_keys(tree_map, nodes['label_start'], nodes['label_end'])
+    return nodes
+
+
+def build_index(tree_path):
+    """
+    Scans a synth tree newick file, e.g. labelled_supertree.tre or grafted_solution.tre,
+    and returns (keys, starts, ends) sorted by key, where the newick of the subtree below
+    the node with key node_key(node_id) is the byte range starts[i]:ends[i] of the file.
+    Nodes whose labels hold no node id are left out.
+    """
+    nodes = read_tree_nodes(tree_path)
+    keep = nodes['key'] != NO_KEY
+    keys = nodes['key'][keep]
+    order = np.argsort(keys, kind='stable')
+    return keys[order], nodes['start'][keep][order], nodes['label_end'][keep][order]
+
+
+def write_newick_with_lengths(tree_path, nodes, edge_length, outputfile):
+    """
+    Copies a newick file with new edge lengths, streaming it through mmap
+    rather than building the tree in memory.
+    nodes: from read_tree_nodes(tree_path)
+    edge_length: float array in the node order of nodes, nan for no length
+    """
+    order = np.argsort(nodes['label_end'], kind='stable')
+    with open(tree_path, 'rb') as tree_file:
+        with mmap.mmap(tree_file.fileno(), 0, access=mmap.ACCESS_READ) as tree_map:
+            with open(outputfile, 'wb') as out:
+                prev = 0
+                for label_end, tail_end, length in zip(nodes['label_end'][order].tolist(),
+                                                       nodes['tail_end'][order].tolist(),
+                                                       edge_length[order].tolist()):
+                    out.write(tree_map[prev:label_end])
+                    if length == length:
+                        out.write(':{}'.format(length).encode('utf-8'))
+                    prev = tail_end
+                out.write(tree_map[prev:])
+    return outputfile
+
+
+_LABEL = re.compile(rb"(:[^,();\[]*|\[[^\]]*\]|'(?:[^']|'')*'|[^(),;:\['\s]+)")
+
+
+def _ids_only(newick):
+    """Replaces the labels in a newick string with their synth node ids, as label_format='id' does"""
+    def relabel(match):
+        token = match.group(1)
+        if token[:1] in (b':', b'['):
+            return token
+        node_id = normalize_node_label(token.decode('utf-8'))
+        return node_id.encode('utf-8') if node_id else b''
+    return _LABEL.sub(relabel, newick)
+
+
+class SynthTreeIndex(object):
+    """
+    Node id to byte range index of a synth tree newick file. The index is built once,
+    saved next to the tree as {tree_path}.index.npz and rebuilt if the tree file changes.
+    Subtrees are read by slicing the memory mapped file.
+    """
+    def __init__(self, tree_path, index_path=None):
+        self.tree_path = tree_path
+        self.index_path = index_path if index_path else tree_path + '.index.npz'
+        stat = os.stat(tree_path)
+        version = np.array([stat.st_size, int(stat.st_mtime)], dtype=np.int64)
+        if os.path.exists(self.index_path):
+            with np.load(self.index_path) as saved:
+                if (saved['version'] == version).all():
+                    self.keys, self.starts, self.ends = saved['keys'], saved['starts'], saved['ends']
+                    return
+        self.keys, self.starts, self.ends = build_index(tree_path)
+        tmp_path = '{}.{}.tmp.npz'.format(self.index_path[:-4], os.getpid())
+        np.savez(tmp_path, keys=self.keys, starts=self.starts, ends=self.ends, version=version)
+        os.replace(tmp_path, self.index_path)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __contains__(self, node_id):
+        return self._find(node_id) is not None
+
+    def _find(self, node_id):
+        key = node_key(node_id)
+        if key is None:
+            return None
+        i = np.searchsorted(self.keys, np.uint64(key))
+        if i < len(self.keys) and self.keys[i] == key:
+            return i
+        return None
+
+    def byte_range(self, node_id):
+        """(start, end) of the node's subtree in the file"""
+        i = self._find(node_id)
+        if i is None:
+            raise KeyError(node_id)
+        return int(self.starts[i]), int(self.ends[i])
+
+    def subtree_newick(self, node_id, label_format='id'):
+        """
+        Newick string of the subtree below node_id, like the newick of OT.synth_subtree.
+        label_format: 'id' relabels nodes with their node ids, anything else keeps the labels of the file.
+        """
+        start, end = self.byte_range(node_id)
+        with open(self.tree_path, 'rb') as tree_file:
+            with mmap.mmap(tree_file.fileno(), 0, access=mmap.ACCESS_READ) as tree_map:
+                newick = tree_map[start:end]
+        if label_format == 'id':
+            newick = _ids_only(newick)
+        return newick.decode('utf-8') + ';'
@@ -0,0 +1,212 @@
+"""Pooled, compressed and cached HTTP transport for OpenTree web service calls"""
+#!/usr/bin/env python3
+import os
+import sys
+import json
+import zlib
+import time
+import hashlib
+import logging
+import sqlite3
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+from urllib3.util.retry import Retry
+
+from opentree.ws_wrapper import WebServiceCallRecord, WebServiceRunMode
+
+log = logging.getLogger(__name__)
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+class ResponseCache(object):
+    """
+    SQLite cache of HTTP responses that came with an ETag or Last-Modified validator,
+    keyed by method, url and request body. Bodies are stored compressed.
+    Connections are opened per process, so the cache can be shared by worker processes.
+    max_bytes: once the compressed bodies take more than this, the least recently used
+               responses are dropped. None for no limit.
+    """
+    def __init__(self, path, timeout=60, max_bytes=None):
+        self.path = path
+        self.timeout = timeout
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._pid = None
+        self._conn = None
+
+    @property
+    def conn(self):
+        if self._pid != os.getpid():
+            self._conn = sqlite3.connect(self.path, timeout=self.timeout, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            with self._conn:
+                self._conn.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, url TEXT, "
+                                   "etag TEXT, last_modified TEXT, headers TEXT, content BLOB, "
+                                   "size INTEGER, used REAL)")
+                columns = [row[1] for row in self._conn.execute("PRAGMA table_info(responses)")]
+                for column, column_type in (('size', 'INTEGER'), ('used', 'REAL')):
+                    if column not in columns:
+                        self._conn.execute("ALTER TABLE responses ADD COLUMN {} {}".format(column, column_type))
+                self._conn.execute("UPDATE responses SET size = LENGTH(content), used = 0 WHERE size IS NULL")
+            self._pid = os.getpid()
+        return self._conn
+
+    @staticmethod
+    def key(http_method, url, data):
+        body = json.dumps(data, sort_keys=True) if data else ''
+        return hashlib.sha1('{} {} {}'.format(http_method, url, body).encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        """(etag, last_modified, headers, content) or None"""
+        with self._lock:
+            row = self.conn.execute("SELECT etag, last_modified, headers, content FROM responses WHERE key = ?",
+                                    (key,)).fetchone()
+            if row is not None and self.max_bytes is not None:
+                with self.conn:
+                    self.conn.execute("UPDATE responses SET used = ? WHERE key = ?", (time.time(), key))
+        if row is None:
+            return None
+        return row[0], row[1], json.loads(row[2]), zlib.decompress(row[3])
+
+    def put(self, key, url, resp):
+        content = zlib.compress(resp.content)
+        with self._lock, self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO responses (key, url, etag, last_modified, headers, content, "
+                              "size, used) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                              (key, url, resp.headers.get('ETag'), resp.headers.get('Last-Modified'),
+                               json.dumps(dict(resp.headers)), content, len(content), time.time()))
+            if self.max_bytes is not None:
+                self._trim()
+
+    def _trim(self):
+        """Drops the least recently used responses until the cache fits in max_bytes"""
+        excess = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0] - self.max_bytes
+        if excess <= 0:
+            return
+        dropped = []
+        for key, size in self.conn.execute("SELECT key, size FROM responses ORDER BY used"):
+            if excess <= 0:
+                break
+            dropped.append((key,))
+            excess -= size
+        self.conn.executemany("DELETE FROM responses WHERE key = ?", dropped)
+
+    def delete(self, key):
+        with self._lock, self.conn:
+            self.conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+
+
+class Transport(object):
+    """
+    HTTP layer for opentree's WebServiceWrapper (see install), with
+    - keep-alive connections pooled in one requests Session per process
+    - gzip compressed responses
+    - bounded retries with exponential backoff on connection errors and 429/5xx statuses
+    - an optional ResponseCache: a cached response is sent back with If-None-Match / If-Modified-Since,
+      and a 304 is answered from the cache, so unchanged studies cost no download.
+
+    Counts of requests, revalidated (304) responses and newly cached responses are kept in stats.
+    """
+    def __init__(self, cache_path=None, pool_size=10, retries=3, backoff=0.5, timeout=None, cache_max_bytes=None):
+        self.cache = ResponseCache(cache_path, max_bytes=cache_max_bytes) if cache_path else None
+        self.pool_size = pool_size
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self._pid = None
+        self._session = None
+        self.stats = {'requests': 0, 'not_modified': 0, 'cached': 0}
+
+    @property
+    def session(self):
+        # Sockets can't be shared with forked worker processes
+        if self._pid != os.getpid():
+            retry = Retry(total=self.retries,
+                          backoff_factor=self.backoff,
+                          status_forcelist=RETRY_STATUSES,
+                          # OpenTree's POST methods are queries, safe to repeat
+                          allowed_methods=None,
+                          raise_on_status=False)
+            adapter = HTTPAdapter(pool_connections=self.pool_size, pool_maxsize=self.pool_size, max_retries=retry)
+            self._session = requests.Session()
+            self._session.mount('https://', adapter)
+            self._session.mount('http://', adapter)
+            self._session.headers['Accept-Encoding'] = 'gzip, deflate'
+            self._pid = os.getpid()
+        return self._session
+
+    def request(self, http_method, url, data=None, headers=None):
+        """Performs the call, revalidating any cached response, and returns a requests Response"""
+        headers = dict(headers or {})
+        key = cached = None
+        if self.cache is not None:
+            key = ResponseCache.key(http_method, url, data)
+            cached = self.cache.get(key)
+            if cached is not None:
+                etag, last_modified = cached[0], cached[1]
+                if etag:
+                    headers['If-None-Match'] = etag
+                if last_modified:
+                    headers['If-Modified-Since'] = last_modified
+        self.stats['requests'] += 1
+        resp = self.session.request(http_method,
+                                    url,
+                                    headers=headers,
+                                    data=json.dumps(data) if data else None,
+                                    allow_redirects=True,
+                                    timeout=self.timeout)
+        if resp.status_code == 304 and cached is not None:
+            self.stats['not_modified'] += 1
+            return _cached_response(resp, cached)
+        if self.cache is not None and resp.status_code == 200:
+            if resp.headers.get('ETag') or resp.headers.get('Last-Modified'):
+                self.cache.put(key, url, resp)
+                self.stats['cached'] += 1
+            elif cached is not None:
+                self.cache.delete(key)
+        return resp
+
+
+def _cached_response(not_modified, cached):
+    """A 200 response made from the cached one, for a 304 answer"""
+    resp = requests.Response()
+    resp.status_code = 200
+    resp.headers = CaseInsensitiveDict(cached[2])
+    resp.headers.update(not_modified.headers)
+    # The cached body was stored decoded
+    resp.headers.pop('Content-Encoding', None)
+    resp.headers.pop('Content-Length', None)
+    resp._content = cached[3]
+    resp.url = not_modified.url
+    resp.request = not_modified.request
+    resp.elapsed = not_modified.elapsed
+    resp.encoding = requests.utils.get_encoding_from_headers(resp.headers)
+    return resp
+
+
+def install(ws, transport):
+    """
+    Routes the calls of an opentree WebServiceWrapper, e.g. OT.ws, through transport,
+    by replacing its _http_request. Calls are no longer kept in ws.call_history,
+    which would otherwise hold every response of a bulk rebuild in memory.
+    """
+    def _http_request(url, http_method="GET", data=None, headers=None):
+        rec = WebServiceCallRecord(ws, url, http_method, headers, data)
+        if ws._generate_curl:
+            ws.curl_strings.append(rec.curl_call)
+        if not ws._perform_ws_calls:
+            if ws._run_mode == WebServiceRunMode.CURL:
+                sys.stderr.write('{}\n'.format(ws.curl_strings[-1]))
+            return rec
+        start = time.perf_counter()
+        rec._response_obj = transport.request(http_method, url, data=data, headers=headers)
+        log.debug('Sent %s to %s: %s in %.3fs', http_method, url, rec._response_obj.status_code,
+                  time.perf_counter() - start)
+        return rec
+    ws._store_api_calls = False
+    ws._http_request = _http_request
+    return ws
@@ -21,14 +21,11 @@ full_synth_tree = dendropy.Tree.get_from_path('grafted_solution.tre', schema = '
 
 len(full_synth_tree.leaf_nodes())
 
-chronogram.build_synth_node_source_ages(ultrametricity_precision=0.01)
-
 ##TODO make this into a chronosynth function, that takes a tree and a dates dictionary, 
 # and returns the ages file, input tree and citations for the dates!
 
-# From git@github.com:OpenTreeOfLife/ChronoSynth.git
-# this file is generated by running examples/conflict_test_all.py
-dates = json.load(open("../node_ages.json"))
+# Indexed node age store, each node lookup is a single query
+dates = chronogram.build_synth_node_source_ages(ultrametricity_precision=0.01)
 
 ages = open("ages",'w')
 
@@ -43,10 +40,9 @@ for node in full_synth_tree:
             lab = node.label
         else:
             lab = node.label.split()[-1]
-        if lab in dates['node_ages']:
+        if lab in dates['node_summary']:
             dated_nodes.add(lab)
-            age_range = [float(source['age']) for source in dates['node_ages'][lab]]
-            age_est = sum(age_range) / len(age_range)
+            age_est = dates['node_summary'][lab]['mean']
             # This uses the average age across multiple age estimates.
             ages.write("{}\t{}\n".format(node.label, age_est))
         else:
@@ -62,10 +58,9 @@ for node in full_synth_tree:
             lab = node.label
         else:
             lab = node.label.split()[-1]
-        if lab in dates['node_ages']:
+        if lab in dates['node_summary']:
             dated_nodes.add(lab)
-            age_range = [float(source['age']) for source in dates['node_ages'][lab]]
-            age_est = sum(age_range) / len(age_range)
+            age_est = dates['node_summary'][lab]['mean']
             node.
             # This uses the average age across multiple age estimates.
             ages.write("{}\t{}\n".format(node.label, age_est))
@@ -26,7 +26,7 @@ maps = chronogram.map_conflict_nodes(source)
 
 
 ##Next create priors file using fastdate
-dates = json.load(open("node_ages.json"))
+dates = chronogram.node_age_store()
 
 #for taxon in maps['tree'].taxon_namespace:
 #     taxon._label = 'ott' + str(taxon.ott_id)
@@ -43,33 +43,17 @@ for edge in maps['tree'].inorder_edge_iter():
 
 maps['tree'].write(path='test.tre', schema='newick')
 
-mrca_dict = {}
-for node_label in maps['matched_nodes']:
-    if maps['matched_nodes'][node_label] in dates['node_ages'].keys():
-        mrca_dict[node_label] = {}
-        mrca_dict[node_label]['synth_node'] = maps['matched_nodes'][node_label]
-        mrca_dict[node_label]['ages'] = dates['node_ages'][maps['matched_nodes'][node_label]]
-        nd = maps['tree'].find_node_with_label(node_label)
-        mrca_dict[node_label]['tips'] = [ti.taxon.label.replace(' ','_') for ti in nd.leaf_iter()]
-#        assert(maps['tree'].mrca(taxon_labels=mrca_dict[node_label]['tips']).label == node_label)
-
-##
-if len(mrca_dict) == 0:
+# Label the matched nodes with their synth node ids, so write_fastdate_prior can find their dates.
+# validate=True checks that the MRCA of each calibrated tip set is still the dated node.
+nodes = {node.label: node for node in maps['tree'].preorder_internal_node_iter()}
+for node_label, synth_node in maps['matched_nodes'].items():
+    nodes[node_label].label = synth_node
+
+if chronogram.write_fastdate_prior(maps['tree'], dates, outputfile='test_prior.txt', validate=True,
+                                   prior=lambda stats: (0.01 * stats['mean'], 0.8 * stats['mean'])) is None:
     print("no calibrations")
     exit()
 
-fi=open('test_prior.txt','w')
-for dated_node in mrca_dict:
-    fi.write("'")
-    fi.write("','".join(mrca_dict[dated_node]['tips']))
-    fi.write("'")
-    fi.write(' ')
-    ages = [source['age'] for source in mrca_dict[dated_node]['ages']]
-    avgage = sum(ages)/len(ages)
-    fi.write('norm({},{},{})\n'.format(0, 0.01*avgage, 0.8*avgage))
-
-fi.close()
-
 
 ott_taxa = []
 for taxon in maps['tree'].taxon_namespace:
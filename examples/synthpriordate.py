@@ -22,10 +22,17 @@ def main(arg_list, out, list_for_results=None):
                         help='max root age.')
     cli.parser.add_argument("--phylo_only", default=False, action='store_true', required=False,
                         help='prune to only tips with some phylogenetic information')
+    cli.parser.add_argument("--workers", default=None, type=int, required=False,
+                        help='How many fastdate runs to do at once. Defaults to the number of cpus.')
+    cli.parser.add_argument("--timeout", default=None, type=float, required=False,
+                        help='Seconds after which a fastdate run is stopped.')
+    cli.parser.add_argument("--synth_tree", default=None, required=False,
+                        help='Local labelled_supertree.tre or grafted_solution.tre to take the subtree from.')
     cli.parser.add_argument("--verbose", action="store_true", help='include meta-data in response')
     OT, args = cli.parse_cli(arg_list)
 
-    chronogram.date_synth_subtree(args.node_id, args.reps, max_age=args.max_age, summary=args.output, phylo_only=args.phylo_only)
+    chronogram.date_synth_subtree(args.node_id, args.reps, max_age=args.max_age, summary=args.output, phylo_only=args.phylo_only,
+                                  workers=args.workers, timeout=args.timeout, synth_tree=args.synth_tree)
 
 if __name__  == '__main__':
     rc = main(sys.argv[1:], sys.stdout)
@@ -0,0 +1,42 @@
+import random
+
+import dendropy
+import numpy as np
+
+from chronosynth.arraytree import ArrayTree, resolve_polytomies
+from chronosynth.age_summary import summarize_replicates
+
+REFERENCE = "((A,B,C,D,E)mrcaottAottE,(F,G,H)x,((I,J)ottIJ)y)r;"
+
+
+def _random_chronogram(tree, rng):
+    """Random ultrametric branch lengths for a resolved tree, with internal labels dropped"""
+    kids = tree.children()
+    age = [0.0] * len(tree)
+    for i in reversed(range(len(tree))):
+        if kids[i]:
+            age[i] = max(age[child] for child in kids[i]) + rng.random()
+    edge_length = [np.nan] + [age[tree.parent[i]] - age[i] for i in range(1, len(tree))]
+    labels = [None if kids[i] else label for i, label in enumerate(tree.labels)]
+    ages = {label: age[i] for i, label in enumerate(tree.labels) if kids[i] and label}
+    return ArrayTree(labels, tree.parent, edge_length), ages
+
+
+def test_summarize_replicates(tmp_path):
+    reference = ArrayTree.from_dendropy(dendropy.Tree.get_from_string(REFERENCE, schema='newick'))
+    rng = random.Random(1)
+    replicates = [_random_chronogram(resolve_polytomies(reference, random.Random(seed)), rng) for seed in range(20)]
+    outputfile = str(tmp_path / 'sumtre.tre')
+    summary = summarize_replicates(reference, (tree for tree, ages in replicates),
+                                   outputfile=outputfile, quantiles=[0.5])
+    stats = summary.summary()
+    assert sorted(stats) == ['mrcaottAottE', 'ottIJ', 'r', 'x']
+    for label in stats:
+        ages = [rep_ages[label] for tree, rep_ages in replicates]
+        assert stats[label]['n'] == 20
+        assert np.isclose(stats[label]['mean'], np.mean(ages))
+        assert np.isclose(stats[label]['variance'], np.var(ages, ddof=1))
+        assert np.isclose(stats[label]['quantiles'][0.5], np.median(ages))
+    tree = dendropy.Tree.get_from_path(outputfile, schema='newick', extract_comment_metadata=True)
+    assert np.isclose(float(tree.seed_node.annotations.get_value('age_mean')), stats['r']['mean'])
+    assert np.isclose(tree.seed_node.distance_from_tip(), stats['r']['mean'])
@@ -0,0 +1,106 @@
+import random
+
+import dendropy
+import numpy as np
+import opentree
+import pytest
+
+from chronosynth.arraytree import ArrayTree, TreeBatch, batch_node_ages, root_depths, resolve_polytomies, bladj_ages
+
+
+def _random_chronogram(n_tips, seed, jitter=0.0):
+    rng = random.Random(seed)
+    tree = dendropy.simulate.treesim.birth_death_tree(birth_rate=1.0, death_rate=0.2,
+                                                       num_extant_tips=n_tips, rng=rng)
+    for i, node in enumerate(tree.preorder_node_iter()):
+        node.label = 'node{}'.format(i)
+        if node.edge.length is not None and node.is_leaf():
+            node.edge.length += rng.uniform(0, jitter)
+    return tree
+
+
+def _dendropy_ages(tree, precision):
+    try:
+        tree.internal_node_ages(ultrametricity_precision=precision)
+    except dendropy.utility.error.UltrametricityError:
+        return None
+    return {node.label: node.age for node in tree.internal_nodes()}
+
+
+def test_batch_node_ages_match_dendropy():
+    trees = [_random_chronogram(n, seed=n) for n in (2, 5, 40, 300)]
+    trees.append(_random_chronogram(30, seed=7, jitter=1.0))
+    expected = [_dendropy_ages(tree, 0.01) for tree in trees]
+    ages = batch_node_ages([ArrayTree.from_dendropy(tree) for tree in trees], ultrametricity_precision=0.01)
+    assert ages == expected
+    assert ages[-1] is None
+    assert list(ages[3].keys()) == list(expected[3].keys())
+
+
+def test_root_depths():
+    tree = dendropy.Tree.get(data="((A:1,B:2)n2:3,C:4)n1;", schema="newick")
+    batch = TreeBatch([ArrayTree.from_dendropy(tree), ArrayTree.from_dendropy(tree)])
+    assert list(root_depths(batch)) == [0.0, 3.0, 4.0, 5.0, 4.0] * 2
+
+
+NEXSON = {'nexml': {'otusById': {'otus1': {'otuById': {'otu1': {'^ot:originalLabel': 'A'},
+                                                       'otu2': {'^ot:originalLabel': 'B'},
+                                                       'otu3': {'^ot:originalLabel': 'C'}}}},
+                    'treesById': {'trees1': {'@otus': 'otus1',
+                                             'treeById': {'tree1': {'@xsi:type': 'nex:FloatTree',
+                                                                    '^ot:rootNodeId': 'node1',
+                                                                    '^ot:specifiedRoot': 'node1',
+                                                                    '^ot:branchLengthMode': 'ot:time',
+                                                                    '^ot:branchLengthTimeUnit': 'Myr',
+                                                                    'nodeById': {'node1': {'@root': True},
+                                                                                 'node2': {},
+                                                                                 'node3': {'@otu': 'otu1'},
+                                                                                 'node4': {'@otu': 'otu2'},
+                                                                                 'node5': {'@otu': 'otu3'}},
+                                                                    'edgeBySourceId': {
+                                                                        'node1': {'edge1': {'@source': 'node1', '@target': 'node5', '@length': 3.3},
+                                                                                  'edge2': {'@source': 'node1', '@target': 'node2', '@length': 2.2}},
+                                                                        'node2': {'edge3': {'@source': 'node2', '@target': 'node3', '@length': 1.1},
+                                                                                  'edge4': {'@source': 'node2', '@target': 'node4', '@length': 1.1}}}}}}}}}
+
+
+def test_from_nexson_matches_dendropy_convert():
+    dp_tree = opentree.object_conversion.DendropyConvert().tree_from_nexson(NEXSON, 'tree1')
+    tree = ArrayTree.from_nexson(NEXSON, 'tree1')
+    assert tree.labels == [node.label for node in dp_tree.preorder_node_iter()]
+    assert tree.annotations == {'branchLengthMode': 'ot:time', 'branchLengthTimeUnit': 'Myr'}
+    assert batch_node_ages([tree]) == [_dendropy_ages(dp_tree, 0.01)]
+
+
+def test_resolve_polytomies_matches_dendropy():
+    newick = "((A,B,C,D,E)mrcaottAottE,(F,G,H)x,((I)ottI)y,J:2,K:0,'L m')r;"
+    tree = ArrayTree.from_dendropy(dendropy.Tree.get_from_string(newick, schema='newick'))
+    for seed in range(5):
+        dp_tree = dendropy.Tree.get_from_string(newick, schema='newick')
+        dp_tree.resolve_polytomies(rng=random.Random(seed))
+        dp_tree.suppress_unifurcations()
+        for edge in dp_tree.levelorder_edge_iter():
+            if (edge.tail_node is not None) and (edge.length is None):
+                edge.length = 0.01
+            if edge.length == 0:
+                edge.length = 0.001
+        resolved = resolve_polytomies(tree, random.Random(seed), br_len=0.01, polytomy_br=0.001)
+        assert resolved.to_newick() == dp_tree.as_string(schema='newick').strip()
+    # the input tree is left unresolved
+    assert len(tree) == 17
+
+
+def test_bladj_ages():
+    tree = ArrayTree.from_dendropy(dendropy.Tree.get_from_string("((A,(B,(C,D)n4)n3)n2,(E,F)n5,(G,H)n6)r;", schema='newick'))
+    # n6 is younger than its tips can be, so it is dropped
+    calibrations = {'n2': 10.0, 'n4': 2.0, 'n5': 20.0, 'n6': 0.0}
+    age, fixed = bladj_ages(tree.parent, [calibrations.get(label, np.nan) for label in tree.labels])
+    ages = dict(zip(tree.labels, age.tolist()))
+    assert ages['r'] == 25.0
+    assert ages['n3'] == 6.0
+    assert ages['n6'] == 12.5
+    assert ages['A'] == 0.0
+    assert not fixed[tree.labels.index('n6')]
+    assert bladj_ages(tree.parent, [calibrations.get(label, np.nan) for label in tree.labels], root_age=30)[0][0] == 30
+    with pytest.raises(ValueError):
+        bladj_ages(tree.parent, [calibrations.get(label, np.nan) for label in tree.labels], root_age=15)
@@ -1,3 +1,12 @@
+import os
+import json
+import time
+import sqlite3
+import subprocess
+
+import dendropy
+import pytest
+
 import chronosynth
 from chronosynth import chronogram
 from chronosynth.chronogram import find_trees, node_ages, as_dendropy, map_conflict_ages
@@ -14,6 +23,10 @@ def test_find():
 def test_dp_convert():
     dp_tree = as_dendropy('ot_1000@tree1')
 
+def test_study_filepath():
+    assert chronogram.study_filepath('phylesystem-1', 'ot_1000') == 'phylesystem-1/study/ot_00/ot_1000/ot_1000.json'
+    assert chronogram.study_filepath('phylesystem-1', 'pg_9') == 'phylesystem-1/study/pg_09/pg_9/pg_9.json'
+
 
 def test_node_ages():
     age_data = node_ages('ot_1000@tree1')
@@ -38,10 +51,40 @@ def test_no_conflict_data():
 def test_conf_map_all():
     sources = ['ot_1000@tree1','ot_1056@Tr66755']
     resp = chronogram.combine_ages_from_sources(sources)
-    assert list(resp.keys()) == ['metadata','node_ages']
+    assert list(resp.keys()) == ['metadata', 'node_ages', 'node_summary']
     assert len(resp['node_ages']['mrcaott129303ott149204']) == 2
+    assert resp['node_summary']['mrcaott129303ott149204']['n'] == 2
     assert list(resp['node_ages']['mrcaott129303ott149204'][0].keys()) == ['source_id', 'age', 'source_node']
 
+def test_conf_map_all_parallel():
+    sources = ['ot_1000@tree1','ot_1056@Tr66755']
+    serial = chronogram.combine_ages_from_sources(sources, workers=1)
+    parallel = chronogram.combine_ages_from_sources(sources, workers=2, fresh=True)
+    assert parallel['node_ages'] == serial['node_ages']
+
+def test_map_conflict_ages_parallel_skips_fetch_errors(tmp_path):
+    def fetch_error(source_id, *args):
+        raise ValueError("Study {} not found in local phylesystem".format(source_id))
+    fetch_source = chronogram._fetch_source
+    cache_file_dir = chronogram.config.get('paths', 'cache_file_dir')
+    chronogram._fetch_source = fetch_error
+    chronogram.config.set('paths', 'cache_file_dir', str(tmp_path))
+    chronogram._synth_abouts[chronogram.OT._api_endpoint] = (time.monotonic(), {'synth_id': 'test_synth'})
+    try:
+        assert chronogram.map_conflict_ages_parallel(['ot_1@tree1', 'ot_2@tree1'], workers=2) == {}
+    finally:
+        chronogram._fetch_source = fetch_source
+        chronogram.config.set('paths', 'cache_file_dir', cache_file_dir)
+        chronogram._synth_abouts.pop(chronogram.OT._api_endpoint)
+
+def test_source_index():
+    node_ages = {'mrcaott1ott2': [{'source_id': 'ot_1@tree1', 'age': 10, 'source_node': 'node2'},
+                                  {'source_id': 'ot_2@tree1', 'age': 12, 'source_node': 'node5'}],
+                 'ott3': [{'source_id': 'ot_1@tree1', 'age': 4, 'source_node': 'node3'}]}
+    index = chronogram.source_index(node_ages)
+    assert sorted(index['ot_1@tree1']) == ['mrcaott1ott2', 'ott3']
+    assert index['ot_2@tree1'] == ['mrcaott1ott2']
+
 def test_get_phylesystem_sha():
     sha = chronogram.get_phylesystem_sha()
     assert len(sha) == 40
@@ -61,8 +104,323 @@ def test_synth_node_source_ages():
     # Bad node id
     resp3 = chronogram.synth_node_source_ages('mrcaott1000311ott364372913412341')
 
+def test_synth_nodes_source_ages():
+    nodes = ['mrcaott1000311ott3643729', 'ott372706', 'ott3727069999999', 'mrcaott1000311ott364372913412341']
+    resp = chronogram.synth_nodes_source_ages(nodes)
+    assert list(resp.keys()) == nodes
+    assert resp['mrcaott1000311ott3643729'] == chronogram.synth_node_source_ages('mrcaott1000311ott3643729')
+    assert 'msg' in resp['mrcaott1000311ott364372913412341']
+
+def test_write_fastdate_prior(tmp_path):
+    tree = dendropy.Tree.get_from_string("((A,B)mrcaottAottB,(C,(D)ottD)mrcaottCottD)root;", schema='newick')
+    dates = {'node_ages': {'mrcaottAottB': [{'age': 10.0}, {'age': 12.0}],
+                           'mrcaottCottD': [{'age': 5.0}],
+                           'ottD': [{'age': 1.0}]}}
+    outputfile = str(tmp_path / 'node_prior.txt')
+    assert chronogram.write_fastdate_prior(tree, dates, outputfile=outputfile) == outputfile
+    with open(outputfile) as prior:
+        assert sorted(prior.readlines()) == ["'A','B' norm(0,2.0,11.0)\n",
+                                             "'C','D' norm(0,0.5,5.0)\n",
+                                             "'D' norm(0,0.1,1.0)\n"]
+    with pytest.raises(ValueError):
+        chronogram.write_fastdate_prior(tree, dates, outputfile=outputfile, validate=True)
+    # The partial prior isn't left behind
+    assert not os.path.exists(outputfile)
+    assert chronogram.write_fastdate_prior(tree, {'node_ages': {}}, outputfile=outputfile + '2') is None
+    chronogram.write_fastdate_prior(tree, dates, outputfile=outputfile,
+                                    prior=lambda stats: (0.01 * stats['mean'], 0.8 * stats['mean']))
+    with open(outputfile) as prior:
+        assert sorted(prior.readlines())[0] == "'A','B' norm(0,0.11,8.8)\n"
+
+def test_prune_to_phylo_only(tmp_path):
+    grafted_solution = tmp_path / 'grafted_solution.tre'
+    grafted_solution.write_text("((ott2,ott4)mrcaott2ott4,(ott10,ott3)ott99)ott1;\n")
+    cache_file_dir = chronogram.config.get('paths', 'cache_file_dir')
+    chronogram.config.set('paths', 'cache_file_dir', str(tmp_path))
+    try:
+        assert list(chronogram.phylo_ottids(str(grafted_solution))) == [2, 3, 4, 10]
+        tree = dendropy.Tree.get_from_string("((ott2,ott5)a,(ott4,ott99,ott1),ott3);", schema='newick')
+        chronogram.prune_to_phylo_only(tree, str(grafted_solution))
+        assert sorted(taxon.label for taxon in tree.poll_taxa()) == ['ott2', 'ott3', 'ott4']
+    finally:
+        chronogram.config.set('paths', 'cache_file_dir', cache_file_dir)
+
+def test_catalog_study(tmp_path):
+    study = {'nexml': {'^ot:studyYear': 2010, '^ot:annotationEvents': {'annotation': []},
+                       'treesById': {'trees1': {'treeById': {'tree1': {'^ot:branchLengthMode': 'ot:time',
+                                                                       '^ot:branchLengthTimeUnit': 'Myr',
+                                                                       'nodeById': {'node1': {}, 'node2': {}, 'node3': {}},
+                                                                       'edgeBySourceId': {'node1': {}}}}}}}}
+    study_path = tmp_path / 'ot_1.json'
+    study_path.write_text(json.dumps(study))
+    study_id, trees = chronogram._catalog_study(str(study_path))
+    assert study_id == 'ot_1'
+    assert trees == [{'source_id': 'ot_1@tree1', 'study_id': 'ot_1', 'tree_id': 'tree1',
+                      'branch_length_mode': 'ot:time', 'time_unit': 'Myr', 'tip_count': 2,
+                      'properties': {'ot:studyYear': 2010, 'ot:branchLengthMode': 'ot:time',
+                                     'ot:branchLengthTimeUnit': 'Myr', 'ot:studyId': 'ot_1', 'ot:treeId': 'tree1'}}]
+
+def test_read_head_sha(tmp_path):
+    repo = str(tmp_path)
+    def git(*args):
+        return subprocess.run(['git', '-C', repo, '-c', 'user.name=x', '-c', 'user.email=x@y'] + list(args),
+                              check=True, stdout=subprocess.PIPE).stdout.decode('ascii').strip()
+    git('init', '-q')
+    git('commit', '-q', '--allow-empty', '-m', 'first')
+    assert chronogram.read_head_sha(repo) == git('rev-parse', 'HEAD')
+    git('pack-refs', '--all')
+    assert chronogram.read_head_sha(repo) == git('rev-parse', 'HEAD')
+    first = git('rev-parse', 'HEAD')
+    git('commit', '-q', '--allow-empty', '-m', 'second')
+    git('checkout', '-q', first)
+    assert chronogram.read_head_sha(repo) == first
+    assert chronogram.get_phylesystem_sha(repo_dir=repo) == first
+
+def test_get_phylesystem_sha_ttl():
+    calls = []
+    def ls_remote(name, args, **kwargs):
+        calls.append(args)
+        return subprocess.CompletedProcess(args, 0, stdout='{}\tHEAD\n'.format(len(calls)).encode('ascii'))
+    run_subprocess = chronogram.instrument.run_subprocess
+    chronogram.instrument.run_subprocess = ls_remote
+    try:
+        assert chronogram.get_phylesystem_sha('remote', ttl=60) == '1'
+        assert chronogram.get_phylesystem_sha('remote', ttl=60) == '1'
+        assert chronogram.get_phylesystem_sha('remote', ttl=0) == '2'
+    finally:
+        chronogram.instrument.run_subprocess = run_subprocess
+        chronogram._phylesystem_shas.pop('remote', None)
+
+def test_date_synth_tree(tmp_path):
+    synth_tree = tmp_path / 'labelled_supertree.tre'
+    synth_tree.write_text("((A_ott1,(B_ott2,(C_ott3,D_ott4)mrcaott3ott4)mrcaott2ott3)'Some clade ott10',(E_ott5,F_ott6)mrcaott5ott6)ott9;\n")
+    dates = {'node_ages': {'ott10': [{'age': 8.0}, {'age': 12.0}],
+                           'mrcaott3ott4': [{'age': 2.0}],
+                           'mrcaott5ott6': [{'age': 20.0}]}}
+    outputfile = str(tmp_path / 'dated.tre')
+    ages_out = str(tmp_path / 'ages.txt')
+    nodes = chronogram.date_synth_tree(str(synth_tree), dates=dates, outputfile=outputfile, ages_out=ages_out)
+    assert int(nodes['fixed'].sum()) == 9
+    with open(ages_out) as ages:
+        assert ages.read().split('\n') == ['ott9\t25.0', 'ott10\t10.0', 'mrcaott2ott3\t6.0', 'mrcaott3ott4\t2.0',
+                                           'mrcaott5ott6\t20.0', '']
+    tree = dendropy.Tree.get_from_path(outputfile, schema='newick')
+    tree.calc_node_ages()
+    assert tree.seed_node.age == 25.0
+    assert tree.find_node_with_label('mrcaott2ott3').age == 6.0
+
 def test_fastdate_write():
     # Hmmmmmm should ideally not require rebuild of whole dang thing...
     ## how to test sha check...
     # Normal synth node
-    pass
\ No newline at end of file
+    pass
+
+
+def test_source_cache():
+    nexson = {'nexml': {'treesById': {'trees1': {'treeById': {'tree1': {
+        '^ot:branchLengthMode': 'ot:time', '^ot:branchLengthTimeUnit': 'Myr', '^ot:rootNodeId': 'node1',
+        'nodeById': {'node1': {}, 'node2': {}, 'node3': {}, 'node4': {}, 'node5': {}},
+        'edgeBySourceId': {'node1': {'e1': {'@target': 'node2', '@length': 3.0},
+                                     'e2': {'@target': 'node5', '@length': 5.0}},
+                           'node2': {'e3': {'@target': 'node3', '@length': 2.0},
+                                     'e4': {'@target': 'node4', '@length': 2.0}}}}}}}}}
+    try:
+        ages_data = chronogram.node_ages('ot_1@tree1', study_nexson=nexson, study_sha='sha1')
+        assert ages_data['ages'] == {'node1': 5.0, 'node2': 2.0}
+        hits = chronogram.SOURCE_CACHE.stats['hits']
+        # Served from the cache, so the study isn't fetched again
+        assert chronogram.node_ages('ot_1@tree1', study_sha='sha1') is ages_data
+        assert chronogram.SOURCE_CACHE.stats['hits'] == hits + 1
+        # A new commit of the study replaces the cached ages
+        edited = json.loads(json.dumps(nexson).replace('5.0', '7.0').replace('3.0', '5.0'))
+        assert chronogram.node_ages('ot_1@tree1', study_nexson=edited, study_sha='sha2')['ages'] == {'node1': 7.0,
+                                                                                                      'node2': 2.0}
+        assert ('ot_1@tree1', 'sha1') not in chronogram.SOURCE_CACHE
+    finally:
+        chronogram.SOURCE_CACHE.evict('ot_1@tree1')
+
+
+def test_node_ages_reuses_study_sha():
+    nexson = {'nexml': {'treesById': {'trees1': {'treeById': {'tree1': {
+        '^ot:branchLengthMode': 'ot:time', '^ot:branchLengthTimeUnit': 'Myr', '^ot:rootNodeId': 'node1',
+        'nodeById': {'node1': {}, 'node2': {}, 'node3': {}},
+        'edgeBySourceId': {'node1': {'e1': {'@target': 'node2', '@length': 1.0},
+                                     'e2': {'@target': 'node3', '@length': 1.0}}}}}}}}}
+    class StudyOT(object):
+        _api_endpoint = 'test'
+        downloads = 0
+        def get_study(self, study_id):
+            StudyOT.downloads += 1
+            return type('Response', (object,), {'response_dict': {'sha': 'abc', 'data': nexson}})
+    ot = chronogram.OT
+    chronogram.OT = StudyOT()
+    try:
+        ages_data = chronogram.node_ages('ot_1@tree1')
+        # The study's commit is remembered, so the cached ages are found without downloading it again
+        assert chronogram.node_ages('ot_1@tree1') is ages_data
+        assert chronogram.node_ages('ot_1@tree1') is ages_data
+        assert StudyOT.downloads == 1
+        # Once the commit is older than study_sha_ttl, the study is downloaded again
+        chronogram._api_study_shas[('test', 'ot_1')] = (time.monotonic() - 1000, 'abc')
+        assert chronogram.node_ages('ot_1@tree1') is ages_data
+        assert StudyOT.downloads == 2
+    finally:
+        chronogram.OT = ot
+        chronogram._api_study_shas.clear()
+        chronogram.SOURCE_CACHE.evict('ot_1@tree1')
+
+
+def test_changed_study_ids_git_failure():
+    class FailingGitAction(object):
+        def __init__(self, repo):
+            pass
+        def get_changed_docs(self, since_sha):
+            return False
+    git_action = chronogram.PhylesystemGitAction
+    chronogram.PhylesystemGitAction = FailingGitAction
+    try:
+        assert chronogram.changed_study_ids('phylesystem-1', 'abc123') is None
+    finally:
+        chronogram.PhylesystemGitAction = git_action
+
+
+def test_chronogram_catalog_git_failure(tmp_path):
+    class FailingGitAction(object):
+        def __init__(self, repo):
+            pass
+        def get_changed_docs(self, since_sha):
+            return False
+    repo_dir = str(tmp_path / 'phylesystem')
+    study_path = chronogram.study_filepath(repo_dir, 'ot_1')
+    os.makedirs(os.path.dirname(study_path))
+    with open(study_path, 'w') as study_file:
+        json.dump({'nexml': {'treesById': {'trees1': {'treeById': {'tree1': {'^ot:branchLengthMode': 'ot:time'}}}}}},
+                  study_file)
+    cache_file_path = str(tmp_path / 'chronogram_catalog.db')
+    with chronogram.ChronogramCatalog(cache_file_path) as catalog:
+        catalog.set_metadata({'phylesystem_sha': 'gone'})
+    git_action, get_phylesystem_sha = chronogram.PhylesystemGitAction, chronogram.get_phylesystem_sha
+    chronogram.PhylesystemGitAction = FailingGitAction
+    chronogram.get_phylesystem_sha = lambda repo_url=None, repo_dir=None: 'head'
+    try:
+        # git can't diff from the cached commit, so every study is rescanned
+        with chronogram.chronogram_catalog(repo_dir, cache_file_path=cache_file_path, workers=1) as catalog:
+            assert catalog.find('ot:branchLengthMode', 'ot:time') == ['ot_1@tree1']
+            assert catalog.metadata['phylesystem_sha'] == 'head'
+    finally:
+        chronogram.PhylesystemGitAction, chronogram.get_phylesystem_sha = git_action, get_phylesystem_sha
+
+
+def test_local_study_shas(tmp_path):
+    repo = str(tmp_path)
+    def git(*args):
+        return subprocess.run(['git', '-C', repo, '-c', 'user.name=x', '-c', 'user.email=x@y'] + list(args),
+                              check=True, stdout=subprocess.PIPE).stdout.decode('ascii').strip()
+    study_path = chronogram.study_filepath(repo, 'ot_1')
+    os.makedirs(os.path.dirname(study_path))
+    with open(study_path, 'w') as study_file:
+        study_file.write('{}')
+    git('init', '-q')
+    git('add', '.')
+    git('commit', '-q', '-m', 'first')
+    first = git('rev-parse', 'HEAD')
+    walks = []
+    study_commit_shas = chronogram.study_commit_shas
+    chronogram.study_commit_shas = lambda repo_dir, study_ids: walks.append(set(study_ids)) or \
+        study_commit_shas(repo_dir, study_ids)
+    try:
+        assert chronogram.local_study_shas(repo, ['ot_1', 'ot_2']) == {'ot_1': first}
+        assert chronogram.study_version('ot_1', repo_dir=repo) == (first, None)
+        assert walks == [{'ot_1', 'ot_2'}]
+        # A new HEAD commit walks the log again
+        git('commit', '-q', '--allow-empty', '-m', 'second')
+        assert chronogram.study_version('ot_1', repo_dir=repo) == (first, None)
+        assert walks == [{'ot_1', 'ot_2'}, {'ot_1'}]
+    finally:
+        chronogram.study_commit_shas = study_commit_shas
+        chronogram._local_study_shas.clear()
+
+
+def test_synth_nodes_source_ages_closes_store(tmp_path):
+    dates = {'metadata': {'phylesystem_sha': 'abc'},
+             'node_ages': {'ott1': [{'source_id': 'ot_1@tree1', 'age': 10.0, 'source_node': 'node1'}]}}
+    store = chronogram.write_node_age_store(dates, str(tmp_path / 'node_ages.db'))
+    saved = chronogram._synth_node_info_batch, chronogram.build_synth_node_source_ages
+    chronogram._synth_node_info_batch = lambda nodes, batch_size: ({'ott1': {'node_id': 'ott1'}}, {})
+    chronogram.build_synth_node_source_ages = lambda cache_file_path=None, report=True: store
+    try:
+        record = chronogram.synth_node_source_ages('ott1')
+    finally:
+        chronogram._synth_node_info_batch, chronogram.build_synth_node_source_ages = saved
+    assert [entry['age'] for entry in record['ot:source_node_ages']] == [10.0]
+    with pytest.raises(sqlite3.ProgrammingError):
+        store.conn.execute("SELECT 1")
+
+
+def test_update_keeps_build_metadata(tmp_path):
+    about = {'synth_id': 'test_synth'}
+    dates = {'metadata': {'synth_tree_about': about, 'date': '2020-01-01', 'phylesystem_sha': 'old',
+                          'sources': 2},
+             'node_ages': {'ott1': [{'source_id': 'ot_1@tree1', 'age': 10.0, 'source_node': 'node1'}],
+                           'ott2': [{'source_id': 'ot_2@tree1', 'age': 5.0, 'source_node': 'node1'}]}}
+    remapped = {'metadata': {'synth_tree_about': about, 'date': '2020-02-01', 'phylesystem_sha': 'new',
+                             'sources': 1},
+                'node_ages': {'ott1': [{'source_id': 'ot_1@tree1', 'age': 12.0, 'source_node': 'node1'}]}}
+    combine = chronogram.combine_ages_from_sources
+    chronogram.combine_ages_from_sources = lambda *args, **kwargs: remapped
+    try:
+        store = chronogram.write_node_age_store(dates, str(tmp_path / 'node_ages.db'))
+        store = chronogram.update_synth_node_source_ages(store, ['ot_1'], ['ot_1@tree1', 'ot_2@tree1'])
+    finally:
+        chronogram.combine_ages_from_sources = combine
+    assert store.metadata == {'synth_tree_about': about, 'date': '2020-02-01', 'phylesystem_sha': 'new',
+                              'sources': 2}
+    assert [entry['age'] for entry in store['node_ages']['ott1']] == [12.0]
+
+
+def test_map_conflict_ages_cache_hit(tmp_path):
+    res = {'metadata': {'study_id': 'ot_1', 'tree_id': 'tree1'}, 'supported_nodes': {}}
+    cache_file_path = str(tmp_path / 'source_maps.db')
+    maps_cache = chronogram.source_map_cache(cache_file_path)
+    maps_cache.put('ot_1@tree1', res, synth_id='test_synth', study_sha='abc', precision=0.01, phylesystem_sha='p1')
+    nexson = {'nexml': {'treesById': {'trees1': {'treeById': {'tree1': {
+        '^ot:branchLengthMode': 'ot:time', '^ot:branchLengthTimeUnit': 'Myr', '^ot:rootNodeId': 'node1',
+        'nodeById': {'node1': {}, 'node2': {}, 'node3': {}},
+        'edgeBySourceId': {'node1': {'e1': {'@target': 'node2', '@length': 1.0},
+                                     'e2': {'@target': 'node3', '@length': 1.0}}}}}}}}}
+    downloads = []
+    study_shas = {'ot_1': 'abc'}
+    def download(study_id, repo_dir=None):
+        downloads.append(study_id)
+        return study_shas[study_id], nexson
+    phylesystem_shas = ['p1']
+    saved = chronogram.study_version, chronogram.get_phylesystem_sha, chronogram.conflict_info
+    chronogram.study_version = download
+    chronogram.get_phylesystem_sha = lambda repo_url=None, repo_dir=None: phylesystem_shas[0]
+    chronogram.conflict_info = lambda source_id, **kwargs: {}
+    chronogram._synth_abouts[chronogram.OT._api_endpoint] = (time.monotonic(), {'synth_id': 'test_synth'})
+    try:
+        # Phylesystem hasn't moved since the mapping was made, so the study isn't downloaded
+        assert chronogram.map_conflict_ages('ot_1@tree1', ultrametricity_precision=0.01,
+                                            cache_file_path=cache_file_path) == res
+        assert downloads == []
+        # It has, but the study is at the same commit, which is recorded as current
+        phylesystem_shas[0] = 'p2'
+        assert chronogram.map_conflict_ages('ot_1@tree1', ultrametricity_precision=0.01,
+                                            cache_file_path=cache_file_path) == res
+        assert downloads == ['ot_1']
+        assert maps_cache.versions(['ot_1@tree1'])['ot_1@tree1'] == ('test_synth', 'abc', 0.01, 'p2')
+        # An edited study is remapped
+        phylesystem_shas[0] = 'p3'
+        study_shas['ot_1'] = 'def'
+        remapped = chronogram.map_conflict_ages('ot_1@tree1', ultrametricity_precision=0.01,
+                                                cache_file_path=cache_file_path)
+        assert remapped['metadata']['study_sha'] == 'def'
+        assert maps_cache.versions(['ot_1@tree1'])['ot_1@tree1'] == ('test_synth', 'def', 0.01, 'p3')
+        # Ages estimated with another precision are a miss
+        chronogram.map_conflict_ages('ot_1@tree1', ultrametricity_precision=0.1, cache_file_path=cache_file_path)
+        assert downloads == ['ot_1'] * 3
+    finally:
+        chronogram.study_version, chronogram.get_phylesystem_sha, chronogram.conflict_info = saved
+        chronogram._synth_abouts.pop(chronogram.OT._api_endpoint)
+        chronogram.SOURCE_CACHE.evict('ot_1@tree1')
@@ -0,0 +1,71 @@
+import os
+import json
+
+import dendropy
+
+from chronosynth.arraytree import ArrayTree
+from chronosynth.conflict import SynthConflict
+
+SYNTH = "((A_ott1,(B_ott2,(C_ott3,D_ott4)mrcaott3ott4)mrcaott2ott3)'Some clade ott10',(E_ott5,F_ott6,G_ott7)mrcaott5ott6)ott9;\n"
+
+
+def test_conflict(tmp_path):
+    synth_tree = tmp_path / 'labelled_supertree.tre'
+    synth_tree.write_text(SYNTH)
+    synth = SynthConflict(str(synth_tree))
+    tree = ArrayTree.from_dendropy(dendropy.Tree.get_from_string(
+        "(((a,b)n1,((c,d)n2)n3)n4,((e,f)n5,g)n6,(x,y)n7,(h,i)n8)r;", schema='newick'))
+    # x is not in synth, h and i repeat the taxa of a and c
+    ottids = {'a': 1, 'b': 2, 'c': 3, 'd': 4, 'e': 5, 'f': 6, 'g': 7, 'x': 99, 'h': 1, 'i': 3}
+    conf = synth.conflict(tree, ottids)
+    assert {label: (conf[label]['status'], conf[label]['witness']) for label in conf} == {
+        'a': ('terminal', 'ott1'), 'b': ('terminal', 'ott2'), 'c': ('terminal', 'ott3'),
+        'd': ('terminal', 'ott4'), 'e': ('terminal', 'ott5'), 'f': ('terminal', 'ott6'),
+        'g': ('terminal', 'ott7'),
+        'n1': ('conflicts_with', 'mrcaott2ott3'),
+        'n2': ('supported_by', 'mrcaott3ott4'),
+        'n3': ('partial_path_of', 'mrcaott3ott4'),
+        'n4': ('supported_by', 'ott10'),
+        'n5': ('resolved_by', 'mrcaott5ott6'),
+        'n6': ('supported_by', 'mrcaott5ott6')}
+
+
+def test_nexson_conflict(tmp_path):
+    synth_tree = tmp_path / 'labelled_supertree.tre'
+    synth_tree.write_text(SYNTH)
+    otus = {'otu{}'.format(i): {'^ot:ottId': i} for i in (1, 2, 5, 6)}
+    edges = {'node1': {'e1': {'@source': 'node1', '@target': 'node2'},
+                       'e2': {'@source': 'node1', '@target': 'node5'}},
+             'node2': {'e3': {'@source': 'node2', '@target': 'node3'},
+                       'e4': {'@source': 'node2', '@target': 'node4'},
+                       'e5': {'@source': 'node2', '@target': 'node6'}},
+             'node3': {'e6': {'@source': 'node3', '@target': 'node7'},
+                       'e7': {'@source': 'node3', '@target': 'node8'}}}
+    nodes = {'node1': {}, 'node2': {}, 'node3': {}, 'node4': {'@otu': 'otu5'}, 'node5': {'@otu': 'otu6'},
+             'node6': {'@otu': 'otu1'}, 'node7': {'@otu': 'otu2'}, 'node8': {'@otu': 'otu6'}}
+    nexson = {'nexml': {'otusById': {'otus1': {'otuById': otus}},
+                        'treesById': {'trees1': {'@otus': 'otus1',
+                                                 'treeById': {'tree1': {'^ot:rootNodeId': 'node1',
+                                                                        '^ot:inGroupClade': 'node2',
+                                                                        'nodeById': nodes,
+                                                                        'edgeBySourceId': edges}}}}}}
+    conf = SynthConflict(str(synth_tree)).nexson_conflict(nexson, 'tree1')
+    # The outgroup tip node5 is left out, so node8 is the first tip on ott6
+    assert conf == {'node4': {'status': 'terminal', 'witness': 'ott5'},
+                    'node6': {'status': 'terminal', 'witness': 'ott1'},
+                    'node7': {'status': 'terminal', 'witness': 'ott2'},
+                    'node8': {'status': 'terminal', 'witness': 'ott6'},
+                    'node3': {'status': 'conflicts_with', 'witness': 'ott10'}}
+
+
+def test_conflict_study_fixture():
+    # A hand-built study with hand-worked statuses, see tests/data/conflict/README
+    data_dir = os.path.join(os.path.dirname(__file__), 'data', 'conflict')
+    with open(os.path.join(data_dir, 'get_study', 'ot_999.json')) as study_file:
+        study = json.load(study_file)
+    with open(os.path.join(data_dir, 'conflict_info', 'ot_999@tree1.json')) as conflict_file:
+        expected = json.load(conflict_file)
+    synth = SynthConflict(os.path.join(data_dir, 'labelled_supertree.tre'))
+    conf = synth.nexson_conflict(study['data'], 'tree1')
+    assert conf == {node_id: {'status': node['status'], 'witness': node['witness']}
+                    for node_id, node in expected.items()}
@@ -0,0 +1,79 @@
+import io
+import json
+import sys
+
+from chronosynth import instrument
+
+
+class FakeResponse(object):
+    status_code = 200
+    content = b'{"a": 1}'
+
+
+class FakeRecord(object):
+    status_code = 200
+    response = FakeResponse()
+
+
+class FakeOT(object):
+    _api_endpoint = 'fake'
+
+    def get_study(self, study_id):
+        return FakeRecord()
+
+
+def test_run_records_stages_calls_and_subprocesses(tmp_path):
+    out = io.StringIO()
+    metrics_out = str(tmp_path / 'metrics.json')
+    ot = instrument.InstrumentedOT(FakeOT())
+    with instrument.run(metrics_out, out=out):
+        assert ot._api_endpoint == 'fake'
+        with instrument.run(out=out):
+            with instrument.stage('fetch', 'ot_1@tree1'):
+                ot.get_study('ot_1')
+        instrument.run_subprocess('python', [sys.executable, '-c', 'pass'])
+        assert out.getvalue() == ''
+    summary = instrument.metrics.summary()
+    assert summary['stages']['fetch']['count'] == 1
+    assert summary['api_calls']['get_study'] == {'count': 1,
+                                                 'seconds': summary['api_calls']['get_study']['seconds'],
+                                                 'max_seconds': summary['api_calls']['get_study']['max_seconds'],
+                                                 'bytes': 8,
+                                                 'failed': 0}
+    assert summary['subprocesses']['python']['failed'] == 0
+    assert 'get_study' in out.getvalue()
+    with open(metrics_out) as metrics_file:
+        dumped = json.load(metrics_file)
+    assert dumped['records']['stages'][0]['source_id'] == 'ot_1@tree1'
+
+
+def test_collected():
+    def work():
+        with instrument.stage('ages', 'ot_1@tree1'):
+            return 3
+    instrument.metrics.reset()
+    result, records = instrument.collected(work)
+    assert result == 3
+    assert [record['stage'] for record in records['stages']] == ['ages']
+    other = instrument.Metrics()
+    other.extend(records)
+    assert other.summary()['stages']['ages']['count'] == 1
+
+
+def test_run_report(capsys):
+    with instrument.run():
+        with instrument.stage('fetch', 'ot_1@tree1'):
+            pass
+    assert capsys.readouterr().out.startswith('stage')
+    with instrument.run(report=False):
+        with instrument.stage('fetch', 'ot_1@tree1'):
+            pass
+    assert capsys.readouterr().out == ''
+    assert instrument.metrics.summary()['stages']['fetch']['count'] == 1
+    # Outside a run nothing is kept
+    with instrument.stage('fetch', 'ot_2@tree1'):
+        pass
+    assert instrument.metrics.summary()['stages']['fetch']['count'] == 1
+    with instrument.run(report=False):
+        pass
+    assert instrument.metrics.summary()['stages'] == {}
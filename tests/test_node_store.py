@@ -0,0 +1,116 @@
+import statistics
+
+from chronosynth.node_store import NodeAgeStore, SourceMapCache, write_node_age_store, summarize_node_ages
+from chronosynth.node_store import NodeAgeTable, write_node_age_table, read_node_age_table, ChronogramCatalog
+
+DATES = {'metadata': {'phylesystem_sha': 'a' * 40, 'date': '2021-01-01'},
+         'node_ages': {'mrcaott1ott2': [{'source_id': 'ot_1@tree1', 'age': 10.0, 'source_node': 'node2'},
+                                        {'source_id': 'ot_2@tree1', 'age': 12.0, 'source_node': 'node5'}],
+                       'ott3': [{'source_id': 'ot_1@tree1', 'age': 4.0, 'source_node': 'node3'}]}}
+
+
+def test_write_and_lookup(tmp_path):
+    store = write_node_age_store(DATES, str(tmp_path / 'node_ages.db'))
+    assert store['metadata'] == DATES['metadata']
+    assert store['node_ages']['mrcaott1ott2'] == DATES['node_ages']['mrcaott1ott2']
+    assert 'ott3' in store['node_ages']
+    assert store['node_ages'].get('ott4') is None
+    assert sorted(store['source_index']['ot_1@tree1']) == ['mrcaott1ott2', 'ott3']
+    assert store.to_dict() == DATES
+    assert dict(store['node_summary']) == summarize_node_ages(DATES['node_ages'])
+    store.close()
+
+
+def test_summarize_node_ages():
+    node_ages = {'a': [{'age': age} for age in [3.0, 1.5, 7.25, 2.0]],
+                 'b': [{'age': 4.0}, {'age': None}],
+                 'c': [{'age': None}]}
+    summary = summarize_node_ages(node_ages)
+    assert sorted(summary) == ['a', 'b']
+    ages = [3.0, 1.5, 7.25, 2.0]
+    assert summary['a'] == {'n': 4, 'min': 1.5, 'max': 7.25, 'mean': statistics.mean(ages),
+                            'median': statistics.median(ages), 'variance': statistics.variance(ages)}
+    assert summary['b'] == {'n': 1, 'min': 4.0, 'max': 4.0, 'mean': 4.0, 'median': 4.0, 'variance': None}
+
+
+def test_replace_studies(tmp_path):
+    store = write_node_age_store(DATES, str(tmp_path / 'node_ages.db'))
+    new = {'ott5': [{'source_id': 'ot_1@tree2', 'age': 3.0, 'source_node': 'node9'}]}
+    store.replace_studies(['ot_1'], new)
+    assert 'ott3' not in store['node_ages']
+    assert store['node_ages']['mrcaott1ott2'] == [DATES['node_ages']['mrcaott1ott2'][1]]
+    assert store.sources() == ['ot_1@tree2', 'ot_2@tree1']
+    assert 'ott3' not in store['node_summary']
+    assert store['node_summary']['mrcaott1ott2']['n'] == 1
+    store.close()
+    with NodeAgeStore(str(tmp_path / 'node_ages.db')) as reopened:
+        assert reopened['node_ages']['ott5'] == new['ott5']
+        assert reopened['node_summary']['ott5']['mean'] == 3.0
+
+
+def test_node_age_table(tmp_path):
+    table = NodeAgeTable.from_dict(DATES['node_ages'])
+    assert list(table) == ['mrcaott1ott2', 'ott3']
+    assert table['mrcaott1ott2'] == DATES['node_ages']['mrcaott1ott2']
+    assert table.get('ott4') is None
+    assert table.to_dict() == DATES['node_ages']
+    assert table.summary() == summarize_node_ages(DATES['node_ages'])
+    path = str(tmp_path / 'node_ages.npz')
+    write_node_age_table(DATES, path)
+    dates = read_node_age_table(path)
+    assert dates['metadata'] == DATES['metadata']
+    assert dates['node_ages'].to_dict() == DATES['node_ages']
+    assert dates['node_summary']['ott3']['mean'] == 4.0
+    store = write_node_age_store(dates, str(tmp_path / 'node_ages.db'))
+    assert store.to_dict() == DATES
+    store.close()
+
+
+def test_source_map_cache(tmp_path):
+    res = {'metadata': {'study_id': 'ot_1', 'tree_id': 'tree1', 'time_unit': 'Myr'},
+           'supported_nodes': {'mrcaott1ott2': {'age': 10.0, 'node_label': 'node2'}}}
+    path = str(tmp_path / 'source_maps.db')
+    with SourceMapCache(path) as cache:
+        assert cache.get('ot_1@tree1') is None
+        cache.put('ot_1@tree1', res)
+        cache.put_many({'ot_2@tree1': res, 'ot_3@tree1': res})
+    with SourceMapCache(path) as cache:
+        assert cache.get('ot_1@tree1') == res
+        assert sorted(cache.get_many(['ot_1@tree1', 'ot_3@tree1', 'ot_4@tree1'])) == ['ot_1@tree1', 'ot_3@tree1']
+        cache.delete(['ot_1@tree1'])
+        assert 'ot_1@tree1' not in cache
+        assert len(cache) == 2
+
+
+def test_source_map_cache_versions(tmp_path):
+    res = {'metadata': {'study_id': 'ot_1', 'tree_id': 'tree1'}, 'supported_nodes': {}}
+    with SourceMapCache(str(tmp_path / 'source_maps.db')) as cache:
+        cache.put('ot_1@tree1', res, synth_id='opentree13.4', study_sha='abc', precision=0.01)
+        assert cache.get('ot_1@tree1', synth_id='opentree13.4', study_sha='abc', precision=0.01) == res
+        assert cache.get('ot_1@tree1', synth_id='opentree14.9', study_sha='abc') is None
+        assert cache.get('ot_1@tree1', study_sha='def') is None
+        assert cache.get('ot_1@tree1', precision=0.1) is None
+        # An unknown study commit can't be checked
+        assert cache.get('ot_1@tree1', study_sha=None) is None
+        assert cache.versions(['ot_1@tree1', 'ot_2@tree1']) == {'ot_1@tree1': ('opentree13.4', 'abc', 0.01, None)}
+        cache.confirm(['ot_1@tree1'], 'f00')
+        assert cache.versions(['ot_1@tree1']) == {'ot_1@tree1': ('opentree13.4', 'abc', 0.01, 'f00')}
+
+
+def test_chronogram_catalog(tmp_path):
+    def tree(study_id, tree_id, mode, curators):
+        return {'source_id': '{}@{}'.format(study_id, tree_id), 'study_id': study_id, 'tree_id': tree_id,
+                'branch_length_mode': mode, 'time_unit': 'Myr', 'tip_count': 4, 'study_sha': 'a' * 40,
+                'properties': {'ot:branchLengthMode': mode, 'ot:studyYear': 2010, 'ot:curatorName': curators}}
+    with ChronogramCatalog(str(tmp_path / 'catalog.db')) as catalog:
+        catalog.replace_studies(['ot_1', 'ot_2'], [tree('ot_1', 'tree1', 'ot:time', ['A', 'B']),
+                                                   tree('ot_1', 'tree2', 'ot:substitutionCount', ['A', 'B']),
+                                                   tree('ot_2', 'tree1', 'ot:time', ['C'])])
+        assert catalog.find('ot:branchLengthMode', 'ot:time') == ['ot_1@tree1', 'ot_2@tree1']
+        assert catalog.find('ot:studyYear', 2010) == ['ot_1@tree1', 'ot_1@tree2', 'ot_2@tree1']
+        assert catalog.find('ot:curatorName', 'B') == ['ot_1@tree1', 'ot_1@tree2']
+        catalog.replace_studies(['ot_1'], [tree('ot_1', 'tree3', 'ot:time', ['A'])])
+        assert catalog.find('ot:branchLengthMode', 'ot:time') == ['ot_1@tree3', 'ot_2@tree1']
+        assert catalog.tree('ot_1@tree2') is None
+        assert catalog.tree('ot_1@tree3')['tip_count'] == 4
+        assert len(catalog) == 2
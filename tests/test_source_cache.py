@@ -0,0 +1,32 @@
+from chronosynth.source_cache import SourceCache
+
+
+def test_source_cache():
+    cache = SourceCache(max_sources=2)
+    assert cache.get('ot_1@tree1', 'synth1', 'tree') is None
+    assert cache.put('ot_1@tree1', 'synth1', 'tree', 'tree1') == 'tree1'
+    cache.put('ot_1@tree1', 'synth1', 'ages', None)
+    assert cache.get('ot_1@tree1', 'synth1', 'ages', default=False) is None
+    assert cache.get('ot_1@tree1', 'synth2', 'tree') is None
+    cache.put('ot_2@tree1', 'synth1', 'tree', 'tree2')
+    # ot_1@tree1 was used last, so ot_2@tree1 goes first
+    assert cache.get('ot_1@tree1', 'synth1', 'tree') == 'tree1'
+    cache.put('ot_3@tree1', 'synth1', 'tree', 'tree3')
+    assert ('ot_2@tree1', 'synth1') not in cache
+    assert len(cache) == 2
+    assert cache.stats == {'hits': 2, 'misses': 2, 'evictions': 1}
+    assert cache.evict(version='synth1') == 2
+    assert len(cache) == 0
+    assert cache.stats['evictions'] == 3
+
+
+def test_source_cache_new_version():
+    cache = SourceCache()
+    cache.put('ot_1@tree1', 'sha1', 'tree', 'tree1')
+    cache.put('ot_2@tree1', 'sha1', 'tree', 'tree2')
+    # A new commit of a source replaces its stale entry
+    cache.put('ot_1@tree1', 'sha2', 'tree', 'tree1 edited')
+    assert ('ot_1@tree1', 'sha1') not in cache
+    assert cache.get('ot_1@tree1', 'sha2', 'tree') == 'tree1 edited'
+    assert cache.get('ot_2@tree1', 'sha1', 'tree') == 'tree2'
+    assert cache.stats['evictions'] == 1
@@ -0,0 +1,31 @@
+import dendropy
+
+from chronosynth.synth_index import SynthTreeIndex, normalize_node_label
+
+SYNTH = ("((('Homo sapiens ott770315':1,Pan_ott417950)mrcaott770315ott417950,Gorilla_ott417969)Homininae_ott312031,"
+         "('Pongo, the orangutans ott417949'[&x=(1,2)],ott5)mrcaott5ott417949)Hominidae_ott770311;\n")
+
+
+def test_normalize_node_label():
+    assert normalize_node_label("'Homo sapiens ott770315'") == 'ott770315'
+    assert normalize_node_label('Homininae_ott312031') == 'ott312031'
+    assert normalize_node_label('mrcaott5ott417949') == 'mrcaott5ott417949'
+    assert normalize_node_label('Homininae') is None
+
+
+def test_subtree_newick(tmp_path):
+    tree_path = str(tmp_path / 'labelled_supertree.tre')
+    with open(tree_path, 'w') as out:
+        out.write(SYNTH)
+    index = SynthTreeIndex(tree_path)
+    assert len(index) == 9
+    assert 'ott1' not in index
+    assert index.subtree_newick('ott312031', label_format='name') == (
+        "(('Homo sapiens ott770315':1,Pan_ott417950)mrcaott770315ott417950,Gorilla_ott417969)Homininae_ott312031;")
+    assert index.subtree_newick('mrcaott5ott417949') == "(ott417949[&x=(1,2)],ott5)mrcaott5ott417949;"
+    assert index.subtree_newick('ott417969') == "ott417969;"
+    # The saved index is reloaded rather than rebuilt
+    index = SynthTreeIndex(tree_path)
+    tree = dendropy.Tree.get_from_string(index.subtree_newick('ott770311'), schema='newick')
+    assert sorted(leaf.taxon.label for leaf in tree.leaf_node_iter()) == ['ott417949', 'ott417950', 'ott417969',
+                                                                         'ott5', 'ott770315']
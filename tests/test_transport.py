@@ -0,0 +1,69 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+from opentree.ws_wrapper import WebServiceWrapper
+
+from chronosynth import transport
+
+
+class StudyHandler(BaseHTTPRequestHandler):
+    """Serves one study with an ETag, failing the first request with a 503"""
+    requests = []
+
+    def do_GET(self):
+        StudyHandler.requests.append(self.headers.get('If-None-Match'))
+        if len(StudyHandler.requests) == 1:
+            self.send_response(503)
+            self.end_headers()
+            return
+        if self.headers.get('If-None-Match') == '"v1"':
+            self.send_response(304)
+            self.end_headers()
+            return
+        body = json.dumps({'sha': 'v1', 'data': {'nexml': {}}}).encode('utf-8')
+        self.send_response(200)
+        self.send_header('ETag', '"v1"')
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def test_transport_retries_and_revalidates(tmp_path):
+    server = HTTPServer(('127.0.0.1', 0), StudyHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        http = transport.Transport(cache_path=str(tmp_path / 'http_cache.db'), retries=2, backoff=0)
+        ws = transport.install(WebServiceWrapper('127.0.0.1:{}'.format(server.server_port)), http)
+        first = ws._call_api('study/ot_1', http_method='GET')
+        second = ws._call_api('study/ot_1', http_method='GET')
+    finally:
+        server.shutdown()
+    assert StudyHandler.requests == [None, None, '"v1"']
+    assert first.response_dict == second.response_dict == {'sha': 'v1', 'data': {'nexml': {}}}
+    assert second.status_code == 200
+    assert http.stats == {'requests': 2, 'not_modified': 1, 'cached': 1}
+    assert ws.call_history == []
+
+
+class Response(object):
+    def __init__(self, content):
+        self.content = content
+        self.headers = {'ETag': '"v1"'}
+
+
+def test_response_cache_max_bytes(tmp_path):
+    cache = transport.ResponseCache(str(tmp_path / 'http_cache.db'), max_bytes=150)
+    for key in ('a', 'b', 'c'):
+        cache.put(key, key, Response(bytes(range(60))))
+        if key == 'b':
+            cache.get('a')
+    # b is the least recently used once a is read, and is dropped to fit c
+    assert cache.get('a') is not None
+    assert cache.get('b') is None
+    assert cache.get('c')[3] == bytes(range(60))